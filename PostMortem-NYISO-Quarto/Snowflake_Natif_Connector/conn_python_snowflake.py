@@ -1,30 +1,79 @@
 import pandas as pd
+import pyarrow as pa
 import os
+import inspect
+import time
 import sqlparse
-from cryptography.hazmat.primitives import serialization
-from cryptography.hazmat.backends import default_backend
 import snowflake.connector
+from Snowflake_Natif_Connector.credential_cache import get_private_key_der
+from Snowflake_Natif_Connector import query_cache
+from Snowflake_Natif_Connector import query_log
+
+# 'pandas'       : default numpy-backed DataFrame (cursor.fetch_pandas_all)
+# 'arrow'        : pyarrow.Table straight from the cursor
+# 'arrow_pandas' : DataFrame backed by pd.ArrowDtype columns, built without copying the buffers
+RESULT_FORMATS = ('pandas', 'arrow', 'arrow_pandas')
+
+# target types of a query schema ({column: 'float32' | 'int32' | 'category'}, see apply_schema)
+SCHEMA_ARROW_TYPES = {'float32': pa.float32(), 'int32': pa.int32()}
+
+# MAG_MULTI_STATEMENT=0 sends the statements of a script one by one instead of in a single request
+MULTI_STATEMENT = os.environ.get('MAG_MULTI_STATEMENT', '1') != '0'
+_MULTI_STATEMENT_SUPPORT = {}
 
 def split_sql_queries(queryText):
     queries_without_comments = sqlparse.format(queryText, strip_comments=True)
     queries = sqlparse.split(queries_without_comments)
     return [q for q in queries if not q.startswith('//')]
 
+def prepare_statements(query_data):
+    """
+    Statements to execute as a list of (sql, bind values).
+    query_data is either a raw script (split here, nothing to bind) or the output of
+    QueryTemplate.bind (already split once when the template was registered).
+    """
+    if isinstance(query_data, str):
+        return [(statement, ()) for statement in split_sql_queries(query_data)]
+    return list(query_data)
+
+def supports_multi_statement(cursor):
+    """
+    True if the cursor can run a whole script in one request (snowflake connector: execute(..., num_statements=n) + nextset).
+    """
+    cursor_type = type(cursor)
+    if cursor_type not in _MULTI_STATEMENT_SUPPORT:
+        try:
+            parameters = inspect.signature(cursor.execute).parameters
+        except (TypeError, ValueError):
+            parameters = {}
+        _MULTI_STATEMENT_SUPPORT[cursor_type] = 'num_statements' in parameters and hasattr(cursor, 'nextset')
+    return _MULTI_STATEMENT_SUPPORT[cursor_type]
+
+def execute_statements(cursor, statements):
+    """
+    Execute a list of (sql, bind values), the cursor is left on the result of the last statement.
+
+    Scripts (SET, ALTER SESSION, CREATE TEMPORARY TABLE... then the final select) are sent as a
+    single multi-statement request, one round trip and one compilation instead of one per statement,
+    and only the last result set is kept. Backends without multi-statement support run the statements one by one.
+    """
+    if MULTI_STATEMENT and len(statements) > 1 and supports_multi_statement(cursor):
+        script = ';\n'.join(statement.strip().rstrip(';') for statement, _ in statements)
+        params = tuple(value for _, values in statements for value in values)
+        cursor.execute(script, params or None, num_statements=len(statements))
+        while cursor.nextset():
+            pass
+        return
+    for statement, params in statements:
+        cursor.execute(statement, params or None)
+
 def establishconnection(warehouse,database,schema):
     username = os.environ['MAG_SNOWFLAKE_USERNAME']
     pathToKey = os.environ['MAG_SNOWFLAKE_PRIVATE_KEY_PATH']
     passphrase = os.environ['MAG_SNOWFLAKE_PASSPHRASE']
     
-    with open(pathToKey, "rb") as key:
-        p_key= serialization.load_pem_private_key(
-            key.read(),
-            password=passphrase.encode(),
-            backend=default_backend()
-        )
-    pkb = p_key.private_bytes(
-        encoding=serialization.Encoding.DER,
-        format=serialization.PrivateFormat.PKCS8,
-        encryption_algorithm=serialization.NoEncryption())
+    # decrypted once per process (and shared between processes with the optional keyring file)
+    pkb = get_private_key_der(pathToKey, passphrase)
     
     conn = snowflake.connector.connect(
         user=username,
@@ -32,19 +81,204 @@ def establishconnection(warehouse,database,schema):
         account='mag.east-us-2.azure',
         warehouse=warehouse,
         database=database,
-        schema=schema
+        schema=schema,
+        # keep the session token valid while the connection waits in the pool
+        client_session_keep_alive=True,
+        # ? placeholders are bound server side (services.query_templates)
+        paramstyle='qmark'
     )
     return(conn)
 
-def executeQueryNatif(query_data,conn):
-    statements_to_execute = split_sql_queries(query_data)
+def normalize_arrow_table(table: pa.Table) -> pa.Table:
+    """
+    Snowflake NUMBER(p,s) columns come out of the arrow path as decimal128.
+    Cast them to int64 (scale 0) or float64 so they behave like fetch_pandas_all columns.
+    DATE columns are cast to timestamps, plotly cannot convert ArrowDtype date32 columns.
+    Only these columns are rewritten, the other buffers are kept as is.
+    """
+    for i, field in enumerate(table.schema):
+        if pa.types.is_decimal(field.type):
+            target = pa.int64() if field.type.scale == 0 else pa.float64()
+        elif pa.types.is_date(field.type):
+            target = pa.timestamp('ms')
+        else:
+            continue
+        table = table.set_column(i, field.name, table.column(i).cast(target, safe=False))
+    return table
+
+def arrow_to_pandas(table: pa.Table) -> pd.DataFrame:
+    """
+    Wrap an arrow table in a DataFrame with pd.ArrowDtype columns (no conversion to numpy/object).
+    """
+    return normalize_arrow_table(table).to_pandas(types_mapper=query_cache.arrow_dtype)
+
+def from_pandas(df: pd.DataFrame, result_format: str = 'pandas'):
+    """
+    Result built locally (local store, local pivot) in the requested format (see RESULT_FORMATS).
+    """
+    if result_format not in RESULT_FORMATS:
+        raise ValueError(f"result_format must be one of {RESULT_FORMATS}, got {result_format!r}")
+    if result_format == 'pandas':
+        return df
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    return table if result_format == 'arrow' else arrow_to_pandas(table)
+
+def apply_schema(result, schema=None):
+    """
+    Downcast the columns listed in schema ({column: 'float32' | 'int32' | 'category'}) of a DataFrame
+    or of a pyarrow.Table ('category' is a dictionary column). Columns missing from the result are
+    ignored, the other columns are left as is.
+    """
+    if not schema:
+        return result
+    if isinstance(result, pa.Table):
+        for name, dtype in schema.items():
+            i = result.schema.get_field_index(name)
+            if i < 0:
+                continue
+            column = result.column(i)
+            column = column.dictionary_encode() if dtype == 'category' else column.cast(SCHEMA_ARROW_TYPES[dtype], safe=False)
+            result = result.set_column(i, name, column)
+        return result
+    dtypes = {}
+    for name, dtype in schema.items():
+        if name not in result.columns:
+            continue
+        # numpy int32 cannot hold nulls, use the nullable pandas type instead
+        dtypes[name] = 'Int32' if dtype == 'int32' and result[name].isna().any() else dtype
+    return result.astype(dtypes)
+
+def fetch_result(cursor, result_format='pandas', schema=None):
+    """
+    Fetch the result of the last executed statement in the requested format (see RESULT_FORMATS),
+    downcast with the query schema if one is given (see apply_schema).
+    """
+    if result_format not in RESULT_FORMATS:
+        raise ValueError(f"result_format must be one of {RESULT_FORMATS}, got {result_format!r}")
+    if result_format == 'pandas':
+        return apply_schema(cursor.fetch_pandas_all(), schema)
+    table = apply_schema(normalize_arrow_table(cursor.fetch_arrow_all(force_return_table=True)), schema)
+    if result_format == 'arrow':
+        return table
+    return table.to_pandas(types_mapper=query_cache.arrow_dtype)
+
+def fetch_batches(cursor, result_format='pandas'):
+    """
+    Yield the result of the last executed statement batch by batch, as the cursor downloads the result chunks.
+    """
+    if result_format not in RESULT_FORMATS:
+        raise ValueError(f"result_format must be one of {RESULT_FORMATS}, got {result_format!r}")
+    if result_format == 'pandas':
+        yield from cursor.fetch_pandas_batches()
+        return
+    for table in cursor.fetch_arrow_batches():
+        table = normalize_arrow_table(table)
+        yield table if result_format == 'arrow' else table.to_pandas(types_mapper=query_cache.arrow_dtype)
+
+def executeQueryNatif(query_data,conn,result_format='pandas',use_cache=True,schema=None):
+    if hasattr(conn, 'submit_query'):
+        # services.async_queries.AsyncQueryClient: submit without blocking, a QueryFuture is returned
+        return conn.submit_query(query_data, result_format, schema, use_cache)
+    statements_to_execute = prepare_statements(query_data)
+
+    # results are cached by normalized sql + warehouse (memory LRU, then parquet on disk), see query_cache
+    use_cache = use_cache and query_cache.ENABLED
+    if use_cache:
+        key = query_cache.cache_key(statements_to_execute, getattr(conn, 'warehouse', None), result_format, schema)
+        started = time.perf_counter()
+        cached = query_cache.RESULT_CACHE.get(key, result_format)
+        if cached is not None:
+            query_log.log_query(statements_to_execute, conn, result_format, 0.0, time.perf_counter() - started,
+                                None, len(cached), query_cache.result_nbytes(cached), cached=True)
+            return cached
+
+    if hasattr(conn, 'routed_connection'):
+        # services.warehouse_routing.WarehouseRouter: run on the warehouse sized for the calling function
+        dataframe = conn.run_routed(lambda routed: executeQueryNatif(statements_to_execute, routed, result_format, False, schema))
+        if use_cache:
+            query_cache.RESULT_CACHE.put(key, result_format, dataframe)
+        return dataframe
+
+    # every query is timed and logged with its caller, see query_log.QUERY_LOG.print_summary()
+    started = time.perf_counter()
     cursor = conn.cursor()
     
     try:
-        for statement in statements_to_execute:
-            cursor.execute(statement)
-        dataframe = cursor.fetch_pandas_all()
+        execute_statements(cursor, statements_to_execute)
+        executed = time.perf_counter()
+        dataframe = fetch_result(cursor, result_format, schema)
+        fetched = time.perf_counter()
+        query_id = getattr(cursor, 'sfqid', None)
     finally:
         cursor.close()
+
+    query_log.log_query(statements_to_execute, conn, result_format, executed - started, fetched - executed,
+                        query_id, len(dataframe), query_cache.result_nbytes(dataframe))
+    if use_cache:
+        query_cache.RESULT_CACHE.put(key, result_format, dataframe)
     return dataframe
 
+def iterQueryNatif(query_data,conn,result_format='pandas'):
+    """
+    Same as executeQueryNatif, but yields the final result set batch by batch instead of
+    materializing it. The cursor stays open until the generator is exhausted or closed.
+    """
+    if hasattr(conn, 'routed_connection'):
+        with conn.routed_connection() as routed:
+            yield from iterQueryNatif(query_data, routed, result_format)
+        return
+    statements_to_execute = prepare_statements(query_data)
+    started = time.perf_counter()
+    cursor = conn.cursor()
+    rows = nbytes = 0
+
+    try:
+        execute_statements(cursor, statements_to_execute)
+        executed = time.perf_counter()
+        for batch in fetch_batches(cursor, result_format):
+            rows += len(batch)
+            nbytes += query_cache.result_nbytes(batch)
+            yield batch
+        # fetch time includes the time spent by the consumer on each batch
+        query_log.log_query(statements_to_execute, conn, result_format, executed - started,
+                            time.perf_counter() - executed, getattr(cursor, 'sfqid', None), rows, nbytes)
+    finally:
+        cursor.close()
+
+def submitQueryNatif(query_data,conn):
+    """
+    Run the setup statements of the script (SET, ALTER SESSION, CREATE TEMPORARY TABLE...) and
+    submit the last statement with execute_async. Returns the Snowflake query id of the last statement,
+    its result can be polled with queryIsRunningNatif and fetched with collectQueryNatif.
+    """
+    statements_to_execute = prepare_statements(query_data)
+    cursor = conn.cursor()
+
+    try:
+        execute_statements(cursor, statements_to_execute[:-1])
+        statement, params = statements_to_execute[-1]
+        cursor.execute_async(statement, params or None)
+        query_id = cursor.sfqid
+    finally:
+        cursor.close()
+    return query_id
+
+def queryIsRunningNatif(query_id,conn):
+    """
+    True while the query is queued or running, raises the query error if it failed.
+    """
+    status = conn.get_query_status_throw_if_error(query_id)
+    return conn.is_still_running(status)
+
+def collectQueryNatif(query_id,conn,result_format='pandas',schema=None):
+    """
+    Fetch the result of a query submitted with submitQueryNatif (waits for it if still running).
+    """
+    cursor = conn.cursor()
+
+    try:
+        cursor.get_results_from_sfqid(query_id)
+        result = fetch_result(cursor, result_format, schema)
+    finally:
+        cursor.close()
+    return result
@@ -0,0 +1,164 @@
+import base64
+import json
+import os
+import threading
+import time
+from typing import Dict, Optional, Tuple
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.scrypt import Scrypt
+from cryptography.hazmat.backends import default_backend
+
+# Optional keyring file shared by the processes of a parallel render, disabled when the variable is not set
+KEYRING_PATH_ENV = 'MAG_SNOWFLAKE_KEYRING_PATH'
+KEYRING_TTL_ENV = 'MAG_SNOWFLAKE_KEYRING_TTL'
+DEFAULT_KEYRING_TTL = 8 * 3600  # seconds
+LOCK_TIMEOUT = 10  # seconds, a lock file older than this is considered stale
+# scrypt work factor of the keyring key (about 0.1 s and 32 MB per derivation), stored in each entry
+KEYRING_KDF = {'n': 2 ** 15, 'r': 8, 'p': 1}
+
+# (absolute key path, key file mtime) -> unencrypted PKCS8 DER bytes
+_DER_CACHE: Dict[Tuple[str, float], bytes] = {}
+_DER_CACHE_LOCK = threading.Lock()
+# (salt, scrypt parameters, passphrase) -> cipher, so the key is derived once per process
+_CIPHER_CACHE: Dict[tuple, AESGCM] = {}
+
+
+def _decrypt_pem(pathToKey: str, passphrase: str) -> bytes:
+    with open(pathToKey, "rb") as key:
+        p_key = serialization.load_pem_private_key(
+            key.read(),
+            password=passphrase.encode(),
+            backend=default_backend()
+        )
+    return p_key.private_bytes(
+        encoding=serialization.Encoding.DER,
+        format=serialization.PrivateFormat.PKCS8,
+        encryption_algorithm=serialization.NoEncryption())
+
+
+def _keyring_cipher(passphrase: str, salt: bytes, kdf: Dict[str, int]) -> AESGCM:
+    # The keyring holds the decrypted key: its AES key is derived with scrypt so a copy of the file
+    # cannot be brute-forced faster than the PEM it replaces. Derived once per process and salt.
+    cache_key = (salt, kdf['n'], kdf['r'], kdf['p'], passphrase)
+    if cache_key not in _CIPHER_CACHE:
+        key = Scrypt(salt=salt, length=32, n=kdf['n'], r=kdf['r'], p=kdf['p']).derive(passphrase.encode())
+        _CIPHER_CACHE[cache_key] = AESGCM(key)
+    return _CIPHER_CACHE[cache_key]
+
+
+class _FileLock:
+    """
+    Portable lock based on the atomic creation of <path>.lock (works on Windows and Linux).
+    """
+
+    def __init__(self, path: str):
+        self.lock_path = path + '.lock'
+
+    def __enter__(self):
+        deadline = time.time() + LOCK_TIMEOUT
+        while True:
+            try:
+                fd = os.open(self.lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o600)
+                os.close(fd)
+                return self
+            except FileExistsError:
+                try:
+                    if time.time() - os.path.getmtime(self.lock_path) > LOCK_TIMEOUT:
+                        os.remove(self.lock_path)  # left behind by a killed process
+                        continue
+                except FileNotFoundError:
+                    continue
+                if time.time() > deadline:
+                    raise TimeoutError(f"Could not lock {self.lock_path}")
+                time.sleep(0.05)
+
+    def __exit__(self, *exc):
+        try:
+            os.remove(self.lock_path)
+        except FileNotFoundError:
+            pass
+
+
+def _read_keyring(keyring_path: str, cache_key: Tuple[str, float], passphrase: str) -> Optional[bytes]:
+    try:
+        with open(keyring_path, 'r') as f:
+            entry = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+    if entry.get('key_path') != cache_key[0] or entry.get('key_mtime') != cache_key[1]:
+        return None
+    if entry.get('expires', 0) < time.time():
+        return None
+    try:
+        # an entry written without scrypt parameters (older keyring) is not trusted: rewritten from the PEM
+        kdf = {k: int(entry['kdf'][k]) for k in ('n', 'r', 'p')}
+        if kdf['n'] < KEYRING_KDF['n']:
+            return None
+        salt, nonce, data = (base64.b64decode(entry[k]) for k in ('salt', 'nonce', 'data'))
+        return _keyring_cipher(passphrase, salt, kdf).decrypt(nonce, data, cache_key[0].encode())
+    except Exception:
+        return None  # wrong passphrase or corrupted file: fall back to the PEM
+
+
+def _write_keyring(keyring_path: str, cache_key: Tuple[str, float], passphrase: str, der: bytes, ttl: float) -> None:
+    salt, nonce = os.urandom(16), os.urandom(12)
+    entry = {
+        'key_path': cache_key[0],
+        'key_mtime': cache_key[1],
+        'expires': time.time() + ttl,
+        'kdf': dict(KEYRING_KDF, name='scrypt'),
+        'salt': base64.b64encode(salt).decode(),
+        'nonce': base64.b64encode(nonce).decode(),
+        'data': base64.b64encode(_keyring_cipher(passphrase, salt, KEYRING_KDF).encrypt(nonce, der, cache_key[0].encode())).decode(),
+    }
+    tmp_path = keyring_path + '.tmp'
+    fd = os.open(tmp_path, os.O_CREAT | os.O_TRUNC | os.O_WRONLY, 0o600)
+    with os.fdopen(fd, 'w') as f:
+        json.dump(entry, f)
+    os.replace(tmp_path, keyring_path)
+
+
+def get_private_key_der(pathToKey: str, passphrase: str) -> bytes:
+    """
+    Return the private key as unencrypted PKCS8 DER bytes, as expected by snowflake.connector.connect.
+
+    The PEM decryption only happens once per process (and per key file version). If
+    MAG_SNOWFLAKE_KEYRING_PATH is set, the key is also kept in that file, encrypted with a key
+    derived from the passphrase (scrypt, KEYRING_KDF) and valid MAG_SNOWFLAKE_KEYRING_TTL seconds,
+    so the other processes of a parallel render skip the PEM decryption too. Access to the file is serialized with a lock file.
+    """
+    abs_path = os.path.abspath(pathToKey)
+    cache_key = (abs_path, os.path.getmtime(abs_path))
+    with _DER_CACHE_LOCK:
+        if cache_key in _DER_CACHE:
+            return _DER_CACHE[cache_key]
+
+        keyring_path = os.environ.get(KEYRING_PATH_ENV)
+        if not keyring_path:
+            der = _decrypt_pem(abs_path, passphrase)
+        else:
+            ttl = float(os.environ.get(KEYRING_TTL_ENV, DEFAULT_KEYRING_TTL))
+            with _FileLock(keyring_path):
+                der = _read_keyring(keyring_path, cache_key, passphrase)
+                if der is None:
+                    der = _decrypt_pem(abs_path, passphrase)
+                    _write_keyring(keyring_path, cache_key, passphrase, der, ttl)
+        _DER_CACHE[cache_key] = der
+        return der
+
+
+def clear_credential_cache(remove_keyring: bool = False) -> None:
+    """
+    Forget the decrypted keys of this process (e.g. after a key rotation), and optionally delete the keyring file.
+    """
+    with _DER_CACHE_LOCK:
+        _DER_CACHE.clear()
+        _CIPHER_CACHE.clear()
+        keyring_path = os.environ.get(KEYRING_PATH_ENV)
+        if remove_keyring and keyring_path:
+            with _FileLock(keyring_path):
+                try:
+                    os.remove(keyring_path)
+                except FileNotFoundError:
+                    pass
@@ -0,0 +1,191 @@
+import itertools
+import os
+import re
+from typing import Any, Iterator, List, Optional, Sequence
+import duckdb
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# Local stand-in for the Snowflake connection: DuckDB on fixture extracts, so the query functions
+# of services.snowflake_queries run without a warehouse (benchmarks, CI, iterating on the plots).
+#
+# Fixtures are parquet files laid out as <fixtures_dir>/<DATABASE>/<SCHEMA>/<TABLE>.parquet
+# (or a <TABLE> directory of parquet files), each one is exposed as the view DATABASE.SCHEMA.TABLE.
+BATCH_ROWS = 100_000
+
+# Snowflake functions missing from DuckDB, created in every connection
+_MACROS = [
+    "CREATE OR REPLACE MACRO iff(condition, if_true, if_false) AS CASE WHEN condition THEN if_true ELSE if_false END",
+    """CREATE OR REPLACE MACRO dateadd(unit, n, d) AS d::TIMESTAMP + CASE upper(unit)
+        WHEN 'YEAR' THEN to_years(n::INT) WHEN 'MONTH' THEN to_months(n::INT) WHEN 'DAY' THEN to_days(n::INT)
+        WHEN 'HOUR' THEN to_hours(n::BIGINT) WHEN 'MINUTE' THEN to_minutes(n::BIGINT) END""",
+    "CREATE OR REPLACE MACRO to_date(d) AS CAST(d AS DATE)",
+    "CREATE OR REPLACE MACRO current_warehouse() AS 'DUCKDB'",
+]
+
+# (pattern, replacement) applied in order on every statement, string literals excluded
+_REWRITES = [
+    # IN (select value::int from table(flatten(input=>parse_json(?)))): JSON list bound by query_templates.json_list
+    (re.compile(r"table\s*\(\s*flatten\s*\(\s*input\s*=>\s*parse_json\s*\(\s*\?\s*\)\s*\)\s*\)", re.I),
+     "(select unnest(CAST(? AS JSON)::JSON[]) AS value)"),
+    # a JSON string cast to varchar keeps its quotes in DuckDB
+    (re.compile(r"\bvalue((?:\[\d+\])?)::string\b", re.I), r"(value\1->>'$')"),
+    # date part given as a keyword: DATEADD(HOUR, ...), DATE_TRUNC(MONTH, ...), DATEDIFF(MONTH, ...)
+    (re.compile(r"\b(dateadd|date_trunc|datediff)\s*\(\s*([A-Za-z]+)\s*,", re.I), r"\1('\2',"),
+    # SPLIT_PART(x, ':', 0) is the first part in Snowflake, an empty string in DuckDB
+    (re.compile(r"\b(split_part\s*\([^()]*,)\s*0\s*\)", re.I), r"\g<1>1)"),
+    # PIVOT (SUM(v) FOR c IN (ANY ORDER BY c)): DuckDB pivot on every value, columns named 'value' like Snowflake
+    (re.compile(r"\bSELECT\s+\*\s+FROM\s+(\w+)\s+PIVOT\s*\(\s*SUM\s*\(\s*(\w+)\s*\)\s*FOR\s+(\w+)\s+IN\s*"
+                r"\(\s*ANY\s+ORDER\s+BY\s+\w+\s*\)\s*\)", re.I),
+     r"SELECT * FROM (PIVOT \1 ON ('''' || \3 || '''') USING SUM(\2))"),
+]
+# session settings without equivalent, skipped
+_SKIPPED = re.compile(r"^\s*ALTER\s+SESSION\b", re.I)
+_LITERALS = re.compile(r"'(?:[^']|'')*'")
+_PLACEHOLDERS = re.compile(r"\x00(\d+)\x00")
+
+_query_ids = itertools.count(1)
+
+
+def translate_sql(statement: str) -> Optional[str]:
+    """
+    DuckDB version of a Snowflake statement of the repository queries, None for a statement to skip.
+    Only the constructs used by services.snowflake_queries are translated.
+    """
+    if _SKIPPED.match(statement):
+        return None
+    # string literals are swapped for placeholders while rewriting, then put back
+    literals = []
+
+    def hide(match):
+        literals.append(match.group(0))
+        return f"\x00{len(literals) - 1}\x00"
+
+    text = _LITERALS.sub(hide, statement)
+    for pattern, replacement in _REWRITES:
+        text = pattern.sub(replacement, text)
+    return _PLACEHOLDERS.sub(lambda m: literals[int(m.group(1))], text)
+
+
+class DuckDBCursor:
+    """
+    Cursor with the subset of the snowflake connector cursor used by conn_python_snowflake.
+    """
+
+    def __init__(self, cursor: 'duckdb.DuckDBPyConnection'):
+        self._cursor = cursor
+        self._has_result = False
+        self.sfqid: Optional[str] = None
+
+    def execute(self, sql: str, params: Optional[Sequence[Any]] = None) -> 'DuckDBCursor':
+        statement = translate_sql(sql)
+        self.sfqid = f"duckdb-{next(_query_ids)}"
+        if statement is None:
+            self._has_result = False
+            return self
+        self._cursor.execute(statement, list(params) if params else None)
+        self._has_result = True
+        return self
+
+    def _table(self) -> pa.Table:
+        if not self._has_result:
+            return pa.table({})
+        return self._cursor.to_arrow_table() if hasattr(self._cursor, 'to_arrow_table') else self._cursor.fetch_arrow_table()
+
+    def fetch_arrow_all(self, force_return_table: bool = False) -> pa.Table:
+        return self._table()
+
+    def fetch_pandas_all(self) -> pd.DataFrame:
+        return self._table().to_pandas()
+
+    def fetch_arrow_batches(self) -> Iterator[pa.Table]:
+        if not self._has_result:
+            return
+        reader = self._cursor.to_arrow_reader(BATCH_ROWS) if hasattr(self._cursor, 'to_arrow_reader') else self._cursor.fetch_record_batch(BATCH_ROWS)
+        for batch in reader:
+            yield pa.Table.from_batches([batch])
+
+    def fetch_pandas_batches(self) -> Iterator[pd.DataFrame]:
+        for table in self.fetch_arrow_batches():
+            yield table.to_pandas()
+
+    def fetchall(self) -> List[tuple]:
+        return self._cursor.fetchall() if self._has_result else []
+
+    def close(self) -> None:
+        self._cursor.close()
+
+
+class DuckDBConnection:
+    """
+    Connection with the subset of the snowflake connection used by the repository (cursor, close, is_closed),
+    on an in-memory DuckDB database where every fixture is a view.
+
+    It has no execute_async: an AsyncQueryClient runs its queries synchronously in the worker threads.
+    """
+
+    def __init__(self, fixtures_dir: str):
+        self.fixtures_dir = fixtures_dir
+        # results of the stand-in are cached apart from the Snowflake ones (see query_cache.cache_key)
+        self.warehouse = f"duckdb:{os.path.abspath(fixtures_dir)}"
+        self._conn = duckdb.connect()
+        self._closed = False
+        for macro in _MACROS:
+            self._conn.execute(macro)
+        for database, schema, table, source in list_fixtures(fixtures_dir):
+            self._conn.execute(f'ATTACH IF NOT EXISTS \':memory:\' AS "{database}"')
+            self._conn.execute(f'CREATE SCHEMA IF NOT EXISTS "{database}"."{schema}"')
+            source = source.replace("'", "''")
+            self._conn.execute(f'CREATE OR REPLACE VIEW "{database}"."{schema}"."{table}" AS SELECT * FROM read_parquet(\'{source}\', hive_partitioning=false)')
+
+    def cursor(self) -> DuckDBCursor:
+        return DuckDBCursor(self._conn.cursor())
+
+    def is_closed(self) -> bool:
+        return self._closed
+
+    def close(self) -> None:
+        if not self._closed:
+            self._conn.close()
+            self._closed = True
+
+
+def list_fixtures(fixtures_dir: str) -> List[tuple]:
+    """
+    (database, schema, table, parquet path or glob) of every fixture of fixtures_dir.
+    """
+    fixtures = []
+    for database in sorted(os.listdir(fixtures_dir)) if os.path.isdir(fixtures_dir) else []:
+        for schema in sorted(os.listdir(os.path.join(fixtures_dir, database))):
+            schema_dir = os.path.join(fixtures_dir, database, schema)
+            if not os.path.isdir(schema_dir):
+                continue
+            for name in sorted(os.listdir(schema_dir)):
+                path = os.path.join(schema_dir, name)
+                if name.endswith('.parquet'):
+                    fixtures.append((database, schema, name[:-len('.parquet')], path))
+                elif any(file.endswith('.parquet') for _, _, files in os.walk(path) for file in files):
+                    fixtures.append((database, schema, name, os.path.join(path, '**', '*.parquet')))
+    return fixtures
+
+
+def write_fixture(df: Any, table: str, fixtures_dir: str) -> str:
+    """
+    Save an extract (DataFrame or pyarrow.Table) as the fixture of table ('DATABASE.SCHEMA.TABLE').
+
+        df = sq.query_to_df("select * from MAGSNOWFLAKE.DAYZER.PROD_DA_CONSTRAINTS_MAPPED where DATE >= '2025-10-01'", conn)
+        write_fixture(df, 'MAGSNOWFLAKE.DAYZER.PROD_DA_CONSTRAINTS_MAPPED', 'fixtures')
+    """
+    database, schema, name = table.split('.')
+    path = os.path.join(fixtures_dir, database, schema, f"{name}.parquet")
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    pq.write_table(df if isinstance(df, pa.Table) else pa.Table.from_pandas(df, preserve_index=False), path)
+    return path
+
+
+def connect(fixtures_dir: str, warehouse: Optional[str] = None) -> DuckDBConnection:
+    """
+    Same role as establishconnection, the warehouse is ignored.
+    """
+    return DuckDBConnection(fixtures_dir)
@@ -0,0 +1,179 @@
+import hashlib
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Optional, Tuple
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# MAG_QUERY_CACHE=0 disables the cache, MAG_QUERY_CACHE_DIR moves the parquet tier
+ENABLED = os.environ.get('MAG_QUERY_CACHE', '1') != '0'
+CACHE_DIR = os.environ.get('MAG_QUERY_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'postmortem', 'queries'))
+MEMORY_BUDGET_BYTES = 1 * 1024**3
+DISK_BUDGET_BYTES = 10 * 1024**3
+TTL_SECONDS = 12 * 3600
+
+# string literals are kept as is, any other run of whitespace becomes a single space
+_TOKENS = re.compile(r"'(?:[^']|'')*'|\s+")
+
+
+def normalize_sql(statements) -> str:
+    """
+    Normalized text of a script (list of (statement, bind values), see prepare_statements):
+    whitespace collapsed outside of string literals, statements joined with ';', bind values appended.
+    """
+    normalized = []
+    for statement, params in statements:
+        text = _TOKENS.sub(lambda m: m.group(0) if m.group(0).startswith("'") else ' ', statement)
+        text = text.strip().rstrip(';').strip()
+        normalized.append(f"{text} -- {params!r}" if params else text)
+    return ';\n'.join(normalized)
+
+
+def cache_key(statements, warehouse: Optional[str], result_format: str, schema: Optional[dict] = None) -> str:
+    text = f"{warehouse}\n{result_format}\n{sorted((schema or {}).items())}\n{normalize_sql(statements)}"
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+def result_nbytes(result: Any) -> int:
+    if isinstance(result, pa.Table):
+        return result.nbytes
+    return int(result.memory_usage(deep=True, index=True).sum())
+
+
+def arrow_dtype(arrow_type: pa.DataType) -> Any:
+    """
+    types_mapper of the 'arrow_pandas' format: pd.ArrowDtype columns, except the dictionary
+    columns of a query schema ('category') which become pandas Categorical columns.
+    """
+    return None if pa.types.is_dictionary(arrow_type) else pd.ArrowDtype(arrow_type)
+
+
+def _copy(result: Any) -> Any:
+    # callers modify the frames in place (fillna, formatting): never hand out the cached object
+    return result if isinstance(result, pa.Table) else result.copy()
+
+
+class QueryCache:
+    """
+    Two-tier cache of query results.
+
+    - memory: LRU bounded by memory_budget bytes
+    - disk: one parquet file per result in cache_dir, bounded by disk_budget bytes (oldest files removed first)
+    Both tiers expire entries after ttl seconds.
+    """
+
+    def __init__(self,
+                 cache_dir: str = CACHE_DIR,
+                 memory_budget: int = MEMORY_BUDGET_BYTES,
+                 disk_budget: int = DISK_BUDGET_BYTES,
+                 ttl: float = TTL_SECONDS):
+        self.cache_dir = cache_dir
+        self.memory_budget = memory_budget
+        self.disk_budget = disk_budget
+        self.ttl = ttl
+        self._memory: "OrderedDict[str, Tuple[Any, int, float]]" = OrderedDict()  # key -> (result, nbytes, created)
+        self._memory_bytes = 0
+        self._lock = threading.Lock()
+
+    def _path(self, key: str, result_format: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.{result_format}.parquet")
+
+    def _put_memory(self, key: str, result: Any, created: float) -> None:
+        nbytes = result_nbytes(result)
+        if nbytes > self.memory_budget:
+            return
+        with self._lock:
+            if key in self._memory:
+                self._memory_bytes -= self._memory.pop(key)[1]
+            self._memory[key] = (result, nbytes, created)
+            self._memory_bytes += nbytes
+            while self._memory_bytes > self.memory_budget:
+                _, (_, evicted_bytes, _) = self._memory.popitem(last=False)
+                self._memory_bytes -= evicted_bytes
+
+    def get(self, key: str, result_format: str) -> Optional[Any]:
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                if now - entry[2] <= self.ttl:
+                    self._memory.move_to_end(key)
+                    return _copy(entry[0])
+                self._memory_bytes -= self._memory.pop(key)[1]
+
+        path = self._path(key, result_format)
+        try:
+            created = os.path.getmtime(path)
+        except FileNotFoundError:
+            return None
+        if now - created > self.ttl:
+            self._remove(path)
+            return None
+        try:
+            table = pq.read_table(path)
+        except Exception:
+            self._remove(path)  # partial or corrupted file
+            return None
+        result = table if result_format == 'arrow' else (
+            table.to_pandas(types_mapper=arrow_dtype) if result_format == 'arrow_pandas' else table.to_pandas())
+        self._put_memory(key, result, created)
+        return _copy(result)
+
+    def put(self, key: str, result_format: str, result: Any) -> None:
+        created = time.time()
+        self._put_memory(key, _copy(result), created)
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            table = result if isinstance(result, pa.Table) else pa.Table.from_pandas(result, preserve_index=False)
+            path = self._path(key, result_format)
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            pq.write_table(table, tmp_path)
+            os.replace(tmp_path, path)
+        except (OSError, pa.ArrowException):
+            return  # the disk tier is best effort, the memory tier still has the result
+        self.evict_disk()
+
+    def _remove(self, path: str) -> None:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def evict_disk(self) -> None:
+        """
+        Remove expired files, then the oldest ones until the directory fits in disk_budget.
+        """
+        try:
+            entries = [e for e in os.scandir(self.cache_dir) if e.name.endswith('.parquet')]
+        except FileNotFoundError:
+            return
+        now = time.time()
+        files = []
+        for entry in entries:
+            stat = entry.stat()
+            if now - stat.st_mtime > self.ttl:
+                self._remove(entry.path)
+            else:
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.disk_budget:
+                break
+            self._remove(path)
+            total -= size
+
+    def clear(self, disk: bool = True) -> None:
+        with self._lock:
+            self._memory.clear()
+            self._memory_bytes = 0
+        if disk and os.path.isdir(self.cache_dir):
+            for entry in os.scandir(self.cache_dir):
+                if entry.name.endswith('.parquet'):
+                    self._remove(entry.path)
+
+
+RESULT_CACHE = QueryCache()
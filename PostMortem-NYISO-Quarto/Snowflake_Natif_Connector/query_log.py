@@ -0,0 +1,148 @@
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional
+import pandas as pd
+
+# MAG_QUERY_LOG=0 disables the log, MAG_QUERY_LOG_PATH moves the JSONL file ('' keeps the records in memory only)
+ENABLED = os.environ.get('MAG_QUERY_LOG', '1') != '0'
+LOG_PATH = os.environ.get('MAG_QUERY_LOG_PATH', os.path.join(os.path.expanduser('~'), '.cache', 'postmortem', 'query_log.jsonl'))
+
+# frames skipped when looking for the function that asked for the query
+_PLUMBING_MODULES = ('Snowflake_Natif_Connector.', 'services.async_queries', 'services.reference_data', 'services.history_store',
+                     'services.warehouse_routing')
+_PLUMBING_FUNCTIONS = ('query_to_df', 'query_to_batches', 'stream_query')
+# function of the queries run in a worker thread for another one, see called_from
+_CALLER = threading.local()
+
+
+def calling_function() -> str:
+    """
+    Name of the first function up the stack outside of the connector plumbing (e.g. 'get_flows').
+    Nested functions count as their enclosing function, private helpers (_name) are skipped.
+    """
+    if getattr(_CALLER, 'function', None) is not None:
+        return _CALLER.function
+    frame = sys._getframe(1)
+    while frame is not None:
+        module = frame.f_globals.get('__name__', '')
+        name = getattr(frame.f_code, 'co_qualname', frame.f_code.co_name).split('.<locals>')[0]
+        if not (module.startswith(_PLUMBING_MODULES) or name in _PLUMBING_FUNCTIONS or name.startswith('_')
+                or (name.startswith('<') and name != '<module>')):
+            return name if name != '<module>' else module
+        frame = frame.f_back
+    return '?'
+
+
+@contextmanager
+def called_from(function: str) -> Iterator[None]:
+    """
+    The queries run by this thread in the block are logged as asked by function
+    (the worker threads of services.async_queries run them for the function that submitted them).
+    """
+    previous = getattr(_CALLER, 'function', None)
+    _CALLER.function = function
+    try:
+        yield
+    finally:
+        _CALLER.function = previous
+
+
+class QueryLog:
+    """
+    Log of the queries run by executeQueryNatif / iterQueryNatif.
+
+    Every record has the calling function, the bind values, the execute time (compilation + execution,
+    until the first result is available), the fetch time, the number of rows, the in-memory size of the
+    result and the Snowflake query id. Records are kept in memory for summary() and appended to
+    a JSONL file, one line per query.
+    """
+
+    def __init__(self, path: Optional[str] = LOG_PATH):
+        self.path = path
+        self.records: List[Dict[str, Any]] = []
+        self._lock = threading.Lock()
+
+    def record(self,
+               function: str,
+               statements,
+               warehouse: Optional[str],
+               result_format: str,
+               execute_s: float,
+               fetch_s: float,
+               rows: int,
+               nbytes: int,
+               query_id: Optional[str],
+               cached: bool = False) -> Dict[str, Any]:
+        entry = {
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'function': function,
+            'params': [value for _, values in statements for value in values],
+            'nb_statements': len(statements),
+            'warehouse': warehouse,
+            'result_format': result_format,
+            'cached': cached,
+            'execute_s': round(execute_s, 4),
+            'fetch_s': round(fetch_s, 4),
+            'rows': rows,
+            'bytes': nbytes,
+            'query_id': query_id,
+        }
+        with self._lock:
+            self.records.append(entry)
+            if self.path:
+                try:
+                    os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+                    with open(self.path, 'a') as f:
+                        f.write(json.dumps(entry, default=str) + '\n')
+                except OSError:
+                    pass  # the log must never break a render
+        return entry
+
+    def to_frame(self) -> pd.DataFrame:
+        with self._lock:
+            return pd.DataFrame(self.records)
+
+    def summary(self) -> pd.DataFrame:
+        """
+        One row per calling function, sorted by total time (execute + fetch).
+        """
+        df = self.to_frame()
+        if df.empty:
+            return df
+        df['total_s'] = df['execute_s'] + df['fetch_s']
+        summary = df.groupby('function').agg(
+            calls=('function', 'size'),
+            cached=('cached', 'sum'),
+            execute_s=('execute_s', 'sum'),
+            fetch_s=('fetch_s', 'sum'),
+            total_s=('total_s', 'sum'),
+            rows=('rows', 'sum'),
+            mb=('bytes', lambda b: round(b.sum() / 1024**2, 2)),
+        )
+        return summary.sort_values('total_s', ascending=False)
+
+    def print_summary(self) -> None:
+        """
+        Print the summary, meant for the last cell of a qmd render.
+        """
+        summary = self.summary()
+        print('No query logged' if summary.empty else summary.to_string(float_format=lambda x: f"{x:.2f}"))
+
+    def clear(self) -> None:
+        with self._lock:
+            self.records.clear()
+
+
+QUERY_LOG = QueryLog()
+
+
+def log_query(statements, conn: Any, result_format: str, execute_s: float, fetch_s: float,
+              query_id: Optional[str], rows: int, nbytes: int, cached: bool = False) -> None:
+    if not ENABLED:
+        return
+    QUERY_LOG.record(calling_function(), statements, getattr(conn, 'warehouse', None), result_format,
+                     execute_s, fetch_s, rows, nbytes, query_id, cached)
@@ -1,9 +1,17 @@
 import pandas as pd
-from typing import List, Tuple, Any
+import pyarrow as pa
+import pyarrow.compute as pc
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import List, Tuple, Any, Callable, ContextManager, Dict, Optional
 from services import snowflake_queries as sq
+from services.database_connection import pooled_connection
 from components import graph_utils as gu
 from itables import show
 
+# Max number of queries get_cdd_data runs at the same time (1 = sequential on the given connection)
+CDD_MAX_WORKERS = 4
+
 def df_to_cid_ces_and_package_str(df_cid_ces_packid:pd.DataFrame):
     cid_ces_str=','.join(map(str, df_cid_ces_packid['MIN_CID_CES'].unique().tolist()))
     packid_str=','.join(map(str, df_cid_ces_packid['MAG_REF_PACKAGEVERSION__ID'].unique().tolist()))
@@ -13,6 +21,120 @@ def df_to_scenario_id(df_scenario_id:pd.DataFrame):
     scenario_id=','.join(map(str, df_scenario_id['MAG_REF_SCENARIO_INFO__ID'].unique().tolist()))
     return scenario_id
 
+def connection_factory_of(_conn: Any) -> Optional[Callable[[], ContextManager[Any]]]:
+    """
+    Connections equivalent to _conn for the concurrent queries of run_queries: the pool of its warehouse
+    for a Snowflake connection (the connection of a WarehouseRouter), the factory of an AsyncQueryClient,
+    None for a connection that cannot be pooled (DuckDB stand-in or mirror...).
+    """
+    if hasattr(_conn,'submit_query'):  # AsyncQueryClient
+        return _conn.connection_factory
+    if hasattr(_conn,'routed_connection'):  # WarehouseRouter, the concurrent queries run on its own warehouse
+        _conn=_conn.conn
+    if not type(_conn).__module__.startswith('snowflake'):
+        return None
+    return partial(pooled_connection,getattr(_conn,'warehouse',None) or 'LARGE_COMPUTE_WAREHOUSE')
+
+def run_queries(queries: Dict[str, Tuple[Callable, tuple]]
+                ,_conn: Any
+                ,result_format: str='pandas'
+                ,max_workers: int=CDD_MAX_WORKERS
+                ,connection_factory: Optional[Callable[[], ContextManager[Any]]]=None) -> Dict[str, Any]:
+    """
+    Run independent queries {name: (sq function, args without the connection)} and return {name: result}.
+    They run concurrently on max_workers threads, each one on its own connection from connection_factory
+    (connection_factory_of(_conn) by default), or sequentially on _conn when max_workers<=1, with a single
+    query or when _conn cannot be pooled.
+    """
+    if connection_factory is None:
+        connection_factory=connection_factory_of(_conn)
+    if max_workers<=1 or len(queries)<=1 or connection_factory is None:
+        return {name:func(*args,_conn,result_format) for name,(func,args) in queries.items()}
+
+    def run_on_own_connection(func,args):
+        with connection_factory() as conn:
+            return func(*args,conn,result_format)
+
+    with ThreadPoolExecutor(max_workers=min(max_workers,len(queries))) as executor:
+        futures={name:executor.submit(run_on_own_connection,func,args) for name,(func,args) in queries.items()}
+        return {name:future.result() for name,future in futures.items()}
+
+def split_by_constraint(result: Any, cid_mags: List[int], column: str='MAG_CID') -> Dict[int, Any]:
+    """
+    Split the result of a batch query (DataFrame or pyarrow.Table) into {cid_mag: result of this constraint},
+    constraints without any row get an empty result.
+    """
+    if isinstance(result, pa.Table):
+        return {cid: result.filter(pc.equal(result[column], cid)) for cid in cid_mags}
+    groups=dict(tuple(result.groupby(column, sort=False)))
+    return {cid: groups[cid].reset_index(drop=True) if cid in groups else result.iloc[0:0] for cid in cid_mags}
+
+def prefetch_cstr_data(pool_id: int
+                       ,cid_mags: List[int]
+                       ,scenario: List[str]
+                       ,scenario_sf: List[str]
+                       ,mindate: str
+                       ,maxdate: str
+                       ,_conn: Any
+                       ,result_format: str='pandas'
+                       ,max_workers: int=CDD_MAX_WORKERS
+                       ,connection_factory: Optional[Callable[[], ContextManager[Any]]]=None
+                       ,scenario_histo_sp: Optional[List[str]]=None) -> Dict[str, Dict[int, Any]]:
+    """
+    Fetch the data of all the constraints of a report at once: one scan of the hourly flows,
+    categories and daily outages instead of one per constraint. Returns
+    {'flows': {cid_mag: df}, 'catego': {cid_mag: df}, 'outages': {cid_mag: df}}, to pass as
+    `prefetched` to get_all_cstr_data / get_cdd_data (same scenarios and dates as get_cdd_data).
+    With scenario_histo_sp, the historical shadow prices of every constraint are fetched in the
+    same run_queries and returned as 'histo_SP'.
+    """
+    cid_mags=list(cid_mags)
+    df_cid_ces_package_str=sq.get_cid_ces_packageid_from_cid_mag(pool_id,cid_mags,_conn)
+    scenario_id=df_to_scenario_id(sq.get_scenario_id(scenario,_conn))
+    scenario_id_sf=df_to_scenario_id(sq.get_scenario_id(scenario_sf,_conn))
+    cid_ces_str,packid_str=df_to_cid_ces_and_package_str(df_cid_ces_package_str)
+
+    queries={
+        'flows':(sq.get_flows,(cid_mags,pool_id,cid_ces_str,packid_str,scenario_id,mindate,maxdate)),
+        'catego':(sq.get_catego,(cid_mags,cid_ces_str,packid_str,pool_id,scenario_id_sf,mindate,maxdate)),
+        'outages':(sq.get_outages,(cid_mags,pool_id,scenario_sf,mindate,maxdate)),
+    }
+    if scenario_histo_sp is not None:
+        # one get_historical_SP per constraint, they share the history of the pool (see sq.get_historical_SP)
+        scenario_id_sp=df_to_scenario_id(sq.get_scenario_id(scenario_histo_sp,_conn))
+        queries.update({('histo_SP',cid):(sq.get_historical_SP,(pool_id,cid,scenario_id_sp)) for cid in cid_mags})
+    results=run_queries(queries,_conn,result_format,max_workers,connection_factory)
+    prefetched={name:split_by_constraint(results[name],cid_mags) for name in ('flows','catego','outages')}
+    if scenario_histo_sp is not None:
+        prefetched['histo_SP']={cid:results[('histo_SP',cid)] for cid in cid_mags}
+    return prefetched
+
+def prefetch_key(pool_id: int
+                 ,scenario: List[str]
+                 ,scenario_sf: List[str]
+                 ,scenario_histo_sp: List[str]
+                 ,mindate: str
+                 ,maxdate: str
+                 ,result_format: str='pandas') -> tuple:
+    """
+    Dataset of get_cdd_data: the constraints called with the same key can be prefetched together.
+    """
+    return (pool_id,tuple(scenario),tuple(scenario_sf),tuple(scenario_histo_sp),str(mindate),str(maxdate),result_format)
+
+# Data prefetched for a whole report (see components.report_planner), read by get_cdd_data when it gets no `prefetched`
+_PREFETCHED: Dict[tuple, Dict[str, Dict[int, Any]]] = {}
+
+def register_prefetched(key: tuple, prefetched: Dict[str, Dict[int, Any]]) -> None:
+    """
+    Make the prefetched data of a dataset (prefetch_key) available to the get_cdd_data calls with the same parameters.
+    """
+    data=_PREFETCHED.setdefault(key,{})
+    for name,by_constraint in prefetched.items():
+        data.setdefault(name,{}).update(by_constraint)
+
+def clear_prefetched() -> None:
+    _PREFETCHED.clear()
+
 def get_cdd_data (cid_mag: int
                   ,pool_id: int
                   ,scenario: List[str]
@@ -20,10 +142,29 @@ def get_cdd_data (cid_mag: int
                   ,scenario_histo_sp:List[str]
                   ,mindate: str
                   ,maxdate: str
-                  ,_conn: any) -> Tuple[pd.DataFrame,pd.DataFrame,pd.DataFrame]:
+                  ,_conn: any
+                  ,result_format: str='pandas'
+                  ,max_workers: int=CDD_MAX_WORKERS
+                  ,connection_factory: Optional[Callable[[], ContextManager[Any]]]=None
+                  ,prefetched: Optional[Dict[str, Dict[int, Any]]]=None) -> Tuple[pd.DataFrame,pd.DataFrame,pd.DataFrame]:
     """
     Get flows, categories and outages data
+    result_format is forwarded to the queries ('pandas', 'arrow' or 'arrow_pandas'),
+    the graph_utils functions accept all of them.
+
+    Once the scenario ids and ces ids are resolved, the four data queries are independent:
+    they run concurrently on max_workers threads, each one on its own connection from
+    connection_factory (the pool of the warehouse of _conn by default), see run_queries. max_workers=1
+    keeps the sequential behaviour on _conn.
+    Data already fetched for this constraint in `prefetched` (see prefetch_cstr_data), or registered
+    for these parameters (see register_prefetched), is not queried again.
     """
+    if prefetched is None:
+        prefetched=_PREFETCHED.get(prefetch_key(pool_id,scenario,scenario_sf,scenario_histo_sp,mindate,maxdate,result_format),{})
+    results={name:prefetched[name][cid_mag] for name in ('histo_SP','flows','catego','outages') if cid_mag in prefetched.get(name,{})}
+    if len(results)==4:
+        return(results['flows'],results['catego'],results['outages'],results['histo_SP'])
+
     df_cid_ces_package_str=sq.get_cid_ces_packageid_from_cid_mag(pool_id,cid_mag,_conn)
 
     df_scenario_id=sq.get_scenario_id(scenario,_conn)
@@ -36,37 +177,18 @@ def get_cdd_data (cid_mag: int
 
     cid_ces_str,packid_str=df_to_cid_ces_and_package_str(df_cid_ces_package_str)
 
-    df_histo_SP=sq.get_historical_SP(pool_id
-                                     ,cid_mag
-                                     ,scenario_id_sp
-                                     ,_conn) 
+    queries={
+        'histo_SP':(sq.get_historical_SP,(pool_id,cid_mag,scenario_id_sp)),
+        'flows':(sq.get_flows,(cid_mag,pool_id,cid_ces_str,packid_str,scenario_id,mindate,maxdate)),
+        'catego':(sq.get_catego,(cid_mag,cid_ces_str,packid_str,pool_id,scenario_id_sf,mindate,maxdate)),
+        'outages':(sq.get_outages,(cid_mag,pool_id,scenario_sf,mindate,maxdate)),
+    }
 
-    df_flows=sq.get_flows(cid_mag
-                        ,pool_id
-                        ,cid_ces_str
-                        ,packid_str
-                        ,scenario_id
-                        ,mindate
-                        ,maxdate
-                        ,_conn)
+    queries={name:query for name,query in queries.items() if name not in results}
 
-    df_catego=sq.get_catego(cid_mag
-                        ,cid_ces_str
-                        ,packid_str
-                        ,pool_id
-                        ,scenario_id_sf
-                        ,mindate
-                        ,maxdate
-                        ,_conn)
+    results.update(run_queries(queries,_conn,result_format,max_workers,connection_factory))
 
-    df_outages=sq.get_outages(cid_mag
-                        ,pool_id
-                        ,scenario_sf
-                        ,mindate
-                        ,maxdate
-                        ,_conn)
-    
-    return(df_flows,df_catego,df_outages,df_histo_SP)
+    return(results['flows'],results['catego'],results['outages'],results['histo_SP'])
 
 def table_nb_hour_bind(pool_id: int,cid_mag: int,mindate: str,maxdate: str,_conn: any):
     df_nb_hour_bind=sq.get_nb_hour_bind(pool_id
@@ -97,10 +219,15 @@ def get_all_cstr_data(pool_id: int,
                       scenario_first_priority:str,
                       scenario_sf:List[str],
                       scenario_histo_sp:List[str],
-                      _conn: Any
+                      _conn: Any,
+                      result_format: str='pandas',
+                      max_workers: int=CDD_MAX_WORKERS,
+                      prefetched: Optional[Dict[str, Dict[int, Any]]]=None
                       ):
     """
     On function to create all the necessary graph for the PM
+    prefetched: output of prefetch_cstr_data for all the constraints of the report, by default
+    the data registered by report_planner.prefetch_report for these parameters
     """
     table_nb_hour_bind(pool_id
                         ,cid_mag
@@ -115,7 +242,10 @@ def get_all_cstr_data(pool_id: int,
                         ,scenario_histo_sp
                         ,histostartdate
                         ,histoenddate
-                        ,_conn)
+                        ,_conn
+                        ,result_format
+                        ,max_workers
+                        ,prefetched=prefetched)
     
     gu.shadowprice_monthly_fig(df_histo_SP,
                           cid_mag,
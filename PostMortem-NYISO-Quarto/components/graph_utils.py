@@ -1,18 +1,30 @@
 import pandas as pd
+import pyarrow as pa
 import plotly.graph_objects as go
 import numpy as np
 import difflib
 from typing import Union,List,Any,Optional
 from plotly.subplots import make_subplots
 from utils.constants import COLOR_PALETTE,COLOR_MAP
+from Snowflake_Natif_Connector.conn_python_snowflake import arrow_to_pandas
 
 pd.set_option('future.no_silent_downcasting', True)
 
-def create_graph_load(df_Load: pd.DataFrame,LoadZone: str,startrange: str, endrange: str) -> None:
+def as_frame(df: Union[pd.DataFrame, pa.Table]) -> pd.DataFrame:
+    """
+    Accept the results of every fetch mode of executeQueryNatif.
+    A pyarrow.Table is wrapped in an ArrowDtype DataFrame (zero copy), DataFrames are returned as is.
+    """
+    if isinstance(df, pa.Table):
+        return arrow_to_pandas(df)
+    return df
+
+def create_graph_load(df_Load: Union[pd.DataFrame, pa.Table],LoadZone: str,startrange: str, endrange: str) -> None:
     """
     Create a load graph based a Df and which loadZone you want to see
     """
     fig=go.Figure()
+    df_Load=as_frame(df_Load)
     df_Load_zone=df_Load[df_Load['ZONENAME'] == LoadZone] #TOTAL ,SOUTH ERCOT, NORTH ERCOT, WEST ERCOT
 
     for scenario in sorted(df_Load_zone['SCENARIONAME'].unique()):
@@ -35,11 +47,12 @@ def create_graph_load(df_Load: pd.DataFrame,LoadZone: str,startrange: str, endra
     )
     fig.show()
 
-def create_graph_wind(df_Wind: pd.DataFrame,startrange: str, endrange: str):
+def create_graph_wind(df_Wind: Union[pd.DataFrame, pa.Table],startrange: str, endrange: str):
     """
     Create a wind graph based on Df
     """
     fig=go.Figure()
+    df_Wind=as_frame(df_Wind)
     for scenario in sorted(df_Wind['SCENARIONAME'].unique()):
         df_filtered = df_Wind[df_Wind['SCENARIONAME'] == scenario]
         fig.add_trace(go.Scatter(x=df_filtered['HEDATE'],
@@ -63,9 +76,9 @@ def create_graph_wind(df_Wind: pd.DataFrame,startrange: str, endrange: str):
 
 
 def hourly_figure(
-    df_flows: pd.DataFrame,
-    df_categories: pd.DataFrame,
-    df_outages: pd.DataFrame,
+    df_flows: Union[pd.DataFrame, pa.Table],
+    df_categories: Union[pd.DataFrame, pa.Table],
+    df_outages: Union[pd.DataFrame, pa.Table],
     Scenario_first_priority: str,
     startdate: Any,
     enddate: Any,
@@ -73,6 +86,10 @@ def hourly_figure(
     """
     Creates the hourly figure showing flows, categories, and outages.
     """
+    df_flows=as_frame(df_flows)
+    df_categories=as_frame(df_categories)
+    df_outages=as_frame(df_outages)
+
     fig = make_subplots(
         rows=3, cols=1,
         specs=[[{"secondary_y": True}], [{}], [{}]],
@@ -618,7 +635,7 @@ def update_fig(fig: go.Figure,startdate:str,enddate:str) -> None:
 #             ), row=2, col=1
 #         )
 
-def shadowprice_monthly_fig(df_histoSP: pd.DataFrame,cid_mag:int):
+def shadowprice_monthly_fig(df_histoSP: Union[pd.DataFrame, pa.Table],cid_mag:int):
     """
     Trace monthly shadowprice
 
@@ -630,6 +647,7 @@ def shadowprice_monthly_fig(df_histoSP: pd.DataFrame,cid_mag:int):
         None
     """
     fig=go.Figure()
+    df_histoSP=as_frame(df_histoSP)
 
     df_histoSP_only_constraint=df_histoSP[df_histoSP['MAG_CID']==cid_mag].copy()
     create_graph_for_constraint(fig,df_histoSP_only_constraint,'Main Constraint')
@@ -0,0 +1,184 @@
+import ast
+import inspect
+import re
+from typing import Any, Dict, List, Optional
+import pandas as pd
+from services import market_prices as mp
+from components import constraint_utils as cu
+
+# Prefetch of a post-mortem report before its sections run. The python cells of the .qmd are read
+# (not executed): every cu.get_all_cstr_data(...) call whose arguments can be worked out from the
+# literals and the assignments of the cells above it is planned, then the calls sharing the same
+# scenarios and dates are fetched at once. The first cell of the report only needs:
+#
+#     from components import report_planner as rp
+#     rp.prefetch_report('PostMortem_Octobre2025.qmd', conn)
+#
+# A call that cannot be planned (argument computed at render time) runs its own queries as before.
+_CELLS = re.compile(r"^```\{python[^}]*\}[^\n]*\n(.*?)^```", re.M | re.S)
+# ipython magics and shell escapes are not python
+_MAGICS = re.compile(r"^\s*[%!].*$", re.M)
+_UNRESOLVED = object()
+_CALLED = 'get_all_cstr_data'
+# arguments of get_all_cstr_data that are not part of the data
+_NOT_PLANNED = ('_conn', 'max_workers', 'prefetched')
+
+
+def python_cells(qmd_text: str) -> List[str]:
+    """
+    Code of the python cells of a .qmd, in order.
+    """
+    return [_MAGICS.sub('', cell) for cell in _CELLS.findall(qmd_text)]
+
+
+def _evaluate(node: ast.AST, names: Dict[str, Any]) -> Any:
+    # value of a literal expression (constants, lists, f-strings, indexing, + of known names...), _UNRESOLVED otherwise
+    if isinstance(node, ast.Constant):
+        return node.value
+    if isinstance(node, ast.Name):
+        return names.get(node.id, _UNRESOLVED)
+    if isinstance(node, (ast.List, ast.Tuple)):
+        values = [_evaluate(element, names) for element in node.elts]
+        if any(value is _UNRESOLVED for value in values):
+            return _UNRESOLVED
+        return values if isinstance(node, ast.List) else tuple(values)
+    if isinstance(node, ast.JoinedStr):
+        parts = [_evaluate(value, names) for value in node.values]
+        return _UNRESOLVED if any(part is _UNRESOLVED for part in parts) else ''.join(parts)
+    if isinstance(node, ast.FormattedValue):
+        value = _evaluate(node.value, names)
+        spec = _evaluate(node.format_spec, names) if node.format_spec is not None else ''
+        if value is _UNRESOLVED or spec is _UNRESOLVED:
+            return _UNRESOLVED
+        value = {-1: value, ord('s'): str(value), ord('r'): repr(value), ord('a'): ascii(value)}[node.conversion]
+        return format(value, spec)
+    if isinstance(node, ast.Subscript):
+        value, index = _evaluate(node.value, names), _evaluate(node.slice, names)
+        if value is _UNRESOLVED or index is _UNRESOLVED:
+            return _UNRESOLVED
+        try:
+            return value[index]
+        except (TypeError, IndexError, KeyError):
+            return _UNRESOLVED
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.USub):
+        value = _evaluate(node.operand, names)
+        return _UNRESOLVED if value is _UNRESOLVED else -value
+    if isinstance(node, ast.BinOp) and isinstance(node.op, ast.Add):
+        left, right = _evaluate(node.left, names), _evaluate(node.right, names)
+        if left is _UNRESOLVED or right is _UNRESOLVED:
+            return _UNRESOLVED
+        try:
+            return left + right
+        except TypeError:
+            return _UNRESOLVED
+    return _UNRESOLVED
+
+
+def _stored_names(node: ast.AST) -> List[str]:
+    return [n.id for n in ast.walk(node) if isinstance(n, ast.Name) and isinstance(n.ctx, ast.Store)]
+
+
+def _is_planned_call(node: ast.AST) -> bool:
+    if not isinstance(node, ast.Call):
+        return False
+    func = node.func
+    return (isinstance(func, ast.Attribute) and func.attr == _CALLED) or (isinstance(func, ast.Name) and func.id == _CALLED)
+
+
+def _bind(call: ast.Call, names: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    # arguments of a get_all_cstr_data call by parameter name, None if one of the data arguments is unknown
+    if any(isinstance(arg, ast.Starred) for arg in call.args) or any(keyword.arg is None for keyword in call.keywords):
+        return None
+    args = [_evaluate(arg, names) for arg in call.args]
+    kwargs = {keyword.arg: _evaluate(keyword.value, names) for keyword in call.keywords}
+    try:
+        bound = inspect.signature(cu.get_all_cstr_data).bind(*args, **kwargs)
+    except TypeError:
+        return None
+    bound.apply_defaults()
+    arguments = {name: value for name, value in bound.arguments.items() if name not in _NOT_PLANNED}
+    if any(value is _UNRESOLVED for value in arguments.values()):
+        return None
+    return arguments
+
+
+def _scan(statements: List[ast.stmt], names: Dict[str, Any], calls: List[Dict[str, Any]]) -> None:
+    # statements in order: the planned calls see the names assigned before them
+    for statement in statements:
+        if isinstance(statement, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            names.pop(statement.name, None)
+            continue
+        if isinstance(statement, ast.For) and isinstance(statement.target, ast.Name):
+            values = _evaluate(statement.iter, names)
+            if isinstance(values, (list, tuple)):
+                # a loop over a literal list: one call per item
+                for value in values:
+                    _scan(statement.body, dict(names, **{statement.target.id: value}), calls)
+                for name in _stored_names(statement):
+                    names.pop(name, None)
+                continue
+        for node in ast.walk(statement):
+            if _is_planned_call(node):
+                arguments = _bind(node, names)
+                if arguments is not None:
+                    calls.append(arguments)
+        if isinstance(statement, ast.Assign):
+            value = _evaluate(statement.value, names)
+            for target in statement.targets:
+                if isinstance(target, ast.Name) and value is not _UNRESOLVED:
+                    names[target.id] = value
+                else:
+                    for name in _stored_names(target):
+                        names.pop(name, None)
+        else:
+            for name in _stored_names(statement):
+                names.pop(name, None)
+
+
+def plan_report(qmd_path: str) -> List[Dict[str, Any]]:
+    """
+    Arguments (by parameter name, without _conn, max_workers and prefetched) of every
+    get_all_cstr_data call of the report that can be worked out without running it, in order.
+    """
+    with open(qmd_path, encoding='utf-8') as f:
+        cells = python_cells(f.read())
+    names: Dict[str, Any] = {}
+    calls: List[Dict[str, Any]] = []
+    for cell in cells:
+        try:
+            tree = ast.parse(cell)
+        except SyntaxError:
+            continue
+        _scan(tree.body, names, calls)
+    return calls
+
+
+def prefetch_report(qmd_path: str, _conn: Any, max_workers: int = cu.CDD_MAX_WORKERS) -> Dict[tuple, List[int]]:
+    """
+    Fetch the data of every planned get_all_cstr_data call of the report, returns the constraints
+    prefetched for each dataset (cu.prefetch_key).
+
+    The calls are grouped by dataset: one cu.prefetch_cstr_data per distinct pool, scenarios and
+    history dates, registered for get_cdd_data (cu.register_prefetched), and one download of the
+    market shadow prices per pool covering all the ftr windows, read by get_nb_hour_bind.
+    """
+    datasets: Dict[tuple, List[int]] = {}
+    windows: Dict[int, tuple] = {}
+    for call in plan_report(qmd_path):
+        key = cu.prefetch_key(call['pool_id'], call['scenario_flows'], call['scenario_sf'], call['scenario_histo_sp'],
+                              call['histostartdate'], call['histoenddate'], call['result_format'])
+        cid_mags = datasets.setdefault(key, [])
+        if call['cid_mag'] not in cid_mags:
+            cid_mags.append(call['cid_mag'])
+        start, end = pd.Timestamp(call['ftrstartdate']), pd.Timestamp(call['ftrenddate'])
+        mindate, maxdate = windows.get(call['pool_id'], (start, end))
+        windows[call['pool_id']] = (min(mindate, start), max(maxdate, end))
+
+    for pool_id, (mindate, maxdate) in windows.items():
+        mp.market_prices(pool_id, f"{mindate:%Y-%m-%d}", f"{maxdate:%Y-%m-%d}", _conn)
+    for key, cid_mags in datasets.items():
+        pool_id, scenario, scenario_sf, scenario_histo_sp, mindate, maxdate, result_format = key
+        prefetched = cu.prefetch_cstr_data(pool_id, cid_mags, list(scenario), list(scenario_sf), mindate, maxdate, _conn,
+                                           result_format, max_workers, scenario_histo_sp=list(scenario_histo_sp))
+        cu.register_prefetched(key, prefetched)
+    return datasets
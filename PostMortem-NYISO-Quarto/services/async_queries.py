@@ -0,0 +1,184 @@
+import asyncio
+import itertools
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import nullcontext
+from typing import Any, Callable, ContextManager, Dict, List, Optional
+import pandas as pd
+from Snowflake_Natif_Connector import conn_python_snowflake as ntf
+from Snowflake_Natif_Connector import query_cache, query_log
+from services.database_connection import pooled_connection
+
+_local_ids = itertools.count(1)
+
+
+class QueryFuture:
+    """
+    Handle on a query submitted with AsyncQueryClient.
+
+    Can be awaited (df = await fut) or waited synchronously (df = fut.result()).
+    query_id is the Snowflake query id once the query has been submitted
+    ('local-<n>' on a backend without execute_async).
+    """
+
+    def __init__(self):
+        self._future: Optional[Future] = None
+        self.query_id: Optional[str] = None
+        self.submitted = threading.Event()
+
+    def done(self) -> bool:
+        return self._future.done()
+
+    def result(self, timeout: Optional[float] = None) -> pd.DataFrame:
+        return self._future.result(timeout)
+
+    def then(self, func: Callable[[Any], Any]) -> 'QueryFuture':
+        """
+        Future of func(result), func runs in the worker thread as soon as the query is collected.
+        """
+        chained = QueryFuture()
+        chained._future = Future()
+        chained.submitted = self.submitted
+
+        def _chain(done: Future) -> None:
+            chained.query_id = self.query_id
+            try:
+                chained._future.set_result(func(done.result()))
+            except Exception as e:
+                chained._future.set_exception(e)
+
+        self._future.add_done_callback(_chain)
+        return chained
+
+    def __await__(self):
+        return asyncio.wrap_future(self._future).__await__()
+
+    def __repr__(self) -> str:
+        state = 'done' if self.done() else 'pending'
+        return f"QueryFuture(query_id={self.query_id!r}, {state})"
+
+
+class AsyncQueryClient:
+    """
+    Submit queries without blocking, so independent report sections overlap their warehouse time.
+
+    Pass the client instead of the connection to any function of services.snowflake_queries,
+    it returns a QueryFuture instead of the DataFrame:
+
+        client = AsyncQueryClient(conn)
+        f_load = sq.get_Load(scenarios, '2020-01-01', end_date, client)
+        f_pm = sq.get_PostMortem(1, start_date, end_date, scenarios_pm, client)
+        df_Load, df_PM = await client.gather(f_load, f_pm)
+
+    Single statement queries are submitted on the shared connection with execute_async.
+    Scripts with setup statements (SET variables, temporary tables) are session scoped, so they
+    run on their own connection from connection_factory (the warehouse pool by default) to avoid
+    two scripts replacing each other's temporary tables.
+    A backend without execute_async (local stand-in) runs the query synchronously in the worker thread.
+    As with executeQueryNatif, the query cache is looked up before submitting and the result is
+    logged (under the function that submitted it) and cached once collected.
+    """
+
+    def __init__(self,
+                 conn: Any,
+                 max_workers: int = 4,
+                 poll_interval: float = 0.5,
+                 connection_factory: Optional[Callable[[], ContextManager[Any]]] = None):
+        self.conn = conn
+        self.poll_interval = poll_interval
+        self.connection_factory = connection_factory or pooled_connection
+        self.futures: Dict[str, QueryFuture] = {}
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='sf_async')
+        self._lock = threading.Lock()
+
+    def _register(self, fut: QueryFuture, query_id: str) -> None:
+        fut.query_id = query_id
+        with self._lock:
+            self.futures[query_id] = fut
+        fut.submitted.set()
+
+    def _run(self, fut: QueryFuture, statements: List[Any], result_format: str, schema: Optional[Dict[str, str]],
+             key: Optional[str], function: str) -> Any:
+        context = self.connection_factory() if len(statements) > 1 else nullcontext(self.conn)
+        try:
+            with query_log.called_from(function), context as conn:
+                if not hasattr(conn, 'get_query_status_throw_if_error'):
+                    self._register(fut, f"local-{next(_local_ids)}")
+                    result = ntf.executeQueryNatif(statements, conn, result_format, False, schema)
+                else:
+                    started = time.perf_counter()
+                    self._register(fut, ntf.submitQueryNatif(statements, conn))
+                    while ntf.queryIsRunningNatif(fut.query_id, conn):
+                        time.sleep(self.poll_interval)
+                    executed = time.perf_counter()
+                    result = ntf.collectQueryNatif(fut.query_id, conn, result_format, schema)
+                    query_log.log_query(statements, conn, result_format, executed - started, time.perf_counter() - executed,
+                                        fut.query_id, len(result), query_cache.result_nbytes(result))
+            if key is not None:
+                query_cache.RESULT_CACHE.put(key, result_format, result)
+            return result
+        finally:
+            fut.submitted.set()
+
+    def submit_query(self, query_data: Any, result_format: str = 'pandas', schema: Optional[Dict[str, str]] = None,
+                     use_cache: bool = True) -> QueryFuture:
+        """
+        Submit a query (or a script) and return immediately with its QueryFuture.
+        A result found in the query cache is returned as a future already done, nothing is submitted.
+        """
+        statements = ntf.prepare_statements(query_data)
+        function = query_log.calling_function()
+        fut = QueryFuture()
+        key = None
+        if use_cache and query_cache.ENABLED:
+            key = query_cache.cache_key(statements, getattr(self.conn, 'warehouse', None), result_format, schema)
+            started = time.perf_counter()
+            cached = query_cache.RESULT_CACHE.get(key, result_format)
+            if cached is not None:
+                query_log.log_query(statements, self.conn, result_format, 0.0, time.perf_counter() - started,
+                                    None, len(cached), query_cache.result_nbytes(cached), cached=True)
+                fut._future = Future()
+                fut._future.set_result(cached)
+                self._register(fut, f"local-{next(_local_ids)}")
+                return fut
+        fut._future = self._executor.submit(self._run, fut, statements, result_format, schema, key, function)
+        return fut
+
+    def submit_call(self, func: Callable[[Any], Any]) -> QueryFuture:
+        """
+        Run func(conn) in a worker thread on a connection of connection_factory and return its QueryFuture,
+        for the functions combining queries with local data (see services.history_store).
+        """
+        fut = QueryFuture()
+        function = query_log.calling_function()
+
+        def _call() -> Any:
+            self._register(fut, f"local-{next(_local_ids)}")
+            with query_log.called_from(function), self.connection_factory() as conn:
+                return func(conn)
+
+        fut._future = self._executor.submit(_call)
+        return fut
+
+    def get(self, query_id: str) -> QueryFuture:
+        """
+        Future of a submitted query from its query id.
+        """
+        with self._lock:
+            return self.futures[query_id]
+
+    async def gather(self, *futures: QueryFuture) -> List[pd.DataFrame]:
+        """
+        Await several futures, results come back in the same order.
+        """
+        return list(await asyncio.gather(*futures))
+
+    def close(self, wait: bool = True) -> None:
+        self._executor.shutdown(wait=wait)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
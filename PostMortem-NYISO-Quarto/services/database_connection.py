@@ -1,12 +1,260 @@
 from Snowflake_Natif_Connector import conn_python_snowflake as ntf
-from typing import Any
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+from contextlib import contextmanager
+import atexit
+import os
+import threading
+import time
 
+DATABASE = "MAGSNOWFLAKE"
+SCHEMA = "DAYZER"
 
-def init_connection(warehouse: str='LARGE_COMPUTE_WAREHOUSE') -> Any:
+# MAG_QUERY_BACKEND=duckdb runs every query on the local DuckDB stand-in loaded with the fixtures
+# of MAG_DUCKDB_FIXTURES (see Snowflake_Natif_Connector.duckdb_backend) instead of Snowflake
+BACKEND = os.environ.get('MAG_QUERY_BACKEND', 'snowflake')
+DUCKDB_FIXTURES = os.environ.get('MAG_DUCKDB_FIXTURES', 'fixtures')
+# MAG_WAREHOUSE_ROUTING=1 runs the small lookups of init_connection on the small warehouse (see
+# services.warehouse_routing), opt-in: the warehouse must exist and be granted to the user
+ROUTING = os.environ.get('MAG_WAREHOUSE_ROUTING', '0') == '1'
+
+# Max number of open connections per warehouse, warehouses not listed use DEFAULT_POOL_SIZE
+# LARGE: the shared init_connection session + the 4 concurrent queries of constraint_utils.get_cdd_data
+POOL_SIZES: Dict[str, int] = {'LARGE_COMPUTE_WAREHOUSE': 5}
+DEFAULT_POOL_SIZE = 2
+# Idle connections older than this are closed (seconds)
+IDLE_TIMEOUT = 15 * 60
+# Idle connections older than this are pinged with SELECT 1 before being handed out (seconds)
+HEALTH_CHECK_AFTER = 60
+
+
+class ConnectionPool:
+    """
+    Pool of Snowflake connections for one warehouse.
+
+    Connections are opened lazily up to `size`, handed out exclusively with `connection()`
+    and put back warm for the next caller, so the key-pair handshake is paid once per session
+    instead of once per call. Idle connections are health checked before reuse and evicted
+    after `idle_timeout` seconds.
+    """
+
+    def __init__(self,
+                 warehouse: str,
+                 size: int = DEFAULT_POOL_SIZE,
+                 idle_timeout: float = IDLE_TIMEOUT,
+                 health_check_after: float = HEALTH_CHECK_AFTER,
+                 connect: Optional[Callable[[str], Any]] = None):
+        if size < 1:
+            raise ValueError(f"Pool size must be >= 1, got {size}")
+        self.warehouse = warehouse
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.health_check_after = health_check_after
+        self._connect = connect or connect_backend
+        self._idle: List[Tuple[Any, float]] = []  # (connection, last time it was released)
+        self._nb_open = 0
+        self._closed = False
+        self._cond = threading.Condition()
+
+    def _is_healthy(self, conn: Any, idle_for: float) -> bool:
+        if conn.is_closed():
+            return False
+        if idle_for < self.health_check_after:
+            return True
+        try:
+            cursor = conn.cursor()
+            try:
+                cursor.execute("SELECT 1")
+            finally:
+                cursor.close()
+            return True
+        except Exception:
+            return False
+
+    def _discard(self, conn: Any) -> None:
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def evict_idle(self) -> int:
+        """
+        Close the idle connections unused for more than idle_timeout, returns how many were closed.
+        """
+        now = time.monotonic()
+        with self._cond:
+            expired = [conn for conn, released in self._idle if now - released > self.idle_timeout]
+            self._idle = [(conn, released) for conn, released in self._idle if now - released <= self.idle_timeout]
+            self._nb_open -= len(expired)
+            self._cond.notify_all()
+        for conn in expired:
+            self._discard(conn)
+        return len(expired)
+
+    def acquire(self, timeout: Optional[float] = None) -> Any:
+        """
+        Check out a connection, waiting up to timeout seconds (None: forever) if the pool is exhausted.
+        """
+        self.evict_idle()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self._cond:
+                if self._closed:
+                    raise RuntimeError(f"Connection pool for {self.warehouse} is closed")
+                if self._idle:
+                    conn, released = self._idle.pop()  # most recently used first, the warmest session
+                elif self._nb_open < self.size:
+                    self._nb_open += 1
+                    conn, released = None, None
+                else:
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        raise TimeoutError(f"No connection available on {self.warehouse} after {timeout}s")
+                    self._cond.wait(remaining)
+                    continue
+
+            if conn is None:
+                try:
+                    return self._connect(self.warehouse)
+                except Exception:
+                    with self._cond:
+                        self._nb_open -= 1
+                        self._cond.notify()
+                    raise
+            if self._is_healthy(conn, time.monotonic() - released):
+                return conn
+            # dead session: drop it and try again
+            self._discard(conn)
+            with self._cond:
+                self._nb_open -= 1
+                self._cond.notify()
+
+    def release(self, conn: Any, discard: bool = False) -> None:
+        """
+        Give a connection back to the pool, or close it if discard is True (or the pool is closed).
+        """
+        with self._cond:
+            if discard or self._closed or conn.is_closed():
+                self._nb_open -= 1
+                keep = False
+            else:
+                self._idle.append((conn, time.monotonic()))
+                keep = True
+            self._cond.notify()
+        if not keep:
+            self._discard(conn)
+
+    @contextmanager
+    def connection(self, timeout: Optional[float] = None) -> Iterator[Any]:
+        """
+        with pool.connection() as conn: ...
+        The connection is discarded instead of reused if the block raises a connector error.
+        """
+        conn = self.acquire(timeout)
+        try:
+            yield conn
+        except Exception as e:
+            self.release(conn, discard=type(e).__module__.startswith('snowflake'))
+            raise
+        else:
+            self.release(conn)
+
+    def close(self) -> None:
+        """
+        Close all the idle connections and refuse new checkouts.
+        """
+        with self._cond:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            self._nb_open -= len(idle)
+            self._cond.notify_all()
+        for conn, _ in idle:
+            self._discard(conn)
+
+
+def connect_backend(warehouse: str) -> Any:
+    """
+    New connection of the configured backend (BACKEND): Snowflake, or the DuckDB stand-in.
+    """
+    if BACKEND == 'duckdb':
+        from Snowflake_Natif_Connector import duckdb_backend  # optional dependency, only needed for the stand-in
+        return duckdb_backend.connect(DUCKDB_FIXTURES, warehouse)
+    if BACKEND != 'snowflake':
+        raise ValueError(f"MAG_QUERY_BACKEND must be 'snowflake' or 'duckdb', got {BACKEND!r}")
+    return ntf.establishconnection(warehouse, DATABASE, SCHEMA)
+
+
+_POOLS: Dict[str, ConnectionPool] = {}
+_SHARED: Dict[str, Any] = {}
+_POOLS_LOCK = threading.Lock()
+_SHARED_LOCK = threading.Lock()
+
+
+def get_pool(warehouse: str = 'LARGE_COMPUTE_WAREHOUSE') -> ConnectionPool:
+    """
+    Return the process-wide pool of a warehouse, creating it with POOL_SIZES on first use.
+    """
+    with _POOLS_LOCK:
+        if warehouse not in _POOLS:
+            _POOLS[warehouse] = ConnectionPool(warehouse, POOL_SIZES.get(warehouse, DEFAULT_POOL_SIZE))
+        return _POOLS[warehouse]
+
+
+@contextmanager
+def pooled_connection(warehouse: str = 'LARGE_COMPUTE_WAREHOUSE', timeout: Optional[float] = None) -> Iterator[Any]:
+    """
+    Exclusive checkout of a warm connection for threads or jobs running queries in parallel.
+
+        with pooled_connection() as conn:
+            df = sq.get_flows(..., conn)
+    """
+    with get_pool(warehouse).connection(timeout) as conn:
+        yield conn
+
+
+def _shared_connection(warehouse: str) -> Any:
+    pool = get_pool(warehouse)
+    with _SHARED_LOCK:
+        conn = _SHARED.get(warehouse)
+        if conn is not None and not conn.is_closed():
+            return conn
+        if conn is not None:
+            pool.release(conn, discard=True)
+        conn = pool.acquire()
+        _SHARED[warehouse] = conn
+        return conn
+
+
+def init_connection(warehouse: str='LARGE_COMPUTE_WAREHOUSE', routing: bool=ROUTING) -> Any:
     """
     Establishes a connection to the Snowflake database.
+    The connection is taken from the warehouse pool and shared: calling init_connection again
+    (another notebook cell, another report in the same kernel) returns the same warm session
+    as long as it is healthy.
+
+    With routing, the connection is wrapped in a WarehouseRouter: the small lookups run on a
+    pooled connection of the small warehouse, the other queries on this one.
 
     Returns:
         Connection object: A connection to the specified Snowflake database.
     """
-    return ntf.establishconnection(warehouse, "MAGSNOWFLAKE", "DAYZER")
\ No newline at end of file
+    conn = _shared_connection(warehouse)
+    if not routing:
+        return conn
+    from services.warehouse_routing import WAREHOUSES, WarehouseRouter  # imports this module
+    return WarehouseRouter(conn, dict(WAREHOUSES, large=warehouse))
+
+
+def close_all_connections() -> None:
+    """
+    Close the shared connections and every pool, called automatically at exit.
+    """
+    with _SHARED_LOCK, _POOLS_LOCK:
+        for warehouse, conn in _SHARED.items():
+            _POOLS[warehouse].release(conn, discard=True)
+        for pool in _POOLS.values():
+            pool.close()
+        _SHARED.clear()
+        _POOLS.clear()
+
+
+atexit.register(close_all_connections)
@@ -0,0 +1,308 @@
+import json
+import os
+import re
+import shutil
+import threading
+from datetime import date
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# Local copy of the history queried by every monthly report (historical shadow prices, hourly
+# load and wind, ...). Past data never changes: it is stored once and only the data after the
+# watermark / high-water mark of the store is queried again.
+HISTORY_DIR = os.environ.get('MAG_HISTORY_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'postmortem', 'history'))
+# since of the first download of a history, before any data
+HISTORY_START = '2000-01-01'
+# complete months before the current one downloaded again at every refresh of a monthly history:
+# a month keeps changing after its end (late RT prices, scenarios run again)
+REFETCHED_MONTHS = 1
+# the append-only hourly stores are rewritten in a single file above this number of parts
+MAX_PARTS = 24
+
+_MANIFEST = '_manifest.json'
+_UNSAFE = re.compile(r'[^\w.=-]+')
+_LOCK = threading.RLock()
+
+
+def _safe(part: Any) -> str:
+    return _UNSAFE.sub('_', str(part))
+
+
+def store_path(*parts: Any) -> str:
+    """
+    Directory of a history under HISTORY_DIR, one level per part ('pool=1', 'line=...'),
+    characters not allowed in a file name are replaced by '_'.
+    """
+    return os.path.join(HISTORY_DIR, *(_safe(part) for part in parts))
+
+
+def _read_manifest(path: str) -> Dict[str, Any]:
+    try:
+        with open(os.path.join(path, _MANIFEST)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_manifest(path: str, manifest: Dict[str, Any]) -> None:
+    tmp_path = os.path.join(path, f"{_MANIFEST}.{os.getpid()}.{threading.get_ident()}.tmp")
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, os.path.join(path, _MANIFEST))
+
+
+def _write_table(path: str, df: pd.DataFrame) -> None:
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    pq.write_table(pa.Table.from_pandas(df, preserve_index=False), tmp_path)
+    os.replace(tmp_path, path)
+
+
+def _read_tables(paths: List[str]) -> List[pd.DataFrame]:
+    return [pq.read_table(path, partitioning=None).to_pandas() for path in sorted(paths)]
+
+
+def _day(value: Any) -> str:
+    return pd.Timestamp(value).date().isoformat()
+
+
+def _month_files(path: str) -> Dict[str, str]:
+    # 'YYYY-MM' -> file
+    try:
+        names = os.listdir(path)
+    except FileNotFoundError:
+        return {}
+    return {name[len('month='):-len('.parquet')]: os.path.join(path, name)
+            for name in names if name.startswith('month=') and name.endswith('.parquet')}
+
+
+def _watermark() -> str:
+    return (pd.Timestamp(date.today().replace(day=1)) - pd.DateOffset(months=REFETCHED_MONTHS)).date().isoformat()
+
+
+def _store_months(path: str, since: str, fetched: pd.DataFrame, month_column: str) -> pd.DataFrame:
+    # the fetched rows replace the stored months >= since, returns all the rows of the store
+    files = _month_files(path)
+    months = pd.to_datetime(fetched[month_column]).dt.strftime('%Y-%m') if len(fetched) else pd.Series(dtype=str)
+    os.makedirs(path, exist_ok=True)
+    for month, file in list(files.items()):
+        if month >= since[:7]:
+            os.remove(file)
+            del files[month]
+    for month, rows in fetched.groupby(months.to_numpy(), sort=True) if len(fetched) else []:
+        files[month] = os.path.join(path, f"month={month}.parquet")
+        _write_table(files[month], rows.reset_index(drop=True))
+
+    _write_manifest(path, {'watermark': _watermark()})
+    frames = [df for df in _read_tables(list(files.values())) if not df.empty]
+    if not frames:
+        return fetched.iloc[0:0]
+    return pd.concat(frames, ignore_index=True)
+
+
+def monthly_history(path: str,
+                    fetch: Callable[[str], pd.DataFrame],
+                    month_column: str) -> pd.DataFrame:
+    """
+    Rows of a history stored in path, one parquet file per month of month_column.
+
+    The manifest keeps a watermark, the first month that may not have been final at the last download.
+    fetch(since) is called with the watermark ('YYYY-MM-DD', HISTORY_START for a new store) and
+    must return the rows of that month and of the following ones: they replace the stored months
+    >= watermark, the older months are read locally. The new watermark is the current month minus
+    REFETCHED_MONTHS: the month just ended is downloaded again until the next one is over.
+    """
+    with _LOCK:
+        since = _read_manifest(path).get('watermark', HISTORY_START)
+        return _store_months(path, since, fetch(since), month_column)
+
+
+def monthly_histories(paths: Dict[str, str],
+                      fetch: Callable[[str, List[str]], pd.DataFrame],
+                      key_column: str,
+                      month_column: str) -> Dict[str, pd.DataFrame]:
+    """
+    Same as monthly_history for several stores filled by the same query, one per key (a monitored line...).
+
+    The stores are grouped by watermark: fetch(since, keys) is called once per distinct watermark with
+    the keys of its stores and must return their rows (key_column) from since. A key without a store
+    is fetched from HISTORY_START with the other new keys only, the existing stores are not downloaded again.
+    """
+    with _LOCK:
+        by_since: Dict[str, List[str]] = {}
+        for key, path in paths.items():
+            by_since.setdefault(_read_manifest(path).get('watermark', HISTORY_START), []).append(key)
+        result = {}
+        for since, keys in sorted(by_since.items()):
+            fetched = fetch(since, keys)
+            for key in keys:
+                rows = fetched[fetched[key_column] == key] if len(fetched) else fetched
+                result[key] = _store_months(paths[key], since, rows.reset_index(drop=True), month_column)
+    return {key: result[key] for key in paths}
+
+
+def _part_files(path: str) -> List[str]:
+    # part=<since>.parquet, sorted by since
+    try:
+        names = os.listdir(path)
+    except FileNotFoundError:
+        return []
+    return sorted(os.path.join(path, name) for name in names if name.startswith('part=') and name.endswith('.parquet'))
+
+
+def _dates(batch: pa.RecordBatch, date_column: str) -> pd.Series:
+    return pd.to_datetime(batch.column(date_column).to_pandas())
+
+
+def _iter_parts(path: str, date_column: str) -> Iterator[pa.RecordBatch]:
+    # a part holds the rows from its since: the rows of a day fetched again are taken from the newest part.
+    # The parts are read batch by batch, a store is never loaded in memory at once
+    files = _part_files(path)
+    for file, next_file in zip(files, files[1:] + [None]):
+        until = None if next_file is None else pd.Timestamp(os.path.basename(next_file)[len('part='):-len('.parquet')])
+        for batch in pq.ParquetFile(file).iter_batches():
+            yield batch if until is None else batch.filter(pa.array((_dates(batch, date_column) < until).to_numpy()))
+
+
+class _PartWriter:
+    # a parquet file written batch by batch, visible under path only once closed
+    def __init__(self, path: str):
+        self.path = path
+        self.tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        self.writer = None
+
+    def write(self, table: pa.Table) -> None:
+        if self.writer is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self.writer = pq.ParquetWriter(self.tmp_path, table.schema)
+        self.writer.write_table(table.cast(self.writer.schema))
+
+    def close(self) -> None:
+        if self.writer is not None:
+            self.writer.close()
+            os.replace(self.tmp_path, self.path)
+
+    def discard(self) -> None:
+        if self.writer is not None:
+            self.writer.close()
+            os.remove(self.tmp_path)
+
+
+def _compact(path: str, date_column: str) -> None:
+    files = _part_files(path)
+    if len(files) <= MAX_PARTS:
+        return
+    writer = _PartWriter(files[0])
+    try:
+        for batch in _iter_parts(path, date_column):
+            writer.write(pa.Table.from_batches([batch]))
+    except BaseException:
+        writer.discard()
+        raise
+    writer.close()
+    for file in files[1:]:
+        os.remove(file)
+
+
+def _append(path: str,
+            marks: List[List[str]],
+            batches: Iterable[Any],
+            date_column: str) -> Dict[str, str]:
+    # the fetched batches are split by scenario and written as they arrive in a new part of each scenario,
+    # returns the last date fetched of each scenario
+    writers = {scenario: _PartWriter(os.path.join(path, _safe(f"scenario={scenario}"), f"part={since}.parquet"))
+               for scenario, since in marks}
+    last_dates: Dict[str, pd.Timestamp] = {}
+    try:
+        for batch in batches:
+            table = pa.Table.from_pandas(batch, preserve_index=False) if isinstance(batch, pd.DataFrame) else batch
+            if table.num_rows == 0:
+                continue
+            scenarios = table.column('SCENARIONAME').to_pandas()
+            for scenario, writer in writers.items():
+                mask = (scenarios == scenario).to_numpy()
+                if not mask.any():
+                    continue
+                rows = table.filter(pa.array(mask))
+                writer.write(rows)
+                last_date = pd.to_datetime(rows.column(date_column).to_pandas()).max()
+                last_dates[scenario] = max(last_dates.get(scenario, last_date), last_date)
+    except BaseException:
+        for writer in writers.values():
+            writer.discard()
+        raise
+    for writer in writers.values():
+        writer.close()
+    return {scenario: _day(last_date) for scenario, last_date in last_dates.items()}
+
+
+def hourly_history(path: str,
+                   scenarios: List[str],
+                   start_date: str,
+                   end_date: str,
+                   fetch: Callable[[List[List[str]]], Iterable[Any]],
+                   date_column: str = 'DATE',
+                   chunk_func: Optional[Callable[[pd.DataFrame], pd.DataFrame]] = None) -> pd.DataFrame:
+    """
+    Rows between start_date and end_date (date_column) of each scenario, stored in path/scenario=<name>.
+
+    The store of a scenario is append-only: the manifest keeps its start and its high-water mark
+    (the last date stored). The day of the high-water mark may have been stored before it was complete,
+    so the scenarios whose high-water mark is not after end_date are queried again from that day,
+    with a single call fetch([[scenario, since], ...]) that must return the rows (SCENARIONAME column)
+    from since to end_date as an iterable of batches (pyarrow.Table or DataFrame, see ntf.iterQueryNatif):
+    they are appended batch by batch as a new part that replaces the stored rows from since.
+    A start_date before the stored start reloads the scenario.
+
+    The parts are read batch by batch and chunk_func is applied on each batch (as in stream_query),
+    so with a reducing chunk_func the memory is bounded by the batch size and not by the history.
+    """
+    start_date, end_date = _day(start_date), _day(end_date)
+    with _LOCK:
+        manifests = {}
+        marks = []
+        for scenario in scenarios:
+            scenario_path = os.path.join(path, _safe(f"scenario={scenario}"))
+            manifest = _read_manifest(scenario_path)
+            if manifest.get('start', start_date) > start_date:
+                shutil.rmtree(scenario_path, ignore_errors=True)
+                manifest = {}
+            manifest.setdefault('start', start_date)
+            manifests[scenario] = manifest
+            high_water_mark = manifest.get('high_water_mark')
+            if high_water_mark is None or high_water_mark <= end_date:
+                marks.append([scenario, high_water_mark or manifest['start']])
+
+        if marks:
+            last_dates = _append(path, marks, fetch(marks), date_column)
+            for scenario, since in marks:
+                scenario_path = os.path.join(path, _safe(f"scenario={scenario}"))
+                os.makedirs(scenario_path, exist_ok=True)
+                if scenario in last_dates:
+                    manifests[scenario]['high_water_mark'] = last_dates[scenario]
+                    _compact(scenario_path, date_column)
+                _write_manifest(scenario_path, manifests[scenario])
+
+        frames = []
+        schema = None
+        for scenario in scenarios:
+            for batch in _iter_parts(os.path.join(path, _safe(f"scenario={scenario}")), date_column):
+                schema = schema or batch.schema
+                dates = _dates(batch, date_column)
+                batch = batch.filter(pa.array(((dates >= pd.Timestamp(start_date)) & (dates <= pd.Timestamp(end_date))).to_numpy()))
+                if batch.num_rows:
+                    df = batch.to_pandas()
+                    frames.append(chunk_func(df) if chunk_func is not None else df)
+    frames = [df for df in frames if not df.empty]
+    if not frames:
+        return schema.empty_table().to_pandas() if schema is not None and chunk_func is None else pd.DataFrame()
+    return pd.concat(frames, ignore_index=True)
+
+
+def clear_history(*parts: Any) -> None:
+    """
+    Delete a stored history (store_path(*parts)), or all of them without parts: the next call downloads it again.
+    """
+    with _LOCK:
+        shutil.rmtree(store_path(*parts) if parts else HISTORY_DIR, ignore_errors=True)
@@ -0,0 +1,234 @@
+import os
+import threading
+import time
+from typing import Any, Dict, List, Optional
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+from Snowflake_Natif_Connector import conn_python_snowflake as ntf
+from services import query_templates as qt
+
+# Hourly DA / RT market shadow prices of a report. They are downloaded once for the pool and the
+# report window and read locally by get_flows, get_nb_hour_bind and get_PostMortem, instead of a
+# SELECT DISTINCT scan of PROD_DA/RT_CONSTRAINTS_MAPPED in every query and for every constraint.
+# Only the columns of those SELECT DISTINCT are kept, the RT table has no ces nor package version.
+MARKET_COLUMNS = ['MAG_REF_POOL__ID', 'PEAKID', 'POOLNAME', 'DATE', 'HE', 'CID_MAG', 'CID_CES',
+                  'MAG_REF_PACKAGEVERSION__ID', 'CONSTRAINTNAME', 'FACILITYNAME', 'CONTINGENCYNAME', 'SP']
+# rows of a binding hour in get_nb_hour_bind, of a constraint in get_PostMortem
+_BINDING_COLUMNS = ['MAG_REF_POOL__ID', 'PEAKID', 'POOLNAME', 'DATE', 'HE', 'CID_MAG',
+                    'CONSTRAINTNAME', 'FACILITYNAME', 'CONTINGENCYNAME', 'SP']
+_POST_MORTEM_KEYS = ['CID_MAG', 'CID_CES', 'CONSTRAINTNAME', 'FACILITYNAME', 'CONTINGENCYNAME']
+
+MARKET_PRICES_QUERY = qt.register('market_shadow_prices', """
+    select distinct
+        'DA' AS MARKET
+        ,MAG_REF_POOL__ID,PEAKID,POOLNAME,DATE,HE,CID_MAG,CID_CES,MAG_REF_PACKAGEVERSION__ID
+        ,CONSTRAINTNAME,FACILITYNAME,CONTINGENCYNAME
+        ,SHADOWPRICE AS SP
+    from
+        MAGSNOWFLAKE.DAYZER.PROD_DA_CONSTRAINTS_MAPPED
+    where
+        MAG_REF_POOL__ID=:pool_id
+        -- one day of margin on each side for the hourly joins on DATEADD(HOUR,HE,DATE)
+        AND DATE BETWEEN DATEADD(DAY,-1,DATE(:mindate)) AND DATEADD(DAY,1,DATE(:maxdate))
+
+    UNION ALL
+
+    select distinct
+        'RT' AS MARKET
+        ,MAG_REF_POOL__ID,PEAKID,POOLNAME,DATE,HE,CID_MAG,NULL AS CID_CES,NULL AS MAG_REF_PACKAGEVERSION__ID
+        ,CONSTRAINTNAME,FACILITYNAME,CONTINGENCYNAME
+        ,SP_RT AS SP
+    from
+        MAGSNOWFLAKE.DAYZER.PROD_RT_CONSTRAINTS_MAPPED
+    where
+        MAG_REF_POOL__ID=:pool_id
+        AND DATE BETWEEN DATEADD(DAY,-1,DATE(:mindate)) AND DATEADD(DAY,1,DATE(:maxdate))
+""")
+
+PACKAGE_VERSION_QUERY = qt.register('market_package_version', """
+    SELECT
+        MAX(MAG_REF_PackageVersion__ID) AS MAG_REF_PACKAGEVERSION__ID
+    FROM
+        MAGSNOWFLAKE.DAYZER_CUBES.NODES_RESULTS_MONTHLY
+    WHERE
+        DATE = date(:month)
+        AND MAG_REF_POOL__ID=:pool_id
+""")
+
+
+def _sync_connection(_conn: Any) -> Any:
+    # the dataset is read by the queries as soon as they are built: with an AsyncQueryClient it is downloaded on its connection
+    return _conn.conn if hasattr(_conn, 'submit_query') else _conn
+
+
+def _day(value: Any) -> pd.Timestamp:
+    return pd.Timestamp(value).normalize()
+
+
+def to_int(values: pd.Series) -> pd.Series:
+    """
+    CAST(... AS INT) of Snowflake: rounded half away from zero, nulls kept (float column then).
+    """
+    values = values.astype('float64')
+    rounded = np.sign(values) * np.floor(np.abs(values) + 0.5)
+    return rounded if rounded.isna().any() else rounded.astype('int64')
+
+
+class MarketShadowPrices:
+    """
+    Deduplicated DA and RT market shadow prices of a pool between mindate and maxdate (MARKET_COLUMNS),
+    indexed by market and CID_MAG.
+    """
+
+    def __init__(self, pool_id: int, mindate: str, maxdate: str, df: pd.DataFrame):
+        self.pool_id = pool_id
+        self.mindate = _day(mindate)
+        self.maxdate = _day(maxdate)
+        self.loaded_at = time.time()
+        df = df.assign(DATE=pd.to_datetime(df['DATE']))
+        self._markets: Dict[str, pd.DataFrame] = {}
+        self._index: Dict[str, Dict[int, np.ndarray]] = {}
+        for market in ('DA', 'RT'):
+            rows = df.loc[df['MARKET'] == market, MARKET_COLUMNS].reset_index(drop=True)
+            for column in ('CID_CES', 'MAG_REF_PACKAGEVERSION__ID'):
+                # float after the UNION ALL with the NULL columns of the RT rows
+                if len(rows) and rows[column].notna().all():
+                    rows[column] = rows[column].astype('int64')
+            self._markets[market] = rows
+            self._index[market] = {int(cid): positions for cid, positions in rows.groupby('CID_MAG').indices.items()}
+
+    def covers(self, mindate: str, maxdate: str) -> bool:
+        return self.mindate <= _day(mindate) and _day(maxdate) <= self.maxdate
+
+    def rows(self,
+             market: str,
+             cid_mags: Optional[List[int]] = None,
+             mindate: Optional[str] = None,
+             maxdate: Optional[str] = None) -> pd.DataFrame:
+        """
+        Rows of a market ('DA' or 'RT'), of the given constraints and between mindate and maxdate (DATE) if given.
+        """
+        df = self._markets[market]
+        if cid_mags is not None:
+            index = self._index[market]
+            positions = [index[int(cid)] for cid in cid_mags if int(cid) in index]
+            df = df.take(np.sort(np.concatenate(positions))) if positions else df.iloc[0:0]
+        if mindate is not None:
+            df = df[(df['DATE'] >= _day(mindate)) & (df['DATE'] <= _day(maxdate))]
+        return df
+
+    def hourly(self, market: str, cid_mags: List[int]) -> pd.DataFrame:
+        """
+        Distinct (MAG_CID, HEDATE, SP) of the constraints, HEDATE = DATEADD(HOUR,HE,DATE).
+        """
+        df = self.rows(market, cid_mags).drop_duplicates(['CID_MAG', 'DATE', 'HE', 'SP'])
+        return pd.DataFrame({
+            'MAG_CID': df['CID_MAG'].astype('int64').to_numpy(),
+            'HEDATE': (df['DATE'] + pd.to_timedelta(df['HE'], unit='h')).to_numpy(),
+            'SP': df['SP'].to_numpy(),
+        })
+
+    def binding_hours(self, market: str, cid_mag: int, mindate: str, maxdate: str) -> pd.DataFrame:
+        """
+        Market row of get_nb_hour_bind: total shadow price, number of binding hours and price per hour.
+        """
+        df = self.rows(market, [cid_mag], mindate, maxdate).drop_duplicates(_BINDING_COLUMNS)
+        sp = to_int(pd.Series([df['SP'].sum(min_count=1)]))
+        nb_hour_bind = len(df)
+        sp_per_hour = 0 if nb_hour_bind == 0 else to_int(sp / nb_hour_bind).iloc[0]
+        return pd.DataFrame({
+            'SCENARIONAME': [f"SP_{market}"],
+            'SP': sp,
+            'NB_HOUR_BIND': [nb_hour_bind],
+            'SP_PER_HOUR': [sp_per_hour],
+            'MINLIMIT': [np.nan],
+            'MAXLIMIT': [np.nan],
+        })
+
+    def post_mortem(self, package_id: Optional[int], mindate: str, maxdate: str) -> pd.DataFrame:
+        """
+        DA shadow price of every constraint of the package version between mindate and maxdate (RESULT_MKT_DA of get_PostMortem).
+        """
+        df = self.rows('DA', None, mindate, maxdate)
+        df = df[df['MAG_REF_PACKAGEVERSION__ID'] == package_id] if package_id is not None else df.iloc[0:0]
+        df = df.drop_duplicates(_BINDING_COLUMNS + ['CID_CES'])
+        sp = df.groupby(_POST_MORTEM_KEYS, dropna=False, sort=False)['SP'].sum(min_count=1).reset_index()
+        sp['SP_DA'] = to_int(sp['SP'])
+        return sp[['CID_MAG', 'CID_CES', 'CONSTRAINTNAME', 'CONTINGENCYNAME', 'SP_DA']]
+
+
+# a dataset is downloaded again after MARKET_PRICES_TTL seconds (the prices of the last days are still published),
+# a dataset covered by a newer one is dropped
+MARKET_PRICES_TTL = float(os.environ.get('MAG_MARKET_PRICES_TTL', 3600))
+_DATASETS: Dict[int, List[MarketShadowPrices]] = {}
+_LOCK = threading.RLock()
+
+
+def market_prices(pool_id: int, mindate: str, maxdate: str, _conn: Any) -> MarketShadowPrices:
+    """
+    Market shadow prices of the pool covering [mindate, maxdate]: the dataset already downloaded in
+    this process (less than MARKET_PRICES_TTL seconds ago) if one covers the window, else a new one for this window.
+    """
+    with _LOCK:
+        now = time.time()
+        datasets = [dataset for dataset in _DATASETS.get(pool_id, []) if now - dataset.loaded_at <= MARKET_PRICES_TTL]
+        for dataset in datasets:
+            if dataset.covers(mindate, maxdate):
+                _DATASETS[pool_id] = datasets
+                return dataset
+        query = MARKET_PRICES_QUERY.bind(pool_id=pool_id, mindate=mindate, maxdate=maxdate)
+        dataset = MarketShadowPrices(pool_id, mindate, maxdate, ntf.executeQueryNatif(query, _sync_connection(_conn)))
+        _DATASETS[pool_id] = [old for old in datasets if not dataset.covers(old.mindate, old.maxdate)] + [dataset]
+        return dataset
+
+
+def package_version(pool_id: int, month: str, _conn: Any) -> Optional[int]:
+    """
+    Latest package version of the pool for a month (NODES_RESULTS_MONTHLY), None if there is none.
+    """
+    df = ntf.executeQueryNatif(PACKAGE_VERSION_QUERY.bind(pool_id=pool_id, month=month), _sync_connection(_conn))
+    value = df['MAG_REF_PACKAGEVERSION__ID'].iloc[0] if len(df) else None
+    return None if value is None or pd.isna(value) else int(value)
+
+
+def add_market_prices(result: Any, prices: MarketShadowPrices) -> Any:
+    """
+    Left join of an hourly result (DataFrame or pyarrow.Table with MAG_CID, HEDATE, SP_DA and SP_RT
+    columns) with the DA then the RT prices: SP_DA and SP_RT are replaced by ABS(IFNULL(price,0)).
+    The row order is kept, an hour with several distinct prices gets one row per price like the join of the query,
+    the SP_DA and SP_RT columns keep their type (the query schema is already applied).
+    """
+    is_table = isinstance(result, pa.Table)
+    cid_mags = result.column('MAG_CID').to_pandas() if is_table else result['MAG_CID']
+    hedates = result.column('HEDATE').to_pandas() if is_table else result['HEDATE']
+    matched = pd.DataFrame({
+        'MAG_CID': np.asarray(cid_mags, dtype='int64'),
+        'HEDATE': np.asarray(hedates, dtype='datetime64[ns]'),
+        '__row': np.arange(len(cid_mags)),
+    })
+    unique_cids = [int(cid) for cid in pd.unique(matched['MAG_CID'])]
+    for column, market in (('SP_DA', 'DA'), ('SP_RT', 'RT')):
+        market_rows = prices.hourly(market, unique_cids).rename(columns={'SP': column})
+        matched = matched.merge(market_rows, on=['MAG_CID', 'HEDATE'], how='left', sort=False)
+    rows = matched['__row'].to_numpy()
+
+    if is_table:
+        out = result.take(pa.array(rows))
+        for column in ('SP_DA', 'SP_RT'):
+            i = out.schema.get_field_index(column)
+            values = matched[column].astype('float64').abs().fillna(0).to_numpy()
+            out = out.set_column(i, column, pa.array(values).cast(out.schema.field(i).type))
+    else:
+        out = result.iloc[rows].reset_index(drop=True)
+        for column in ('SP_DA', 'SP_RT'):
+            out[column] = pd.array(matched[column].astype('float64').abs().fillna(0).to_numpy(), dtype=out[column].dtype)
+    return out
+
+
+def clear_market_prices() -> None:
+    """
+    Forget the datasets of this process: the next report query downloads the prices again.
+    """
+    with _LOCK:
+        _DATASETS.clear()
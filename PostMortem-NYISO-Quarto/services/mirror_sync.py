@@ -0,0 +1,197 @@
+import argparse
+import hashlib
+import json
+import os
+import threading
+import time
+from datetime import date
+from typing import Any, Dict, List, Optional
+import pandas as pd
+import pyarrow.parquet as pq
+from Snowflake_Natif_Connector import conn_python_snowflake as ntf
+from services import query_templates as qt
+
+# Local parquet mirror of the DAYZER tables read by every render, one file per pool and month:
+#   <MIRROR_DIR>/<DATABASE>/<SCHEMA>/<TABLE>/pool=<id>/month=<YYYY-MM>.parquet
+# This is the fixture layout of Snowflake_Natif_Connector.duckdb_backend: the DuckDB stand-in
+# reads the mirror as is (MAG_QUERY_BACKEND=duckdb MAG_DUCKDB_FIXTURES=<MIRROR_DIR>, or mirror_connection()).
+MIRROR_DIR = os.environ.get('MAG_MIRROR_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'postmortem', 'mirror'))
+
+_MANIFEST = '_manifest.json'
+
+# filter of the rows of a pool, and of a month ([:start, :end[) for the tables partitioned by month
+_HOURLY = "HEDATE >= DATEADD(HOUR,1,:start::TIMESTAMP) AND HEDATE < DATEADD(HOUR,1,:end::TIMESTAMP)"
+_DAILY = "DATE >= :start::DATE AND DATE < :end::DATE"
+_POOL = "MAG_REF_POOL__ID=:pool_id"
+_POOL_CES = """(CONSTRAINTMAPPING_DAYZER_REF__ID, MAG_REF_PACKAGEVERSION__ID) IN (
+        select CES_CID, MAG_REF_PACKAGEVERSION__ID
+        from MAGSQLSERVER.DAYZERSTUDY.MAG_CES_CONSTRAINTS_MAP_HISTORIC
+        where MAG_REF_POOL__ID=:pool_id)"""
+
+# table -> (pool filter or None, month filter or None for the small tables mirrored whole)
+MIRRORED_TABLES: Dict[str, tuple] = {
+    'MAGSNOWFLAKE.DAYZER_CUBES.CONSTRAINTS_RESULTS_HOURLY': (_POOL, _HOURLY),
+    'MAGSNOWFLAKE.DAYZER_CUBES.CATEGORY_RESULTS_HOURLY': (_POOL, _HOURLY),
+    'MAGSNOWFLAKE.DAYZER_CUBES.LOR_RESULTS_DAILY': (_POOL_CES, _DAILY),
+    'MAGSNOWFLAKE.DAYZER.PROD_DA_CONSTRAINTS_MAPPED': (_POOL, _DAILY),
+    'MAGSNOWFLAKE.DAYZER.PROD_RT_CONSTRAINTS_MAPPED': (_POOL, _DAILY),
+    # joined by the queries above
+    'MAGSQLSERVER.DAYZERSTUDY.MAG_CES_CONSTRAINTS_MAP_HISTORIC': (_POOL, None),
+    'MAGSNOWFLAKE.DAYZER.CONSTRAINT_SCENARIO_TO_BE_CUBED': (None, None),
+}
+
+_TEMPLATES = {
+    table: qt.register(f"mirror {table}", f"select * from {table} where "
+                                          + (' AND '.join(f for f in (pool_filter, month_filter) if f) or '1=1'))
+    for table, (pool_filter, month_filter) in MIRRORED_TABLES.items()
+}
+_LOCK = threading.Lock()
+
+
+def table_dir(table: str) -> str:
+    return os.path.join(MIRROR_DIR, *table.split('.'))
+
+
+def read_manifest(table: str) -> Dict[str, Dict[str, Any]]:
+    """
+    Partitions of a mirrored table: {'pool=1/month=2025-10.parquet': {'rows', 'bytes', 'sha256', 'synced_at', 'complete'}}.
+    """
+    try:
+        with open(os.path.join(table_dir(table), _MANIFEST)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_manifest(table: str, manifest: Dict[str, Dict[str, Any]]) -> None:
+    path = os.path.join(table_dir(table), _MANIFEST)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def checksum(path: str) -> str:
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def _months(start: str, end: str) -> List[pd.Timestamp]:
+    return list(pd.date_range(pd.Timestamp(start).replace(day=1), pd.Timestamp(end).replace(day=1), freq='MS'))
+
+
+def _download(table: str, path: str, _conn: Any, **params: Any) -> Dict[str, Any]:
+    # the partition is streamed batch by batch to a temporary file, then moved in place
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    writer = None
+    rows = 0
+    try:
+        for batch in ntf.iterQueryNatif(_TEMPLATES[table].bind(**params), _conn, 'arrow'):
+            if writer is None:
+                writer = pq.ParquetWriter(tmp_path, batch.schema)
+            writer.write_table(batch.cast(writer.schema))
+            rows += batch.num_rows
+    except BaseException:
+        if writer is not None:
+            writer.close()
+            os.remove(tmp_path)
+        raise
+    if writer is not None:
+        writer.close()
+    synced_at = time.strftime('%Y-%m-%dT%H:%M:%S')
+    if writer is None:  # no rows: no file, the schema is unknown
+        if os.path.exists(path):
+            os.remove(path)
+        return {'rows': 0, 'bytes': 0, 'sha256': None, 'synced_at': synced_at}
+    os.replace(tmp_path, path)
+    return {'rows': rows, 'bytes': os.path.getsize(path), 'sha256': checksum(path), 'synced_at': synced_at}
+
+
+def _is_valid(path: str, entry: Dict[str, Any]) -> bool:
+    if entry['sha256'] is None:
+        return not os.path.exists(path)
+    return os.path.exists(path) and checksum(path) == entry['sha256']
+
+
+def sync_table(table: str, pool_id: int, start: str, end: str, _conn: Any, force: bool = False) -> List[str]:
+    """
+    Mirror the months of [start, end] (or the whole table for the pool) of one table, returns the synced partitions.
+
+    A partition of a month before the current one is final: it is downloaded once and skipped
+    afterwards as long as its file matches the manifest checksum. The current month (and the next
+    ones) are downloaded again at every sync. force=True downloads every partition again.
+    """
+    pool_filter, month_filter = MIRRORED_TABLES[table]
+    current_month = pd.Timestamp(date.today()).replace(day=1)
+    with _LOCK:
+        manifest = read_manifest(table)
+        synced = []
+        if month_filter is None:
+            name = f"pool={pool_id}/all.parquet" if pool_filter else 'all.parquet'
+            partitions = [(name, {'pool_id': pool_id} if pool_filter else {}, False)]
+        else:
+            partitions = [(f"pool={pool_id}/month={month:%Y-%m}.parquet",
+                           {'pool_id': pool_id, 'start': f"{month:%Y-%m-%d}", 'end': f"{month + pd.offsets.MonthBegin(1):%Y-%m-%d}"},
+                           month < current_month)
+                          for month in _months(start, end)]
+        for name, params, final in partitions:
+            path = os.path.join(table_dir(table), name)
+            entry = manifest.get(name)
+            if not force and entry is not None and entry['complete'] and _is_valid(path, entry):
+                continue
+            manifest[name] = dict(_download(table, path, _conn, **params), complete=final)
+            _write_manifest(table, manifest)
+            synced.append(name)
+    return synced
+
+
+def sync_mirror(pool_id: int, start: str, end: str, _conn: Any, tables: Optional[List[str]] = None, force: bool = False) -> Dict[str, List[str]]:
+    """
+    Sync the mirror of a pool between start and end (dates, the whole months are mirrored)
+    for the given tables (all of MIRRORED_TABLES by default), returns the synced partitions of each table.
+    """
+    return {table: sync_table(table, pool_id, start, end, _conn, force) for table in (tables or MIRRORED_TABLES)}
+
+
+def verify_mirror(tables: Optional[List[str]] = None) -> Dict[str, List[str]]:
+    """
+    Partitions whose file is missing or does not match the manifest checksum, by table.
+    They are downloaded again by the next sync.
+    """
+    corrupted = {}
+    for table in tables or MIRRORED_TABLES:
+        for name, entry in read_manifest(table).items():
+            if not _is_valid(os.path.join(table_dir(table), name), entry):
+                corrupted.setdefault(table, []).append(name)
+    return corrupted
+
+
+def mirror_connection() -> Any:
+    """
+    DuckDB stand-in connection reading the mirror, to pass as _conn to the query functions.
+    """
+    from Snowflake_Natif_Connector import duckdb_backend  # optional dependency, only needed to read the mirror
+    return duckdb_backend.connect(MIRROR_DIR)
+
+
+if __name__ == '__main__':
+    # python -m services.mirror_sync --pool 1 --start 2025-01-01 --end 2025-10-31
+    from services.database_connection import init_connection
+
+    parser = argparse.ArgumentParser(description='Sync the local parquet mirror of the DAYZER tables')
+    parser.add_argument('--pool', type=int, required=True)
+    parser.add_argument('--start', required=True)
+    parser.add_argument('--end', default=date.today().isoformat())
+    parser.add_argument('--table', action='append', choices=list(MIRRORED_TABLES))
+    parser.add_argument('--force', action='store_true')
+    parser.add_argument('--verify', action='store_true', help='only check the checksums of the mirror')
+    args = parser.parse_args()
+    if args.verify:
+        print(json.dumps(verify_mirror(args.table), indent=1))
+    else:
+        for table, partitions in sync_mirror(args.pool, args.start, args.end, init_connection(), args.table, args.force).items():
+            print(f"{table}: {len(partitions)} partition(s) synced")
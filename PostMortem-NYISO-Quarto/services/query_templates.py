@@ -0,0 +1,67 @@
+import json
+import re
+from typing import Any, Dict, Iterable, List, Tuple
+from Snowflake_Natif_Connector import conn_python_snowflake as ntf
+
+# :name placeholders, outside of string literals and not part of a ::cast
+_TOKENS = re.compile(r"'(?:[^']|'')*'|(?<![:\w]):([A-Za-z_]\w*)")
+
+
+class QueryTemplate:
+    """
+    SQL script with :name placeholders, parsed and split once when it is registered.
+
+    bind() returns the statements with qmark (?) placeholders and the ordered values to bind,
+    the text sent to Snowflake is therefore identical from one call to the other and the values
+    are bound server side (see establishconnection, paramstyle='qmark').
+    """
+
+    def __init__(self, name: str, text: str):
+        self.name = name
+        self.text = text
+        self.statements: List[Tuple[str, Tuple[str, ...]]] = []
+        for statement in ntf.split_sql_queries(text):
+            names: List[str] = []
+
+            def to_qmark(match):
+                if match.group(1) is None:
+                    return match.group(0)  # string literal
+                names.append(match.group(1))
+                return '?'
+
+            self.statements.append((_TOKENS.sub(to_qmark, statement), tuple(names)))
+        self.parameters = {name for _, names in self.statements for name in names}
+
+    def bind(self, **params: Any) -> List[Tuple[str, Tuple[Any, ...]]]:
+        missing = self.parameters - params.keys()
+        if missing:
+            raise KeyError(f"{self.name}: missing parameters {sorted(missing)}")
+        return [(sql, tuple(params[name] for name in names)) for sql, names in self.statements]
+
+
+TEMPLATES: Dict[str, QueryTemplate] = {}
+
+
+def register(name: str, text: str) -> QueryTemplate:
+    """
+    Parse a template once and keep it in TEMPLATES.
+    Registering a name again (importlib.reload of the module declaring it) returns the registered
+    template when the text is unchanged, and replaces it otherwise.
+    """
+    if name not in TEMPLATES or TEMPLATES[name].text != text:
+        TEMPLATES[name] = QueryTemplate(name, text)
+    return TEMPLATES[name]
+
+
+def json_list(values: Any) -> str:
+    """
+    Bind value of a list parameter, used in the templates as
+    IN (select value::<type> from table(flatten(input=>parse_json(:param))))
+
+    Accepts a list/tuple or the comma separated strings built by constraint_utils ('1,2,3').
+    """
+    if isinstance(values, str):
+        values = [int(v) if v.strip().lstrip('-').isdigit() else v.strip() for v in values.split(',') if v.strip()]
+    elif not isinstance(values, Iterable):
+        values = [values]
+    return json.dumps([v.item() if hasattr(v, 'item') else v for v in values])
@@ -0,0 +1,351 @@
+import json
+import os
+import threading
+import time
+from typing import Any, Dict, List, Optional
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from Snowflake_Natif_Connector import conn_python_snowflake as ntf
+from services import query_templates as qt
+
+# Local copy of the slowly changing reference tables used by get_flows / get_catego / get_historical_SP.
+# Tables of a package version never change and are kept for good, the tables of a pool
+# (constraint mapping, hybrid markets) are downloaded again after REFERENCE_TTL seconds.
+REFERENCE_DIR = os.environ.get('MAG_REFERENCE_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'postmortem', 'reference'))
+REFERENCE_TTL = 24 * 3600
+
+BUS_COLUMNS = ['FROMBUSNAME', 'TOBUSNAME']
+_JOIN_KEYS = ['MAG_REF_PACKAGEVERSION__ID', 'CES_CID']
+
+HYBRID_POOLS_QUERY = qt.register('reference_hybrid_pools', """
+    select distinct
+        MAG_REF_POOLHYBRID__ID
+    from
+        MAGSNOWFLAKE.DAYZER.LINK_HYBRID_MKT
+    where
+        MAG_REF_POOL__ID=:pool_id
+""")
+
+CONSTRAINT_MAP_QUERY = qt.register('reference_constraint_map', """
+    select
+        MAG_CID
+        ,CES_CID
+        ,CES_NAME
+        ,MAG_REF_PACKAGEVERSION__ID
+        ,MAG_REF_POOL__ID
+    from
+        MAGSQLSERVER.DAYZERSTUDY.MAG_CES_CONSTRAINTS_MAP_HISTORIC
+    where
+        MAG_REF_POOL__ID=:pool_id
+""")
+
+# constraints of every line monitored in the pool, from all the pools (MONITORED_LINE of get_historical_SP)
+MONITORED_LINES_QUERY = qt.register('reference_monitored_lines', """
+    select
+        SPLIT_PART(CES_NAME,':',0) AS BRANCH
+        ,MAG_CID
+        ,MIN(CES_CID) AS MIN_CID_CES
+        ,MIN(CES_NAME) MIN_CES_NAME
+        ,CONCAT(' MAG: ',MAG_CID,' CES: ',MIN_CID_CES,' CTG: ',SPLIT_PART(MIN_CES_NAME,':',2)) AS NAME
+        ,SPLIT_PART(MIN_CES_NAME,':',2) AS CTG
+    from
+        MAGSQLSERVER.DAYZERSTUDY.MAG_CES_CONSTRAINTS_MAP_HISTORIC
+    where
+        SPLIT_PART(CES_NAME,':',0) IN (
+            select SPLIT_PART(CES_NAME,':',0)
+            from MAGSQLSERVER.DAYZERSTUDY.MAG_CES_CONSTRAINTS_MAP_HISTORIC
+            where MAG_REF_POOL__ID=:pool_id)
+    group by
+        SPLIT_PART(CES_NAME,':',0)
+        ,MAG_CID
+""")
+
+SCENARIOS_QUERY = qt.register('reference_scenarios', """
+    select distinct
+        SCENARIONAME
+        ,MAG_REF_SCENARIO_INFO__ID
+    from
+        MAGSNOWFLAKE.DAYZER.CONSTRAINT_SCENARIO_TO_BE_CUBED
+""")
+# The scenario names and ids are kept in memory only, they change whenever scenarios are cubed:
+# the map is downloaded again after SCENARIO_TTL seconds, or when a name it does not have is looked up
+SCENARIO_TTL = float(os.environ.get('MAG_SCENARIO_TTL', 900))
+
+CONSTRAINT_DETAILS_QUERY = qt.register('reference_constraint_details', """
+    select
+        MAG_REF_POOL__ID
+        ,CES_CID
+        ,MAG_REF_PACKAGEVERSION__ID
+        ,MONITOREDDAYZERELEMENTIDS
+        ,MONITOREDDAYZERELEMENTIDS_DIR
+    from
+        MAGSQLSERVER.DAYZERSTUDY.REF_DAYZER_CONSTRAINTS_DETAILS
+    where
+        MAG_REF_POOL__ID IN (select value::int from table(flatten(input=>parse_json(:pools))))
+        AND MAG_REF_PACKAGEVERSION__ID IN (select value::int from table(flatten(input=>parse_json(:packids))))
+""")
+
+TRANSMISSION_ELEMENTS_QUERY = qt.register('reference_transmission_elements', """
+    select
+        MAG_REF_POOL__ID
+        ,MAG_REF_PACKAGEVERSION__ID
+        ,DAYZERELEMENTID
+        ,FROMBUSNAME
+        ,TOBUSNAME
+    from
+        MAGSQLSERVER.DAYZERSTUDY.REF_DAYZER_TRANSMISSION_ELEMENTS_DETAILS
+    where
+        MAG_REF_POOL__ID IN (select value::int from table(flatten(input=>parse_json(:pools))))
+        AND MAG_REF_PACKAGEVERSION__ID IN (select value::int from table(flatten(input=>parse_json(:packids))))
+""")
+
+# path -> DataFrame, so a parquet file is read once per process
+_MEMORY: Dict[str, pd.DataFrame] = {}
+# pool_id -> (constraint map, monitored lines, {MAG_CID: branch}, {branch: constraints of the line}),
+# built again when one of the two tables is downloaded again
+_LINE_INDEXES: Dict[int, tuple] = {}
+# scenario map: 'df', 'names', 'loaded_at' and the unknown names already looked up since it was loaded ('unknown')
+_SCENARIOS: Dict[str, Any] = {}
+_LOCK = threading.RLock()
+
+
+def _sync_connection(_conn: Any) -> Any:
+    # reference tables are small: with an AsyncQueryClient they are downloaded on its connection, synchronously
+    return _conn.conn if hasattr(_conn, 'submit_query') else _conn
+
+
+def _download(template: qt.QueryTemplate, _conn: Any, **params: Any) -> pd.DataFrame:
+    # the reference store is the cache of these queries, no need to keep them in the result cache too
+    return ntf.executeQueryNatif(template.bind(**params), _sync_connection(_conn), use_cache=False)
+
+
+def _read(path: str, ttl: Optional[float] = None) -> Optional[pd.DataFrame]:
+    try:
+        if ttl is not None and time.time() - os.path.getmtime(path) > ttl:
+            _MEMORY.pop(path, None)
+            return None
+    except FileNotFoundError:
+        return None
+    if path not in _MEMORY:
+        try:
+            _MEMORY[path] = pq.read_table(path, partitioning=None).to_pandas()
+        except Exception:
+            return None  # partial or corrupted file: downloaded again
+    return _MEMORY[path]
+
+
+def _write(path: str, df: pd.DataFrame) -> None:
+    _MEMORY[path] = df
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        pq.write_table(pa.Table.from_pandas(df, preserve_index=False), tmp_path)
+        os.replace(tmp_path, path)
+    except (OSError, pa.ArrowException):
+        pass  # the memory copy is still there for this process
+
+
+def _pool_table(name: str, template: qt.QueryTemplate, pool_id: int, _conn: Any) -> pd.DataFrame:
+    path = os.path.join(REFERENCE_DIR, name, f"pool={pool_id}.parquet")
+    with _LOCK:
+        df = _read(path, REFERENCE_TTL)
+        if df is None:
+            df = _download(template, _conn, pool_id=pool_id)
+            _write(path, df)
+        return df
+
+
+def _package_table(name: str, template: qt.QueryTemplate, pool_id: int, packids: List[int], _conn: Any) -> pd.DataFrame:
+    """
+    Rows of pool_id (and its hybrid pools) for the given package versions, one parquet file per package
+    version: only the versions not stored yet are downloaded, in a single query.
+    """
+    paths = {packid: os.path.join(REFERENCE_DIR, name, f"pool={pool_id}", f"package={packid}.parquet") for packid in packids}
+    with _LOCK:
+        frames = {packid: _read(path) for packid, path in paths.items()}
+        missing = [packid for packid, df in frames.items() if df is None]
+        if missing:
+            downloaded = _download(template, _conn, pools=qt.json_list(pools(pool_id, _conn)), packids=qt.json_list(missing))
+            for packid in missing:
+                frames[packid] = downloaded[downloaded['MAG_REF_PACKAGEVERSION__ID'] == packid].reset_index(drop=True)
+                _write(paths[packid], frames[packid])
+    frames = [df for df in frames.values() if not df.empty]
+    return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+
+
+def _ids(values: Any) -> List[int]:
+    return [int(v) for v in json.loads(qt.json_list(values))]
+
+
+def pools(pool_id: int, _conn: Any) -> List[int]:
+    """
+    pool_id and its hybrid pools (LINK_HYBRID_MKT).
+    """
+    hybrids = _pool_table('hybrid_pools', HYBRID_POOLS_QUERY, pool_id, _conn)
+    return [pool_id] + [int(p) for p in hybrids['MAG_REF_POOLHYBRID__ID'] if int(p) != pool_id]
+
+
+def constraint_map(pool_id: int, _conn: Any) -> pd.DataFrame:
+    """
+    MAG_CES_CONSTRAINTS_MAP_HISTORIC rows of a pool (MAG_CID, CES_CID, CES_NAME, MAG_REF_PACKAGEVERSION__ID, MAG_REF_POOL__ID).
+    """
+    return _pool_table('constraint_map', CONSTRAINT_MAP_QUERY, pool_id, _conn)
+
+
+def scenario_ids(scenarios: Any, _conn: Any) -> pd.DataFrame:
+    """
+    Distinct MAG_REF_SCENARIO_INFO__ID of the scenario names (list or comma separated string),
+    from the scenario map of the process (CONSTRAINT_SCENARIO_TO_BE_CUBED).
+
+    A name missing from the map downloads it again once, in case the scenario was cubed since:
+    a name that is still missing is not downloaded again until the map expires (SCENARIO_TTL).
+    """
+    names = {str(name) for name in json.loads(qt.json_list(scenarios))}
+    with _LOCK:
+        expired = not _SCENARIOS or time.time() - _SCENARIOS['loaded_at'] > SCENARIO_TTL
+        if expired or not names <= _SCENARIOS['names'] | _SCENARIOS['unknown']:
+            df = _download(SCENARIOS_QUERY, _conn)
+            _SCENARIOS.update(df=df, names=set(df['SCENARIONAME'].astype(str)), loaded_at=time.time(), unknown=set())
+        _SCENARIOS['unknown'] |= names - _SCENARIOS['names']
+        df = _SCENARIOS['df']
+    ids = df.loc[df['SCENARIONAME'].astype(str).isin(names), ['MAG_REF_SCENARIO_INFO__ID']]
+    return ids.drop_duplicates().reset_index(drop=True)
+
+
+def _line_index(pool_id: int, _conn: Any) -> tuple:
+    constraints = constraint_map(pool_id, _conn)
+    lines = _pool_table('monitored_lines', MONITORED_LINES_QUERY, pool_id, _conn)
+    with _LOCK:
+        index = _LINE_INDEXES.get(pool_id)
+        if index is None or index[0] is not constraints or index[1] is not lines:
+            first = constraints.drop_duplicates('MAG_CID')
+            by_cid = {int(cid): str(name).split(':')[0] for cid, name in zip(first['MAG_CID'], first['CES_NAME'])}
+            by_line = {str(branch): rows.reset_index(drop=True) for branch, rows in lines.groupby('BRANCH', sort=False)}
+            index = _LINE_INDEXES[pool_id] = (constraints, lines, by_cid, by_line)
+        return index
+
+
+def monitored_line(pool_id: int, cid_mag: int, _conn: Any) -> str:
+    """
+    Branch monitored by a constraint: the part of its CES_NAME before the first ':' (SPLIT_PART(CES_NAME,':',0)).
+    """
+    by_cid = _line_index(pool_id, _conn)[2]
+    if int(cid_mag) not in by_cid:
+        raise KeyError(f"Constraint {cid_mag} is not mapped in pool {pool_id}")
+    return by_cid[int(cid_mag)]
+
+
+def monitored_lines(pool_id: int, _conn: Any) -> List[str]:
+    """
+    Branches monitored by the constraints of a pool (see monitored_line), sorted.
+    """
+    return sorted(_line_index(pool_id, _conn)[3])
+
+
+def line_constraints(pool_id: int, branches: List[str], _conn: Any) -> List[List[Any]]:
+    """
+    [BRANCH, MAG_CID, NAME, CTG] rows of the constraints of each branch, in all the pools
+    (the MONITORED_LINE CTE of get_historical_SP), bound as :monitored_line.
+    """
+    by_line = _line_index(pool_id, _conn)[3]
+    rows = []
+    for branch in branches:
+        if branch not in by_line:
+            continue
+        df = by_line[branch]
+        rows += [[branch, int(cid), None if pd.isna(name) else str(name), None if pd.isna(ctg) else str(ctg)]
+                 for cid, name, ctg in zip(df['MAG_CID'], df['NAME'], df['CTG'])]
+    return rows
+
+
+def reference_ces(pool_id: int, cid_mags: Any, _conn: Any) -> pd.DataFrame:
+    """
+    Reference ces of each constraint and package version: the smallest CES_CID mapped to the MAG_CID.
+    Columns MAG_CID, MIN_CID_CES, MAG_REF_PACKAGEVERSION__ID.
+    """
+    df = constraint_map(pool_id, _conn)
+    df = df[df['MAG_CID'].isin(_ids(cid_mags))]
+    ref = df.groupby(['MAG_CID', 'MAG_REF_PACKAGEVERSION__ID'], as_index=False, sort=False)['CES_CID'].min()
+    ref = ref.rename(columns={'CES_CID': 'MIN_CID_CES'})
+    return ref[['MAG_CID', 'MIN_CID_CES', 'MAG_REF_PACKAGEVERSION__ID']].drop_duplicates().reset_index(drop=True)
+
+
+def cid_links(pool_id: int, cid_mags: Any, _conn: Any) -> List[List[int]]:
+    """
+    [MAG_CID, CES_CID, MAG_REF_PACKAGEVERSION__ID] rows linking each constraint to its reference ces,
+    bound as :links in the flows and category queries.
+    """
+    df = constraint_map(pool_id, _conn)
+    ref = reference_ces(pool_id, cid_mags, _conn)[['MAG_CID', 'MIN_CID_CES']].drop_duplicates()
+    links = df.merge(ref, left_on=['MAG_CID', 'CES_CID'], right_on=['MAG_CID', 'MIN_CID_CES'])
+    return links[['MAG_CID', 'CES_CID', 'MAG_REF_PACKAGEVERSION__ID']].astype('int64').values.tolist()
+
+
+def definition_with_te(pool_id: int, packids: Any, cid_ces: Any, _conn: Any) -> pd.DataFrame:
+    """
+    From and to bus of the monitored element of each ces (the DEFINITION_WITH_TE CTE of the queries),
+    the bus order follows the direction of the constraint.
+    Columns MAG_REF_POOL__ID, CES_CID, MAG_REF_PACKAGEVERSION__ID, FROMBUSNAME, TOBUSNAME.
+    """
+    packids = _ids(packids)
+    columns = ['MAG_REF_POOL__ID', 'CES_CID', 'MAG_REF_PACKAGEVERSION__ID'] + BUS_COLUMNS
+    definitions = _package_table('constraint_details', CONSTRAINT_DETAILS_QUERY, pool_id, packids, _conn)
+    elements = _package_table('transmission_elements', TRANSMISSION_ELEMENTS_QUERY, pool_id, packids, _conn)
+    if definitions.empty or elements.empty:
+        return pd.DataFrame(columns=columns)
+
+    definitions = definitions[definitions['CES_CID'].isin(_ids(cid_ces))]
+    # constraints monitoring a single element only (TRY_TO_NUMBER(MONITOREDDAYZERELEMENTIDS) IS NOT NULL)
+    element = pd.to_numeric(definitions['MONITOREDDAYZERELEMENTIDS'], errors='coerce')
+    definitions = definitions.assign(
+        DAYZERELEMENTID=element,
+        DIRECTION=pd.to_numeric(definitions['MONITOREDDAYZERELEMENTIDS_DIR'].astype(str).str.split('_').str[0], errors='coerce'),
+    )[element.notna()]
+    elements = elements.assign(DAYZERELEMENTID=pd.to_numeric(elements['DAYZERELEMENTID'], errors='coerce'))
+
+    df = definitions.merge(elements, on=['MAG_REF_POOL__ID', 'MAG_REF_PACKAGEVERSION__ID', 'DAYZERELEMENTID'])
+    forward = (df['DIRECTION'] == 1).to_numpy()
+    return df.assign(
+        FROMBUSNAME=np.where(forward, df['FROMBUSNAME'], df['TOBUSNAME']),
+        TOBUSNAME=np.where(forward, df['TOBUSNAME'], df['FROMBUSNAME']),
+    )[columns].reset_index(drop=True)
+
+
+def add_bus_names(result: Any, definitions: pd.DataFrame, schema: Optional[Dict[str, str]] = None) -> Any:
+    """
+    Left join of the result (DataFrame or pyarrow.Table) with definition_with_te on
+    (MAG_REF_PACKAGEVERSION__ID, CES_CID): appends FROMBUSNAME and TOBUSNAME, keeps the row order.
+    """
+    is_table = isinstance(result, pa.Table)
+    left = pd.DataFrame({key: np.asarray(result.column(key) if is_table else result[key], dtype='int64') for key in _JOIN_KEYS})
+    left['__row'] = np.arange(len(left))
+    right = definitions[_JOIN_KEYS + BUS_COLUMNS].astype({key: 'int64' for key in _JOIN_KEYS})
+    matched = left.merge(right, on=_JOIN_KEYS, how='left', sort=False)
+    rows = matched['__row'].to_numpy()
+
+    if is_table:
+        out = result.take(pa.array(rows))
+        for column in BUS_COLUMNS:
+            out = out.append_column(column, pa.array(matched[column].astype(object).where(matched[column].notna(), None), pa.string()))
+    else:
+        out = result.iloc[rows].reset_index(drop=True)
+        for column in BUS_COLUMNS:
+            out[column] = matched[column].to_numpy()
+    return ntf.apply_schema(out, {column: dtype for column, dtype in (schema or {}).items() if column in BUS_COLUMNS})
+
+
+def clear_reference_cache(disk: bool = False) -> None:
+    """
+    Forget the reference tables read by this process, and optionally delete the local store.
+    """
+    with _LOCK:
+        _MEMORY.clear()
+        _LINE_INDEXES.clear()
+        _SCENARIOS.clear()
+        if disk and os.path.isdir(REFERENCE_DIR):
+            for root, _, files in os.walk(REFERENCE_DIR):
+                for name in files:
+                    if name.endswith('.parquet'):
+                        os.remove(os.path.join(root, name))
@@ -1,101 +1,212 @@
+import json
+import os
+import threading
+import time
 import pandas as pd  # Assuming the result is a Pandas DataFrame
 from Snowflake_Natif_Connector import conn_python_snowflake as ntf
-from typing import Any,List, Callable
-
-
-def query_to_df(query:str ,_conn: Any) -> pd.DataFrame:
+from typing import Any,Dict,List, Callable, Iterator, Optional, Tuple, Union
+from services import query_templates as qt
+from services import reference_data as rd
+from services import history_store as hs
+from services import market_prices as mp
+
+# Target dtypes of the per-constraint queries, applied at fetch time (see ntf.apply_schema).
+# A report keeps these frames for every constraint it analyzes: float32 values, categorical
+# names and int32 ids take about half the memory of the connector defaults.
+FLOWS_SCHEMA = {
+    'SCENARIONAME': 'category',
+    'MAG_CID': 'int32',
+    'FLOWS': 'float32',
+    'SP_DZR': 'float32',
+    'SP_DA': 'float32',
+    'SP_RT': 'float32',
+    'MINLIMIT': 'float32',
+    'MAXLIMIT': 'float32',
+    'MAG_REF_PACKAGEVERSION__ID': 'int32',
+    'CES_CID': 'int32',
+    'FROMBUSNAME': 'category',
+    'TOBUSNAME': 'category',
+}
+CATEGO_SCHEMA = {
+    'SCENARIONAME': 'category',
+    'MAG_REF_SCENARIO_INFO__ID': 'int32',
+    'MAG_CID': 'int32',
+    'CES_CID': 'int32',
+    'MAG_REF_PACKAGEVERSION__ID': 'int32',
+    'WIND': 'float32',
+    'SOLAR': 'float32',
+    'HYDRO': 'float32',
+    'GEO': 'float32',
+    'IE': 'float32',
+    'OTHERS_UNITS': 'float32',
+    'LOAD': 'float32',
+    'INDL_LOAD': 'float32',
+    'FROMBUSNAME': 'category',
+    'TOBUSNAME': 'category',
+}
+OUTAGES_SCHEMA = {
+    'SCENARIONAME': 'category',
+    'MAG_CID': 'int32',
+    'ILODF': 'float32',
+    'AVG_REDIRECTED_FLOW': 'float32',
+}
+
+
+def _then(result: Any, func: Callable[[Any], Any]) -> Any:
+    # local step on a query result: the reference data (reference_data), the market shadow prices (market_prices)...
+    if hasattr(result, 'then'):  # QueryFuture of an AsyncQueryClient
+        return result.then(func)
+    return func(result)
+
+
+def _with_bus_names(result: Any, definitions: pd.DataFrame, schema: dict) -> Any:
+    # FROMBUSNAME/TOBUSNAME come from the local reference data (see reference_data.definition_with_te)
+    return _then(result, lambda df: rd.add_bus_names(df, definitions, schema))
+
+
+def query_to_df(query:str ,_conn: Any, result_format: str='pandas', use_cache: bool=True) -> pd.DataFrame:
     """
     Run a query in snowflake and return the result in a Dataframe
 
     Parameters:
         query (str): the query to run
         conn (Any): Snowflake connection object.
+        result_format (str): 'pandas', 'arrow' (pyarrow.Table) or 'arrow_pandas' (ArrowDtype DataFrame).
+        use_cache (bool): False to bypass the result cache and always hit Snowflake.
 
     Returns:
         pd.DataFrame: Result of the query as a DataFrame.
     """
-    return ntf.executeQueryNatif(query,_conn)
+    return ntf.executeQueryNatif(query,_conn,result_format,use_cache)
 
-def get_Load(Scenarios,StartDate,EndDate,_conn: Any) -> pd.DataFrame:
+def query_to_batches(query:str ,_conn: Any, result_format: str='pandas') -> Iterator[pd.DataFrame]:
     """
-    get Load for a list of scenarios
+    Run a query in snowflake and yield the result batch by batch as it is downloaded
+
+    Parameters:
+        query (str): the query to run
+        conn (Any): Snowflake connection object.
+        result_format (str): 'pandas', 'arrow' (pyarrow.Table) or 'arrow_pandas' (ArrowDtype DataFrame).
+
+    Returns:
+        Iterator[pd.DataFrame]: the batches of the result.
     """
-    query="""WITH ZONE_DATA AS (
-             select SCENARIONAME,
+    return ntf.iterQueryNatif(query,_conn,result_format)
+
+def stream_query(query:str ,_conn: Any, chunk_func: Callable[[pd.DataFrame],pd.DataFrame], result_format: str='pandas') -> pd.DataFrame:
+    """
+    Run a query and apply chunk_func (filter, aggregation...) on every batch as it arrives.
+    Only the output of chunk_func is kept, so peak memory is bounded by the batch size
+    and not by the size of the full result.
+
+    Parameters:
+        query (str): the query to run
+        conn (Any): Snowflake connection object.
+        chunk_func (Callable): function applied on each batch, returns the reduced batch.
+        result_format (str): 'pandas' or 'arrow_pandas'.
+
+    Returns:
+        pd.DataFrame: the concatenation of the reduced batches.
+    """
+    reduced=[chunk_func(batch) for batch in query_to_batches(query,_conn,result_format)]
+    if not reduced:
+        return pd.DataFrame()
+    return pd.concat(reduced,ignore_index=True)
+
+LOAD_QUERY = qt.register('get_Load', """WITH MARKS AS (
+             -- first date to fetch of each scenario, the rest is in the local store (see history_store.hourly_history)
+             select value[0]::string AS SCENARIONAME,
+             value[1]::date AS SINCE
+             from table(flatten(input=>parse_json(:marks)))
+             )
+             ,ZONE_DATA AS (
+             select A.SCENARIONAME,
               ZONENAME,
               HEDATE,
+              DATE,
               DEMANDMW 
-              from MAGSNOWFLAKE.DAYZER_CUBES.ZONES_RESULTS_HOURLY
-              where SCENARIONAME IN (select value from table(flatten(input=>{0})))
-              AND ((ZONETYPE<>'IndustrialLoad') OR (ZONETYPE is null))
-              AND DATE between '{1}' and '{2}'
+              from MAGSNOWFLAKE.DAYZER_CUBES.ZONES_RESULTS_HOURLY A
+              INNER JOIN MARKS M
+              ON A.SCENARIONAME=M.SCENARIONAME
+              AND A.DATE between M.SINCE and :end_date
+              where ((ZONETYPE<>'IndustrialLoad') OR (ZONETYPE is null))
               UNION ALL
-              select SCENARIONAME,
+              select A.SCENARIONAME,
               'TOTAL'  AS ZONENAME,
               HEDATE,
+              DATE,
               SUM(DEMANDMW) AS DEMANDMW
-              from MAGSNOWFLAKE.DAYZER_CUBES.ZONES_RESULTS_HOURLY
-              where SCENARIONAME IN (select value from table(flatten(input=>{0})))
-              AND DATE between '{1}' and '{2}'
-              AND ((ZONETYPE<>'IndustrialLoad') OR (ZONETYPE is null))
-              group by SCENARIONAME,HEDATE
+              from MAGSNOWFLAKE.DAYZER_CUBES.ZONES_RESULTS_HOURLY A
+              INNER JOIN MARKS M
+              ON A.SCENARIONAME=M.SCENARIONAME
+              AND A.DATE between M.SINCE and :end_date
+              where ((ZONETYPE<>'IndustrialLoad') OR (ZONETYPE is null))
+              group by A.SCENARIONAME,HEDATE,DATE
               )
               select * from ZONE_DATA 
               order by HEDATE
               ;
-    """.format(Scenarios,StartDate,EndDate)
-    return ntf.executeQueryNatif(query,_conn)
-
-def get_Wind(Scenarios,StartDate,EndDate,_conn: any) -> pd.DataFrame:
-    query="""select SCENARIONAME,HEDATE,SUM(GENERATIONMW) AS WIND_GEN
-             from MAGSNOWFLAKE.DAYZER_CUBES.UNITS_RESULTS_HOURLY
-             where SCENARIONAME IN (select value from table(flatten(input=>{0})))
-             AND DATE between '{1}' and '{2}'
-             AND FUELNAME='Wind'
+""")
+
+def _hourly_history(name: str,template: qt.QueryTemplate,Scenarios,StartDate,EndDate,_conn: Any,result_format: str,
+                    chunk_func: Optional[Callable[[pd.DataFrame],pd.DataFrame]]) -> pd.DataFrame:
+    # rows of the local hourly store, only the rows after the high-water mark of each scenario are queried
+    def hourly_history(conn):
+        def fetch(marks):
+            # streamed to the store batch by batch, the new days are never materialized at once
+            query=template.bind(marks=qt.json_list(marks),end_date=EndDate)
+            return ntf.iterQueryNatif(query,conn,'arrow')
+
+        def chunk(df):
+            df=df.drop(columns=['DATE'])
+            return chunk_func(df) if chunk_func is not None else df
+
+        df=hs.hourly_history(hs.store_path(name),list(Scenarios),StartDate,EndDate,fetch,chunk_func=chunk)
+        if chunk_func is None and not df.empty:
+            df=df.sort_values('HEDATE',kind='stable',ignore_index=True)
+        return ntf.from_pandas(df,result_format)
+
+    if hasattr(_conn,'submit_call'):  # AsyncQueryClient
+        return _conn.submit_call(hourly_history)
+    return hourly_history(_conn)
+
+def get_Load(Scenarios,StartDate,EndDate,_conn: Any,result_format: str='pandas',
+             chunk_func: Optional[Callable[[pd.DataFrame],pd.DataFrame]]=None) -> pd.DataFrame:
+    """
+    get Load for a list of scenarios
+    The hourly history is kept in a local store, only the new days of each scenario are queried (see history_store.hourly_history).
+    If chunk_func is given, it is applied on each batch read from the store, as in stream_query
+    """
+    return _hourly_history('load',LOAD_QUERY,Scenarios,StartDate,EndDate,_conn,result_format,chunk_func)
+
+WIND_QUERY = qt.register('get_Wind', """WITH MARKS AS (
+             -- first date to fetch of each scenario, the rest is in the local store (see history_store.hourly_history)
+             select value[0]::string AS SCENARIONAME,
+             value[1]::date AS SINCE
+             from table(flatten(input=>parse_json(:marks)))
+             )
+             select A.SCENARIONAME,HEDATE,DATE,SUM(GENERATIONMW) AS WIND_GEN
+             from MAGSNOWFLAKE.DAYZER_CUBES.UNITS_RESULTS_HOURLY A
+             INNER JOIN MARKS M
+             ON A.SCENARIONAME=M.SCENARIONAME
+             AND A.DATE between M.SINCE and :end_date
+             where FUELNAME='Wind'
              --AND ZONE ='WEST ERCOT'
-             group by SCENARIONAME,HEDATE
+             group by A.SCENARIONAME,HEDATE,DATE
              order by HEDATE
               ;
-    """.format(Scenarios,StartDate,EndDate)
-    return ntf.executeQueryNatif(query,_conn)
+""")
 
-def get_PostMortem(pool_id: int, start_date: str, end_date: str, scenario: List[str], _conn: Any) -> pd.DataFrame:
+def get_Wind(Scenarios,StartDate,EndDate,_conn: any,result_format: str='pandas',
+             chunk_func: Optional[Callable[[pd.DataFrame],pd.DataFrame]]=None) -> pd.DataFrame:
     """
-    Executes the Post Mortem query on Snowflake and returns the result.
-
-    Parameters:
-        pool_id (int): The pool ID to filter the query.
-        start_date (str): The start date for the query in YYYY-MM-DD format.
-        end_date (str): The end date for the query in YYYY-MM-DD format.
-        product (List): List of product name of scenario you want to use.
-        conn (Any): The Snowflake connection object.
-
-    Returns:
-        pd.DataFrame: The result of the query as a Pandas DataFrame.
+    get Wind generation for a list of scenarios
+    The hourly history is kept in a local store, only the new days of each scenario are queried (see history_store.hourly_history).
+    If chunk_func is given, it is applied on each batch read from the store, as in stream_query
     """
-    query = f"""
-    SET PackId=(SELECT MAX(MAG_REF_PackageVersion__ID) FROM MAGSNOWFLAKE.DAYZER_CUBES.NODES_RESULTS_MONTHLY WHERE DATE = '{start_date}' AND MAG_REF_POOL__ID={pool_id});
-
-    CREATE OR REPLACE TEMPORARY TABLE RESULT_MKT_DA AS 
-    SELECT 
-        CID_MAG
-        ,CID_CES
-        , CONSTRAINTNAME
-       -- , FACILITYNAME
-        , CONTINGENCYNAME
-        , CAST(SUM(SHADOWPRICE) AS INT) AS SP_DA
-    FROM (
-        SELECT DISTINCT
-            MAG_REF_POOL__ID, PEAKID, POOLNAME, DATE, HE, CID_MAG, CID_CES,
-            CONSTRAINTNAME, FACILITYNAME, CONTINGENCYNAME, SHADOWPRICE
-        FROM MAGSNOWFLAKE.DAYZER.PROD_DA_CONSTRAINTS_MAPPED
-        WHERE MAG_REF_POOL__ID={pool_id}
-        AND DATE BETWEEN DATE('{start_date}') AND DATE('{end_date}')
-        AND MAG_REF_PACKAGEVERSION__ID=$PackId
-    )
-    GROUP BY 
-        CID_MAG, CID_CES,CONSTRAINTNAME, FACILITYNAME, CONTINGENCYNAME;
+    return _hourly_history('wind',WIND_QUERY,Scenarios,StartDate,EndDate,_conn,result_format,chunk_func)
 
+POSTMORTEM_QUERY = qt.register('get_PostMortem', """
     CREATE OR REPLACE TEMPORARY TABLE RESULT_DZR AS 
     SELECT 
         CONSTRAINTMAPPING_MAG_REF__ID AS CID_MAG
@@ -106,11 +217,11 @@ def get_PostMortem(pool_id: int, start_date: str, end_date: str, scenario: List[
     FROM 
         MAGSNOWFLAKE.DAYZER.VWMAG_CONSTRAINTS_RESULTS_MONTHLY
     WHERE 
-        MAG_REF_POOL__ID={pool_id}
+        MAG_REF_POOL__ID=:pool_id
         AND SHADOWPRICE<>0
-        AND SCENARIONAME IN (select value from table(flatten(input=>{scenario}))
+        AND SCENARIONAME IN (select value::string from table(flatten(input=>parse_json(:scenarios)))
                             )
-        AND MONTH between DATE('{start_date}') AND DATE('{end_date}')
+        AND MONTH between DATE(:start_date) AND DATE(:end_date)
     GROUP BY 
         CONSTRAINTMAPPING_MAG_REF__ID
         ,CONSTRAINTMAPPING_DAYZER_REF__ID
@@ -125,20 +236,40 @@ def get_PostMortem(pool_id: int, start_date: str, end_date: str, scenario: List[
         RESULT_DZR PIVOT (SUM(PIVOT_VALUE) FOR PIVOT_COLUMN IN (ANY ORDER BY PIVOT_COLUMN))
     ;
 
+    -- joined with the DA shadow prices of the report (see market_prices.post_mortem)
     select 
-        A.* 
-        ,B.* EXCLUDE(CID_MAG,CES_NAME,CID_CES)
+        * EXCLUDE(CES_NAME,CID_CES)
     from 
-        RESULT_MKT_DA A
-    LEFT JOIN
-        RESULT_PIVOT B
-    ON
-        A.CID_MAG=B.CID_MAG
-    order by 
-        ABS(SP_DA) DESC;
+        RESULT_PIVOT;
+
+""")
+
+def get_PostMortem(pool_id: int, start_date: str, end_date: str, scenario: List[str], _conn: Any) -> pd.DataFrame:
+    """
+    Executes the Post Mortem query on Snowflake and returns the result.
+    SP_DA comes from the market shadow prices of the report (see market_prices).
+
+    Parameters:
+        pool_id (int): The pool ID to filter the query.
+        start_date (str): The start date for the query in YYYY-MM-DD format.
+        end_date (str): The end date for the query in YYYY-MM-DD format.
+        product (List): List of product name of scenario you want to use.
+        conn (Any): The Snowflake connection object.
 
+    Returns:
+        pd.DataFrame: The result of the query as a Pandas DataFrame.
     """
-    return ntf.executeQueryNatif(query, _conn)
+    query=POSTMORTEM_QUERY.bind(pool_id=pool_id,start_date=start_date,end_date=end_date,scenarios=qt.json_list(scenario))
+    result=ntf.executeQueryNatif(query, _conn)
+    prices=mp.market_prices(pool_id,start_date,end_date,_conn)
+    df_mkt_da=prices.post_mortem(mp.package_version(pool_id,start_date,_conn),start_date,end_date)
+
+    def join_market(df_pivot):
+        df=df_mkt_da.merge(df_pivot,on='CID_MAG',how='left',sort=False)
+        # order by ABS(SP_DA) DESC, nulls first like Snowflake
+        return df.iloc[df['SP_DA'].abs().sort_values(ascending=False,na_position='first',kind='stable').index].reset_index(drop=True)
+
+    return _then(result,join_market)
 
 def get_flows_old(cid_mag: int,
               pool_id: int,
@@ -342,97 +473,17 @@ def get_flows_old(cid_mag: int,
     """
     return ntf.executeQueryNatif(query,_conn) 
 
-def get_flows(cid_mag: int,
-              pool_id: int,
-              cid_ces_str: str, 
-              packid_str: str,
-              Scenario_id: List[int],
-              Mindate :str,
-              Maxdate :str,
-              _conn: Any) -> pd.DataFrame:
-    """
-    Get the flows hourly for a given constraint, a timeframe and a list of scenarios
-
-    Parameters:
-        cid_mag (int): unique cid of the constraint.
-        pool_id (int): pool_id of the constraint
-        cid_ces_str (str): str of all the cid_ces involved.
-        packid_str (str): str of all the package_id involved.
-        Mindate (str): The Mindate to take date for the query in YYYY-MM-DD format.
-        Maxdate (str): The Maxdate to take date for the query in YYYY-MM-DD format.
-        product (List): List of scenario_id you want to use.
-        conn (Any): The Snowflake connection object.
-
-    Returns:
-        pd.DataFrame: The result of the query as a Pandas DataFrame.
-    """
-    query=f"""
+FLOWS_QUERY = qt.register('get_flows', """
     ALTER SESSION SET QUERY_TAG = 'NERD_MONKEY';
 
-    WITH DEFINITION AS (
-    select
-        MAG_REF_POOL__ID
-        ,CES_CID
-        ,MAG_REF_PACKAGEVERSION__ID
-        ,SPLIT_PART(MONITOREDDAYZERELEMENTIDS,'_',1) AS MONITOREDDAYZERELEMENTIDS
-        ,SPLIT_PART(MONITOREDDAYZERELEMENTIDS_DIR,'_',1) AS MONITOREDDAYZERELEMENTIDS_DIR
-    from 
-        MAGSQLSERVER.DAYZERSTUDY.REF_DAYZER_CONSTRAINTS_DETAILS A
-    WHERE (MAG_REF_POOL__ID ={pool_id}
-    OR
-    MAG_REF_POOL__ID  IN (select distinct MAG_REF_POOLHYBRID__ID 
-                            from MAGSNOWFLAKE.DAYZER.LINK_HYBRID_MKT where MAG_REF_POOL__ID={pool_id}
-                            )
-    )
-    AND TRY_TO_NUMBER(MONITOREDDAYZERELEMENTIDS) IS NOT NULL
-    AND CES_CID IN ({cid_ces_str})
-    AND MAG_REF_PACKAGEVERSION__ID IN ({packid_str})
-    )
-    
-    ,TRANSMISSION_ELEMENTS AS (
-     select
-        MAG_REF_POOL__ID
-        ,MAG_REF_PACKAGEVERSION__ID
-        ,DAYZERELEMENTID
-        ,FROMBUSNAME
-        ,TOBUSNAME
-     from 
-        MAGSQLSERVER.DAYZERSTUDY.REF_DAYZER_TRANSMISSION_ELEMENTS_DETAILS   
-    WHERE (MAG_REF_POOL__ID ={pool_id}
-    OR
-    MAG_REF_POOL__ID  IN (select distinct MAG_REF_POOLHYBRID__ID 
-                            from MAGSNOWFLAKE.DAYZER.LINK_HYBRID_MKT where MAG_REF_POOL__ID={pool_id}
-                            )
-    )    
-    )
-    ,DEFINITION_WITH_TE AS (
+    WITH MAG_CID_LINK AS (
+    -- reference ces of each constraint, resolved locally from the reference data (see reference_data.cid_links)
     select 
-        A.MAG_REF_POOL__ID
-        ,CES_CID
-        ,A.MAG_REF_PACKAGEVERSION__ID
-        ,IFF(MONITOREDDAYZERELEMENTIDS_DIR=1,FROMBUSNAME,TOBUSNAME) AS FROMBUSNAME
-        ,IFF(MONITOREDDAYZERELEMENTIDS_DIR=1,TOBUSNAME,FROMBUSNAME) AS TOBUSNAME
+        value[0]::int AS MAG_CID
+        ,value[1]::int AS CES_CID
+        ,value[2]::int AS MAG_REF_PACKAGEVERSION__ID
     from 
-        DEFINITION A
-    INNER JOIN 
-        TRANSMISSION_ELEMENTS B
-    ON 
-        A.MONITOREDDAYZERELEMENTIDS=B.DAYZERELEMENTID
-        AND A.MAG_REF_PACKAGEVERSION__ID=B.MAG_REF_PACKAGEVERSION__ID
-        AND A.MAG_REF_POOL__ID=B.MAG_REF_POOL__ID
-    
-    )
-
-    ,MAG_CID_LINK AS (
-    SELECT 
-        MAG_CID
-        ,CES_CID
-        ,MAG_REF_PACKAGEVERSION__ID
-        ,MAG_REF_POOL__ID
-    FROM 
-        MAGSQLSERVER.DAYZERSTUDY.MAG_CES_CONSTRAINTS_MAP_HISTORIC
-    WHERE
-        MAG_CID={cid_mag}
+        table(flatten(input=>parse_json(:links)))
     )
 
    ,SCENARIO_DZR_A AS (
@@ -450,11 +501,12 @@ def get_flows(cid_mag: int,
     FROM 
         MAGSNOWFLAKE.DAYZER_CUBES.CONSTRAINTS_RESULTS_HOURLY  A
     WHERE 
-        MAG_REF_SCENARIO_INFO__ID IN ({Scenario_id})
-        AND A.MAG_REF_POOL__ID ={pool_id}
-        AND A.CONSTRAINTMAPPING_DAYZER_REF__ID IN ({cid_ces_str})
-        AND A.MAG_REF_PACKAGEVERSION__ID IN ({packid_str})
-        AND CAST(DATEADD(HOUR,-1,HEDATE) AS DATE) between date('{Mindate}') AND date('{Maxdate}')
+        MAG_REF_SCENARIO_INFO__ID IN (select value::int from table(flatten(input=>parse_json(:scenario_ids))))
+        AND A.MAG_REF_POOL__ID =:pool_id
+        AND A.CONSTRAINTMAPPING_DAYZER_REF__ID IN (select value::int from table(flatten(input=>parse_json(:cid_ces))))
+        AND A.MAG_REF_PACKAGEVERSION__ID IN (select value::int from table(flatten(input=>parse_json(:packids))))
+        -- hours ending of mindate..maxdate (HE 1 to HE 24), as a range on HEDATE for partition pruning
+        AND HEDATE >= DATEADD(HOUR,1,date(:mindate)) AND HEDATE < DATEADD(HOUR,25,date(:maxdate))
     )
     
     ,SCENARIO_DZR_B AS (
@@ -476,7 +528,6 @@ def get_flows(cid_mag: int,
     ON 
         A.CONSTRAINTMAPPING_DAYZER_REF__ID=B.CES_CID 
         AND A.MAG_REF_PACKAGEVERSION__ID=B.MAG_REF_PACKAGEVERSION__ID 
-        AND A.MAG_REF_POOL__ID=B.MAG_REF_POOL__ID
     
     )
 
@@ -497,97 +548,81 @@ def get_flows(cid_mag: int,
     INNER JOIN 
         AVOID_DOUBLONS B
     ON A.HEDATE=B.HEDATE 
+    AND A.MAG_CID=B.MAG_CID
     AND A.CES_CID=B.MIN_CID_CES
     AND A.SCENARIONAME=B.SCENARIONAME
     )
 
-    ,MKT_RESULTS AS (
-    select distinct 
-        CID_MAG,DATE,HE,SHADOWPRICE AS SP_DA
-    from (select distinct
-            MAG_REF_POOL__ID,POOLNAME,DATE,HE,CID_MAG,CONSTRAINTNAME,FACILITYNAME,CONTINGENCYNAME,SHADOWPRICE
-            from MAGSNOWFLAKE.DAYZER.PROD_DA_CONSTRAINTS_MAPPED
-            where MAG_REF_POOL__ID={pool_id}
-            AND CID_MAG={cid_mag}
-        )
-    )
-
-    ,MKT_RESULTS_RT AS (
-    select distinct CID_MAG,DATE,HE,SP_RT
-     from (select distinct
-        MAG_REF_POOL__ID,POOLNAME,DATE,HE,CID_MAG,CONSTRAINTNAME,FACILITYNAME,CONTINGENCYNAME,SP_RT
-        from MAGSNOWFLAKE.DAYZER.PROD_RT_CONSTRAINTS_MAPPED
-        where MAG_REF_POOL__ID={pool_id}
-        AND CID_MAG={cid_mag})
-    ) 
-    
     select 
         SCENARIONAME
         ,HEDATE
         ,MAG_CID
         ,FLOWS
         ,ABS(SP_DZR) AS SP_DZR
-        ,ABS(IFNULL(SP_DA,0)) AS SP_DA
-        ,ABS(IFNULL(SP_RT,0)) AS SP_RT
+        -- filled with the market shadow prices of the report (see market_prices.add_market_prices)
+        ,CAST(0 AS FLOAT) AS SP_DA
+        ,CAST(0 AS FLOAT) AS SP_RT
         ,IFF(ABS(MINLIMIT)>8000,NULL,MINLIMIT) AS MINLIMIT
         ,IFF(ABS(MAXLIMIT)>8000,NULL,MAXLIMIT) AS MAXLIMIT
         ,SIMULATIONDATE
         ,A.MAG_REF_PACKAGEVERSION__ID
         ,A.CES_CID
-        ,FROMBUSNAME
-        ,TOBUSNAME
     from 
         SCENARIO_DZR A
-    LEFT JOIN 
-        MKT_RESULTS B
-    ON A.HEDATE=DATEADD(HOUR,B.HE,B.DATE)
-    LEFT JOIN 
-        MKT_RESULTS_RT C
-    ON A.HEDATE=DATEADD(HOUR,C.HE,C.DATE)
-    LEFT JOIN 
-        DEFINITION_WITH_TE D
-    ON 
-        A.MAG_REF_PACKAGEVERSION__ID=D.MAG_REF_PACKAGEVERSION__ID
-        AND A.CES_CID=D.CES_CID
-    order by HEDATE
+    order by MAG_CID,HEDATE
+""")
+
+def get_flows(cid_mag: Union[int, List[int]],
+              pool_id: int,
+              cid_ces_str: str, 
+              packid_str: str,
+              Scenario_id: List[int],
+              Mindate :str,
+              Maxdate :str,
+              _conn: Any,
+              result_format: str='pandas') -> pd.DataFrame:
     """
-    return ntf.executeQueryNatif(query,_conn) 
+    Get the flows hourly for a given constraint, a timeframe and a list of scenarios
+    With a list of cid_mag, the constraints are fetched with a single scan and the result is
+    sorted by MAG_CID (see constraint_utils.prefetch_cstr_data).
+    SP_DA and SP_RT are joined locally from the market shadow prices of the report (see market_prices).
 
-def get_cid_ces_packageid_from_cid_mag(pool_id: int,cid_mag: int,_conn: any) -> pd.DataFrame:
+    Parameters:
+        cid_mag (int or List[int]): unique cid of the constraint, or list of cids.
+        pool_id (int): pool_id of the constraint
+        cid_ces_str (str): str of all the cid_ces involved (of all the constraints).
+        packid_str (str): str of all the package_id involved (of all the constraints).
+        Mindate (str): The Mindate to take date for the query in YYYY-MM-DD format.
+        Maxdate (str): The Maxdate to take date for the query in YYYY-MM-DD format.
+        product (List): List of scenario_id you want to use.
+        conn (Any): The Snowflake connection object.
+        result_format (str): 'pandas', 'arrow' or 'arrow_pandas' (see ntf.RESULT_FORMATS).
+
+    Returns:
+        pd.DataFrame: The result of the query as a Pandas DataFrame.
+    """
+    query=FLOWS_QUERY.bind(pool_id=pool_id,links=qt.json_list(rd.cid_links(pool_id,cid_mag,_conn)),
+                            cid_ces=qt.json_list(cid_ces_str),packids=qt.json_list(packid_str),
+                            scenario_ids=qt.json_list(Scenario_id),mindate=Mindate,maxdate=Maxdate)
+    result=ntf.executeQueryNatif(query,_conn,result_format,schema=FLOWS_SCHEMA)
+    definitions=rd.definition_with_te(pool_id,packid_str,cid_ces_str,_conn)
+    prices=mp.market_prices(pool_id,Mindate,Maxdate,_conn)
+    return _then(result,lambda df: rd.add_bus_names(mp.add_market_prices(df,prices),definitions,FLOWS_SCHEMA))
+
+def get_cid_ces_packageid_from_cid_mag(pool_id: int,cid_mag: Union[int, List[int]],_conn: any) -> pd.DataFrame:
     """
-    getting all ces id and packageid for a mag_cid
+    getting all ces id and packageid for a mag_cid (or a list of mag_cid)
+    Read from the local copy of the constraint mapping (see reference_data.reference_ces).
 
     Parameters:
         pool_id (int): pool_id
-        cid_mag (int): cid_mag
+        cid_mag (int or List[int]): cid_mag
         conn (Any): The Snowflake connection object.
 
     Returns:
         pd.DataFrame: The result of the query as a Pandas DataFrame.
     """ 
-    query=f"""
-    WITH TEMP_A AS (
-    select 
-        MAG_CID
-        ,MAG_REF_PACKAGEVERSION__ID
-        ,MIN(CES_CID) AS MIN_CID_CES
-    from 
-        MAGSQLSERVER.DAYZERSTUDY.MAG_CES_CONSTRAINTS_MAP_HISTORIC
-    where 
-        MAG_REF_POOL__ID={pool_id}
-        AND MAG_CID={cid_mag}
-    group by 
-        MAG_CID
-        ,MAG_REF_PACKAGEVERSION__ID
-    )
-    
-    select distinct 
-        MIN_CID_CES,MAG_REF_PACKAGEVERSION__ID
-    from 
-        TEMP_A;
-    
-    """
-    return ntf.executeQueryNatif(query,_conn)
+    return rd.reference_ces(pool_id,cid_mag,_conn)
 
 def get_catego_old(cid_mag: int,
                pool_id: int, 
@@ -772,101 +807,17 @@ def get_catego_old(cid_mag: int,
         """
     return ntf.executeQueryNatif(query,_conn)
 
-def get_catego(cid_mag: int,
-               cid_ces_str: str, 
-               packid_str: str,
-               pool_id: int, 
-               scenario_id: List[int],
-               mindate: str,
-               maxdate: str,
-               _conn: any) -> pd.DataFrame:
-    """
-    Get the category for a period and different scenario
-
-    Parameters:
-        cid_mag (int): unique cid of the constraint.
-        cid_ces_str: str, 
-        packid_str: str,
-        pool_id (int): pool_id of the constraint.
-        scenario_id (List): list of scenario you want to see
-        mindate (str): first date of the interval.
-        maxdate (str): last date of the interval.
-        conn (Any): The Snowflake connection object.
-
-    Returns:
-        pd.DataFrame: The result of the query as a Pandas DataFrame.
-    """
-    query=f"""
+CATEGO_QUERY = qt.register('get_catego', """
     ALTER SESSION SET QUERY_TAG = 'NERD_MONKEY';
 
-    WITH DEFINITION AS (
-    select
-        MAG_REF_POOL__ID
-        ,CES_CID
-        ,MAG_REF_PACKAGEVERSION__ID
-        ,SPLIT_PART(MONITOREDDAYZERELEMENTIDS,'_',1) AS MONITOREDDAYZERELEMENTIDS
-        ,SPLIT_PART(MONITOREDDAYZERELEMENTIDS_DIR,'_',1) AS MONITOREDDAYZERELEMENTIDS_DIR
-    from 
-        MAGSQLSERVER.DAYZERSTUDY.REF_DAYZER_CONSTRAINTS_DETAILS A
-    WHERE (
-        MAG_REF_POOL__ID ={pool_id}
-    OR
-        MAG_REF_POOL__ID  IN (select distinct MAG_REF_POOLHYBRID__ID 
-                                from MAGSNOWFLAKE.DAYZER.LINK_HYBRID_MKT 
-                                where MAG_REF_POOL__ID={pool_id}
-                                )
-    )
-        AND TRY_TO_NUMBER(MONITOREDDAYZERELEMENTIDS) IS NOT NULL
-        AND CES_CID IN ({cid_ces_str})
-        AND MAG_REF_PACKAGEVERSION__ID IN ({packid_str})
-    )
-
-    ,TRANSMISSION_ELEMENTS AS (
-     select
-        MAG_REF_POOL__ID
-        ,MAG_REF_PACKAGEVERSION__ID
-        ,DAYZERELEMENTID
-        ,FROMBUSNAME
-        ,TOBUSNAME
-     from 
-        MAGSQLSERVER.DAYZERSTUDY.REF_DAYZER_TRANSMISSION_ELEMENTS_DETAILS   
-    WHERE (MAG_REF_POOL__ID ={pool_id}
-    OR
-    MAG_REF_POOL__ID  IN (select distinct MAG_REF_POOLHYBRID__ID 
-                            from MAGSNOWFLAKE.DAYZER.LINK_HYBRID_MKT where MAG_REF_POOL__ID={pool_id}
-                            )
-    )
-    )    
-    
-    ,DEFINITION_WITH_TE AS (
+    WITH MAG_CID_LINK AS (
+    -- reference ces of each constraint, resolved locally from the reference data (see reference_data.cid_links)
     select 
-        A.MAG_REF_POOL__ID
-        ,CES_CID
-        ,A.MAG_REF_PACKAGEVERSION__ID
-        ,IFF(MONITOREDDAYZERELEMENTIDS_DIR=1,FROMBUSNAME,TOBUSNAME) AS FROMBUSNAME
-        ,IFF(MONITOREDDAYZERELEMENTIDS_DIR=1,TOBUSNAME,FROMBUSNAME) AS TOBUSNAME
+        value[0]::int AS MAG_CID
+        ,value[1]::int AS CES_CID
+        ,value[2]::int AS MAG_REF_PACKAGEVERSION__ID
     from 
-        DEFINITION A
-    INNER JOIN 
-        TRANSMISSION_ELEMENTS B
-    ON 
-        A.MONITOREDDAYZERELEMENTIDS=B.DAYZERELEMENTID
-        AND A.MAG_REF_PACKAGEVERSION__ID=B.MAG_REF_PACKAGEVERSION__ID
-        AND A.MAG_REF_POOL__ID=B.MAG_REF_POOL__ID
-    
-    )
-
-    ,MAG_CID_LINK AS (
-    SELECT 
-        MAG_CID
-        ,CES_CID
-        ,MAG_REF_PACKAGEVERSION__ID
-        ,MAG_REF_POOL__ID
-    FROM 
-        MAGSQLSERVER.DAYZERSTUDY.MAG_CES_CONSTRAINTS_MAP_HISTORIC
-    WHERE
-        MAG_CID={cid_mag}
-    
+        table(flatten(input=>parse_json(:links)))
     )
     ,SCENARIO_DZR_A AS (
     SELECT
@@ -887,10 +838,11 @@ def get_catego(cid_mag: int,
     FROM 
         MAGSNOWFLAKE.dayzer_cubes.category_results_hourly A
     where 
-        MAG_REF_SCENARIO_INFO__ID IN ({scenario_id})
-        AND A.CONSTRAINTID IN ({cid_ces_str})
-        AND A.MAG_REF_PACKAGEVERSION__ID IN ({packid_str})
-        AND CAST(DATEADD(HOUR,-1,HEDATE) AS DATE) between date('{mindate}') AND date('{maxdate}')
+        MAG_REF_SCENARIO_INFO__ID IN (select value::int from table(flatten(input=>parse_json(:scenario_ids))))
+        AND A.CONSTRAINTID IN (select value::int from table(flatten(input=>parse_json(:cid_ces))))
+        AND A.MAG_REF_PACKAGEVERSION__ID IN (select value::int from table(flatten(input=>parse_json(:packids))))
+        -- hours ending of mindate..maxdate (HE 1 to HE 24), as a range on HEDATE for partition pruning
+        AND HEDATE >= DATEADD(HOUR,1,date(:mindate)) AND HEDATE < DATEADD(HOUR,25,date(:maxdate))
     )
 
     ,SCENARIO_DZR_B AS (
@@ -916,7 +868,6 @@ def get_catego(cid_mag: int,
     ON 
         A.CONSTRAINTID=B.CES_CID 
         AND A.MAG_REF_PACKAGEVERSION__ID=B.MAG_REF_PACKAGEVERSION__ID 
-        AND A.MAG_REF_POOL__ID=B.MAG_REF_POOL__ID
     
     )
 
@@ -943,41 +894,51 @@ def get_catego(cid_mag: int,
         AVOID_DOUBLONS B
     ON 
         A.HEDATE=B.HEDATE 
+        AND A.MAG_CID=B.MAG_CID
         AND A.CES_CID=B.MIN_CID_CES 
         AND A.MAG_REF_SCENARIO_INFO__ID=B.MAG_REF_SCENARIO_INFO__ID
     )
 
     select 
-        A.* 
-        ,B.FROMBUSNAME
-        ,B.TOBUSNAME
+        * 
     from 
-        FINAL_CATEGORY_TABLE A
-    LEFT JOIN 
-        DEFINITION_WITH_TE B
-    ON 
-        A.MAG_REF_PACKAGEVERSION__ID=B.MAG_REF_PACKAGEVERSION__ID
-        AND A.CES_CID=B.CES_CID
+        FINAL_CATEGORY_TABLE
 
-        """
-    return ntf.executeQueryNatif(query,_conn)
+""")
 
-def get_outages(cid_mag: int,pool_id: int,scenario: List[str],mindate: str,maxdate: str,_conn: any) -> pd.DataFrame:
+def get_catego(cid_mag: Union[int, List[int]],
+               cid_ces_str: str, 
+               packid_str: str,
+               pool_id: int, 
+               scenario_id: List[int],
+               mindate: str,
+               maxdate: str,
+               _conn: any,
+               result_format: str='pandas') -> pd.DataFrame:
     """
-    Get outages for a period and different scenario
+    Get the category for a period and different scenario
+    With a list of cid_mag, the constraints are fetched with a single scan (see constraint_utils.prefetch_cstr_data).
 
     Parameters:
-        cid_mag (int): unique cid of the constraint.
-        pool_id (int): pool id of the constraint
-        scenario (List): list of scenario you want to see
+        cid_mag (int or List[int]): unique cid of the constraint, or list of cids.
+        cid_ces_str: str, 
+        packid_str: str,
+        pool_id (int): pool_id of the constraint.
+        scenario_id (List): list of scenario you want to see
         mindate (str): first date of the interval.
         maxdate (str): last date of the interval.
         conn (Any): The Snowflake connection object.
+        result_format (str): 'pandas', 'arrow' or 'arrow_pandas' (see ntf.RESULT_FORMATS).
 
     Returns:
         pd.DataFrame: The result of the query as a Pandas DataFrame.
     """
-    query=f"""
+    query=CATEGO_QUERY.bind(links=qt.json_list(rd.cid_links(pool_id,cid_mag,_conn)),cid_ces=qt.json_list(cid_ces_str),packids=qt.json_list(packid_str),
+                             scenario_ids=qt.json_list(scenario_id),mindate=mindate,maxdate=maxdate)
+    result=ntf.executeQueryNatif(query,_conn,result_format,schema=CATEGO_SCHEMA)
+    return _with_bus_names(result,rd.definition_with_te(pool_id,packid_str,cid_ces_str,_conn),CATEGO_SCHEMA)
+
+OUTAGES_QUERY = qt.register('get_outages', """
     WITH BASE_A AS (
     select 
         MDB_SCENARIONAME
@@ -991,7 +952,7 @@ def get_outages(cid_mag: int,pool_id: int,scenario: List[str],mindate: str,maxda
         ,STARTDATE
         ,ENDDATE
         ,STATUS 
-        ,DATEDIFF(DAY, LAG(DATE) OVER (PARTITION BY EQKEY ORDER BY DATE), DATE) AS DateDiff
+        ,DATEDIFF(DAY, LAG(DATE) OVER (PARTITION BY MAG_CID,EQKEY ORDER BY DATE), DATE) AS DateDiff
     from 
         MAGSNOWFLAKE.DAYZER_CUBES.LOR_RESULTS_DAILY A
     INNER JOIN 
@@ -1000,11 +961,11 @@ def get_outages(cid_mag: int,pool_id: int,scenario: List[str],mindate: str,maxda
         A.CONSTRAINTMAPPING_DAYZER_REF__ID=B.CES_CID 
         AND A.MAG_REF_PACKAGEVERSION__ID=B.MAG_REF_PACKAGEVERSION__ID
     where 
-        MAG_CID={cid_mag}
-        AND MDB_SCENARIONAME IN (select value from table(flatten(input=>{scenario})))
-        AND B.MAG_REF_POOL__ID={pool_id}
+        MAG_CID IN (select value::int from table(flatten(input=>parse_json(:cid_mags))))
+        AND MDB_SCENARIONAME IN (select value::string from table(flatten(input=>parse_json(:scenarios))))
+        AND B.MAG_REF_POOL__ID=:pool_id
         AND ABS(AVGREDIRECTEDFLOW)>=1
-        AND A.DATE between date('{mindate}') AND date('{maxdate}')
+        AND A.DATE between date(:mindate) AND date(:maxdate)
         AND ENDDATE<='2049-01-01'
     group by 
         MDB_SCENARIONAME
@@ -1043,12 +1004,14 @@ def get_outages(cid_mag: int,pool_id: int,scenario: List[str],mindate: str,maxda
         AVOID_DOUBLONS B
     ON 
         A.DATE=B.DATE 
+        AND A.MAG_CID=B.MAG_CID
         AND A.CES_CID=B.MIN_CID_CES
         AND A.MDB_SCENARIONAME=B.MDB_SCENARIONAME
     )
 
     select  
         MDB_SCENARIONAME AS SCENARIONAME
+        ,MAG_CID
         ,DATE
         ,EQKEY
         ,OUTAGEID
@@ -1060,74 +1023,50 @@ def get_outages(cid_mag: int,pool_id: int,scenario: List[str],mindate: str,maxda
     from 
         BASE
     order by 
-        DATE
+        MAG_CID
+        ,DATE
             
+""")
+
+def get_outages(cid_mag: Union[int, List[int]],pool_id: int,scenario: List[str],mindate: str,maxdate: str,_conn: any,result_format: str='pandas') -> pd.DataFrame:
     """
-    return ntf.executeQueryNatif(query,_conn)
+    Get outages for a period and different scenario
+    With a list of cid_mag, the constraints are fetched with a single scan (see constraint_utils.prefetch_cstr_data).
 
-def get_scenario_id (scenario: List[str],_conn: Any):
-    query=f"""
-    select distinct 
-        MAG_REF_SCENARIO_INFO__ID 
-    from 
-        MAGSNOWFLAKE.DAYZER.CONSTRAINT_SCENARIO_TO_BE_CUBED
-    where 
-        SCENARIONAME IN (select value from table(flatten(input=>{scenario})))
+    Parameters:
+        cid_mag (int or List[int]): unique cid of the constraint, or list of cids.
+        pool_id (int): pool id of the constraint
+        scenario (List): list of scenario you want to see
+        mindate (str): first date of the interval.
+        maxdate (str): last date of the interval.
+        conn (Any): The Snowflake connection object.
+        result_format (str): 'pandas', 'arrow' or 'arrow_pandas' (see ntf.RESULT_FORMATS).
+
+    Returns:
+        pd.DataFrame: The result of the query as a Pandas DataFrame.
     """
-    return ntf.executeQueryNatif(query,_conn)
+    query=OUTAGES_QUERY.bind(pool_id=pool_id,cid_mags=qt.json_list(cid_mag),scenarios=qt.json_list(scenario),mindate=mindate,maxdate=maxdate)
+    return ntf.executeQueryNatif(query,_conn,result_format,schema=OUTAGES_SCHEMA)
 
-def get_nb_hour_bind(pool_id: int,cid_mag: int,mindate: str,maxdate: str,_conn: any) -> pd.DataFrame:
-    query=f"""
-    SET PoolName=(select distinct MARKET from MAGSQLSERVER.DAYZERSTUDY.MAG_REF_MARKET where MAG_REF_MARKET__ID={pool_id});
+def get_scenario_id (scenario: List[str],_conn: Any):
+    """
+    MAG_REF_SCENARIO_INFO__ID of the scenarios, read from the scenario map of the process
+    (see reference_data.scenario_ids): the lookups of a report share a single query.
+    """
+    if hasattr(_conn,'submit_call'):  # AsyncQueryClient
+        return _conn.submit_call(lambda conn: rd.scenario_ids(scenario,conn))
+    return rd.scenario_ids(scenario,_conn)
 
+NB_HOUR_BIND_QUERY = qt.register('get_nb_hour_bind', """
     WITH NB_HOUR_PEAKID AS (
     select A.FTR_PEAKID AS PEAKID,COUNT(*) AS NB_HOUR
     from MAGSNOWFLAKE.DAYZER_CUBES_STAGING.YESENERGY_PEAKS A
-    where MAG_REF_POOL__ID={pool_id}
-    AND DATE_TRUNC(DAY,DATEADD(HOUR,-1,DATETIME)) between DATE('{mindate}') AND DATE('{maxdate}')
+    where MAG_REF_POOL__ID=:pool_id
+    -- hours ending of mindate..maxdate, as a range on DATETIME for partition pruning
+    AND DATETIME >= DATEADD(HOUR,1,DATE(:mindate)) AND DATETIME < DATEADD(HOUR,25,DATE(:maxdate))
     group by FTR_PEAKID
     )
 
-    ,RESULTS_MKT_DA AS (
-    SELECT 
-        'SP_DA' AS SCENARIO
-        , CAST(SUM(SHADOWPRICE) AS INT) AS SP
-        ,COUNT(*) AS NB_HOUR_BIND
-        ,CAST(IFF(NB_HOUR_BIND=0,0,SP/NB_HOUR_BIND) AS INT) AS SP_PER_HOUR
-        ,NULL AS MINLIMIT
-        ,NULL AS MAXLIMIT
-    FROM (
-        SELECT DISTINCT
-            MAG_REF_POOL__ID, PEAKID, POOLNAME, DATE, HE, CID_MAG,
-            CONSTRAINTNAME, FACILITYNAME, CONTINGENCYNAME, SHADOWPRICE
-        FROM MAGSNOWFLAKE.DAYZER.PROD_DA_CONSTRAINTS_MAPPED
-        WHERE MAG_REF_POOL__ID={pool_id}
-        AND DATE BETWEEN DATE('{mindate}') AND DATE('{maxdate}')
-        AND CID_MAG={cid_mag}
-
-    )
-    )
-
-    ,RESULTS_MKT_RT AS (
-    SELECT 
-        'SP_RT' AS SCENARIO
-        , CAST(SUM(SP_RT) AS INT) AS SP
-        ,COUNT(*) AS NB_HOUR_BIND
-        ,CAST(IFF(NB_HOUR_BIND=0,0,SP/NB_HOUR_BIND) AS INT) AS SP_PER_HOUR
-        ,NULL AS MINLIMIT
-        ,NULL AS MAXLIMIT
-    FROM (
-        SELECT DISTINCT
-            MAG_REF_POOL__ID, PEAKID, POOLNAME, DATE, HE, CID_MAG,
-            CONSTRAINTNAME, FACILITYNAME, CONTINGENCYNAME, SP_RT
-        FROM MAGSNOWFLAKE.DAYZER.PROD_RT_CONSTRAINTS_MAPPED
-        WHERE MAG_REF_POOL__ID={pool_id}
-        AND DATE BETWEEN DATE('{mindate}') AND DATE('{maxdate}')
-        AND CID_MAG={cid_mag}
-
-    )
-    )
-
     ,RESULT_SC_A AS (
     select distinct
         MAG_CID,PEAKID,SHADOWCOST
@@ -1139,11 +1078,11 @@ def get_nb_hour_bind(pool_id: int,cid_mag: int,mindate: str,maxdate: str,_conn:
         A.CID_CES=B.CES_CID
         AND A.MAG_REF_PACKAGEVERSION__ID=B.MAG_REF_PACKAGEVERSION__ID
     where 
-        POOLNAME=$PoolName
+        POOLNAME=(select distinct MARKET from MAGSQLSERVER.DAYZERSTUDY.MAG_REF_MARKET where MAG_REF_MARKET__ID=:pool_id)
         AND AUCTIONDATE=STARTDATE
-        AND STARTDATE='{mindate}'
-        AND ENDDATE='{maxdate}'
-        AND MAG_CID={cid_mag}
+        AND STARTDATE=DATE(:mindate)
+        AND ENDDATE=DATE(:maxdate)
+        AND MAG_CID=:cid_mag
 
 )
 
@@ -1173,66 +1112,53 @@ def get_nb_hour_bind(pool_id: int,cid_mag: int,mindate: str,maxdate: str,_conn:
         NB_HOUR_PEAKID B
     ON
         A.PEAKID=B.PEAKID
-        WHERE MAG_REF_POOL__ID={pool_id}
-        AND MONTH=  DATE('{mindate}')
-        AND CONSTRAINTMAPPING_MAG_REF__ID={cid_mag}
+        WHERE MAG_REF_POOL__ID=:pool_id
+        AND MONTH=  DATE(:mindate)
+        AND CONSTRAINTMAPPING_MAG_REF__ID=:cid_mag
         AND MAG_REF_PRODUCT__ID IN (1,2)
     group by SCENARIONAME
     )
 
+    -- the SP_DA and SP_RT rows come from the market shadow prices of the report (see market_prices.binding_hours)
     select * from RESULTS_SCENARIO
     UNION
-    select * from RESULTS_MKT_DA
-    UNION
     select * from RESULTS_SC
-    UNION
-    select * from RESULTS_MKT_RT
     ;
-    """
-    return ntf.executeQueryNatif(query,_conn)
+""")
 
-def get_historical_SP(pool_id: int,cid_mag: int,scenario_id_sp:List[int] ,_conn: any) -> pd.DataFrame:
-    """
-    For a constraint, get all the ShadowPrice DAM,RT, ShadowCost and Predicted ShadowPrice from scenario selected by the user
-
-    Parameters:
-        pool_id (int): pool id of the constraint
-        cid_mag (int): unique cid of the constraint.
-        scenario_id (List): list of scenario you want to see
-        conn (Any): The Snowflake connection object.
-
-    Returns:
-        pd.DataFrame: The result of the query as a Pandas DataFrame.
-    """ 
-    query=f"""
+def get_nb_hour_bind(pool_id: int,cid_mag: int,mindate: str,maxdate: str,_conn: any) -> pd.DataFrame:
+    query=NB_HOUR_BIND_QUERY.bind(pool_id=pool_id,cid_mag=cid_mag,mindate=mindate,maxdate=maxdate)
+    result=ntf.executeQueryNatif(query,_conn)
+    prices=mp.market_prices(pool_id,mindate,maxdate,_conn)
+    market=[prices.binding_hours(name,cid_mag,mindate,maxdate) for name in ('DA','RT')]
+    return _then(result,lambda df: pd.concat([df]+market,ignore_index=True).drop_duplicates(ignore_index=True))
+
+# get_historical_SP reads the history of every monitored line of the pool with a single query and
+# keeps it for the process, instead of one query per constraint (MAG_HISTORICAL_SP_POOL_WIDE=0).
+# A history is read again from its store (and the new months queried) after rd.REFERENCE_TTL seconds
+HISTORICAL_SP_POOL_WIDE = os.environ.get('MAG_HISTORICAL_SP_POOL_WIDE', '1') != '0'
+_POOL_HISTORICAL_SP: Dict[tuple, Tuple[float, Dict[str, pd.DataFrame], pd.DataFrame]] = {}
+_POOL_HISTORICAL_SP_LOCK = threading.Lock()
+
+HISTORICAL_SP_QUERY = qt.register('get_historical_SP', """
     ALTER SESSION SET QUERY_TAG = 'NERD_MONKEY';
 
-    CREATE OR REPLACE TEMPORARY TABLE UNION_ALL_RESULTS AS 
+    -- one row per monitored line (BRANCH) and constraint: the rows of every line of :monitored_line are
+    -- the rows a query on this line alone would return. Resolved locally (see reference_data.line_constraints)
     WITH MONITORED_LINE AS (
     select 
-        MAG_CID
-        ,MIN(CES_CID) AS MIN_CID_CES
-        ,MIN(CES_NAME) MIN_CES_NAME
-        ,CONCAT(' MAG: ',MAG_CID,' CES: ',MIN_CID_CES,' CTG: ',SPLIT_PART(MIN_CES_NAME,':',2)) AS NAME
-        ,SPLIT_PART(MIN_CES_NAME,':',2) AS CTG
+        value[0]::string AS BRANCH
+        ,value[1]::int AS MAG_CID
+        ,value[2]::string AS NAME
+        ,value[3]::string AS CTG
     from 
-        MAGSQLSERVER.DAYZERSTUDY.MAG_CES_CONSTRAINTS_MAP_HISTORIC
-    where 
-        SPLIT_PART(CES_NAME,':',0)=(
-                                        select top 1
-                                            SPLIT_PART(CES_NAME,':',0) BRANCH, 
-                                        from 
-                                            MAGSQLSERVER.DAYZERSTUDY.MAG_CES_CONSTRAINTS_MAP_HISTORIC
-                                        where 
-                                            MAG_CID={cid_mag}
-                                        )
-    group by 
-        MAG_CID
+        table(flatten(input=>parse_json(:monitored_line)))
     )
 
     ,RESULT_DA AS (
     select 
-        DATE_TRUNC(MONTH, DATE) AS FTRMONTH
+        BRANCH
+        ,DATE_TRUNC(MONTH, DATE) AS FTRMONTH
         ,CID_MAG
         ,NAME
         ,CTG
@@ -1252,6 +1178,7 @@ def get_historical_SP(pool_id: int,cid_mag: int,scenario_id_sp:List[int] ,_conn:
             ,FACILITYNAME
             ,CONTINGENCYNAME
             ,SHADOWPRICE
+            ,BRANCH
             ,NAME
             ,CTG
         from 
@@ -1261,10 +1188,12 @@ def get_historical_SP(pool_id: int,cid_mag: int,scenario_id_sp:List[int] ,_conn:
         ON 
             A.CID_MAG=B.MAG_CID
         where 
-            MAG_REF_POOL__ID={pool_id}
+            MAG_REF_POOL__ID=:pool_id
+            AND DATE >= date(:since)
     )
     group by 
-        DATE_TRUNC(MONTH, DATE)
+        BRANCH
+        ,DATE_TRUNC(MONTH, DATE)
         ,CID_MAG
         ,PEAKID
         ,NAME
@@ -1273,7 +1202,8 @@ def get_historical_SP(pool_id: int,cid_mag: int,scenario_id_sp:List[int] ,_conn:
 
     , RESULT_RT AS (
     select 
-        DATE_TRUNC(MONTH, DATE) AS FTRMONTH
+        BRANCH
+        ,DATE_TRUNC(MONTH, DATE) AS FTRMONTH
         ,CID_MAG
         ,NAME
         ,CTG
@@ -1293,6 +1223,7 @@ def get_historical_SP(pool_id: int,cid_mag: int,scenario_id_sp:List[int] ,_conn:
             ,FACILITYNAME
             ,CONTINGENCYNAME
             ,SP_RT
+            ,BRANCH
             ,NAME
             ,CTG
         from 
@@ -1302,10 +1233,12 @@ def get_historical_SP(pool_id: int,cid_mag: int,scenario_id_sp:List[int] ,_conn:
         ON 
             A.CID_MAG=B.MAG_CID
         where 
-            MAG_REF_POOL__ID={pool_id}
+            MAG_REF_POOL__ID=:pool_id
+            AND DATE >= date(:since)
     )
     group by 
-        DATE_TRUNC(MONTH, DATE)
+        BRANCH
+        ,DATE_TRUNC(MONTH, DATE)
         ,CID_MAG
         ,PEAKID
         ,NAME
@@ -1326,7 +1259,8 @@ def get_historical_SP(pool_id: int,cid_mag: int,scenario_id_sp:List[int] ,_conn:
 
     ,SHADOWCOST_DATA AS (
     select distinct 
-        B.MAG_CID
+        C.BRANCH
+        ,B.MAG_CID
         ,A.* EXCLUDE (CID_CES,NAME_CES,MAG_REF_PACKAGEVERSION__ID,SHADOWCOST)
         ,ABS(A.SHADOWCOST) AS SHADOWCOST
         ,C.NAME
@@ -1401,13 +1335,15 @@ def get_historical_SP(pool_id: int,cid_mag: int,scenario_id_sp:List[int] ,_conn:
     ON 
         B.MAG_CID=C.MAG_CID
     WHERE 
-        MAG_REF_MARKET__ID={pool_id}
+        MAG_REF_MARKET__ID=:pool_id
+        AND A.STARTDATE >= date(:since)
     )
 
 
     ,SHADOWCOST_DATA_FINAL AS (
     select 
-        STARTDATE
+        BRANCH
+        ,STARTDATE
         ,MAG_CID
         ,NAME
         ,CTG
@@ -1417,7 +1353,8 @@ def get_historical_SP(pool_id: int,cid_mag: int,scenario_id_sp:List[int] ,_conn:
     from 
         SHADOWCOST_DATA
     group by 
-        MAG_CID
+        BRANCH
+        ,MAG_CID
         ,STARTDATE
         ,TYPE_AUCTION
         ,PEAKID
@@ -1427,7 +1364,8 @@ def get_historical_SP(pool_id: int,cid_mag: int,scenario_id_sp:List[int] ,_conn:
 
     ,RESULT_DZR AS (
     select 
-        MONTH
+        B.BRANCH
+        ,MONTH
         ,CONSTRAINTMAPPING_MAG_REF__ID AS CID_MAG
         ,B.NAME
         ,B.CTG
@@ -1442,9 +1380,11 @@ def get_historical_SP(pool_id: int,cid_mag: int,scenario_id_sp:List[int] ,_conn:
         A.CONSTRAINTMAPPING_MAG_REF__ID=B.MAG_CID
     WHERE 
         SHADOWPRICE<>0
-        AND MAG_REF_SCENARIO_INFO__ID IN ({scenario_id_sp})
+        AND MAG_REF_SCENARIO_INFO__ID IN (select value::int from table(flatten(input=>parse_json(:scenario_ids))))
+        AND MONTH >= date(:since)
     group by 
-        MONTH
+        B.BRANCH
+        ,MONTH
         ,PEAKID
         ,B.NAME
         ,B.CTG
@@ -1458,12 +1398,78 @@ def get_historical_SP(pool_id: int,cid_mag: int,scenario_id_sp:List[int] ,_conn:
     select * from RESULT_DZR
     UNION
     select * from RESULT_MKT_RT_DA
-    ;
+""")
+
+# columns of HISTORICAL_SP_QUERY, for a pool without any monitored line
+HISTORICAL_SP_COLUMNS = ['BRANCH','STARTDATE','MAG_CID','NAME','CTG','PEAKID','PIVOT_COLUMN','PIVOT_VALUE']
+
+def _pivot_historical_SP(df: pd.DataFrame) -> pd.DataFrame:
+    # PIVOT (SUM(PIVOT_VALUE) FOR PIVOT_COLUMN IN (ANY ORDER BY PIVOT_COLUMN)), the columns are named 'SP_DA', 'SC_1MA', ...
+    index=['STARTDATE','MAG_CID','NAME','CTG','PEAKID']
+    wide=df.groupby(index+['PIVOT_COLUMN'],dropna=False)['PIVOT_VALUE'].sum(min_count=1).unstack('PIVOT_COLUMN')
+    wide.columns=[f"'{column}'" for column in wide.columns]
+    return wide.reset_index().sort_values(index,ignore_index=True)
+
+def _historical_SP_rows(pool_id: int,branches: List[str],scenario_ids: str,conn: Any) -> Dict[str,pd.DataFrame]:
+    # monthly rows of each monitored line, kept in the local store line=<line> (see history_store.monthly_histories):
+    # the lines at the same watermark are queried together, a line new to the pool alone from the beginning
+    def fetch(since,lines):
+        monitored=rd.line_constraints(pool_id,lines,conn)
+        query=HISTORICAL_SP_QUERY.bind(pool_id=pool_id,monitored_line=json.dumps(monitored),scenario_ids=scenario_ids,since=since)
+        return ntf.executeQueryNatif(query,conn,use_cache=False)
+
+    scenarios='-'.join(map(str,json.loads(scenario_ids)))
+    paths={line:hs.store_path('historical_SP',f'pool={pool_id}',f'line={line}',f'scenarios={scenarios}') for line in branches}
+    return hs.monthly_histories(paths,fetch,'BRANCH','STARTDATE')
+
+def _pool_historical_SP(pool_id: int,scenario_ids: str,conn: Any) -> Tuple[Dict[str,pd.DataFrame],pd.DataFrame]:
+    # rows of every monitored line of the pool by line, and an empty frame for a line without rows
+    key=(pool_id,scenario_ids)
+    with _POOL_HISTORICAL_SP_LOCK:
+        if key not in _POOL_HISTORICAL_SP or time.time()-_POOL_HISTORICAL_SP[key][0] > rd.REFERENCE_TTL:
+            by_line={line:rows.drop(columns='BRANCH',errors='ignore')
+                     for line,rows in _historical_SP_rows(pool_id,rd.monitored_lines(pool_id,conn),scenario_ids,conn).items()}
+            empty=next(iter(by_line.values())).iloc[0:0] if by_line else pd.DataFrame(columns=HISTORICAL_SP_COLUMNS[1:])
+            _POOL_HISTORICAL_SP[key]=(time.time(),{line:rows for line,rows in by_line.items() if len(rows)},empty)
+        return _POOL_HISTORICAL_SP[key][1:]
+
+def clear_historical_SP() -> None:
+    """
+    Forget the pool histories read by get_historical_SP in this process: the next call reads its store again.
+    """
+    with _POOL_HISTORICAL_SP_LOCK:
+        _POOL_HISTORICAL_SP.clear()
 
+def get_historical_SP(pool_id: int,cid_mag: int,scenario_id_sp:List[int] ,_conn: any,result_format: str='pandas') -> pd.DataFrame:
+    """
+    For a constraint, get all the ShadowPrice DAM,RT, ShadowCost and Predicted ShadowPrice from scenario selected by the user
+    The monthly values are kept in a local store (see history_store.monthly_history): only the months
+    from its watermark are queried, the pivot is done locally.
+    The history of every monitored line of the pool is read once per process and per rd.REFERENCE_TTL (HISTORICAL_SP_POOL_WIDE),
+    the rows of the line of the constraint are taken from it; MAG_HISTORICAL_SP_POOL_WIDE=0 queries
+    and stores the monitored line of each constraint alone. Both give the same result.
 
+    Parameters:
+        pool_id (int): pool id of the constraint
+        cid_mag (int): unique cid of the constraint.
+        scenario_id (List): list of scenario you want to see
+        conn (Any): The Snowflake connection object.
+        result_format (str): 'pandas', 'arrow' or 'arrow_pandas' (see ntf.RESULT_FORMATS).
 
-    select * from 
-    UNION_ALL_RESULTS PIVOT (SUM(PIVOT_VALUE) FOR PIVOT_COLUMN IN (ANY ORDER BY PIVOT_COLUMN));
-    """
-    df=ntf.executeQueryNatif(query,_conn)
-    return df
\ No newline at end of file
+    Returns:
+        pd.DataFrame: The result of the query as a Pandas DataFrame.
+    """ 
+    scenario_ids=qt.json_list(sorted(json.loads(qt.json_list(scenario_id_sp))))
+
+    def historical_SP(conn):
+        branch=rd.monitored_line(pool_id,cid_mag,conn)
+        if HISTORICAL_SP_POOL_WIDE:
+            by_line,empty=_pool_historical_SP(pool_id,scenario_ids,conn)
+            df=by_line.get(branch,empty)
+        else:
+            df=_historical_SP_rows(pool_id,[branch],scenario_ids,conn)[branch].drop(columns='BRANCH',errors='ignore')
+        return ntf.from_pandas(_pivot_historical_SP(df),result_format)
+
+    if hasattr(_conn,'submit_call'):  # AsyncQueryClient
+        return _conn.submit_call(historical_SP)
+    return historical_SP(_conn)
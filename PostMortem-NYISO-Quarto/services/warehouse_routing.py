@@ -0,0 +1,197 @@
+import json
+import os
+import threading
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional, Set
+import pandas as pd
+from Snowflake_Natif_Connector import query_log
+from services.database_connection import get_pool
+
+# Warehouse of each query size. Small lookups run on their own warehouse so they never queue
+# behind the multi-year scans of the large one.
+WAREHOUSES: Dict[str, str] = {
+    'small': os.environ.get('MAG_SMALL_WAREHOUSE', 'SMALL_COMPUTE_WAREHOUSE'),
+    'large': os.environ.get('MAG_LARGE_WAREHOUSE', 'LARGE_COMPUTE_WAREHOUSE'),
+}
+
+# Size of the query functions whose scan is known in advance, the other ones are learned from the query log
+DECLARED_SIZES: Dict[str, str] = {
+    'get_scenario_id': 'small',
+    'get_cid_ces_packageid_from_cid_mag': 'small',
+    'get_nb_hour_bind': 'small',
+    'package_version': 'small',
+    'market_prices': 'large',
+    'get_flows': 'large',
+    'get_catego': 'large',
+    'get_outages': 'large',
+    'get_PostMortem': 'large',
+    'get_Load': 'large',
+    'get_Wind': 'large',
+    'get_historical_SP': 'large',
+}
+
+# A function is learned as small when its median execute time and its largest result stay under
+# these limits over at least MIN_SAMPLES uncached runs on the large warehouse
+SMALL_MAX_EXECUTE_S = 2.0
+SMALL_MAX_ROWS = 10_000
+MIN_SAMPLES = 3
+# last records of the JSONL query log read when learning the sizes
+LOG_TAIL = 5000
+
+
+def _read_log_tail(path: Optional[str], nb_lines: int) -> List[Dict[str, Any]]:
+    if not path:
+        return []
+    try:
+        with open(path) as f:
+            lines = f.readlines()[-nb_lines:]
+    except OSError:
+        return []
+    records = []
+    for line in lines:
+        try:
+            records.append(json.loads(line))
+        except ValueError:
+            continue
+    return records
+
+
+def learned_sizes(records: List[Dict[str, Any]], large_warehouse: str = WAREHOUSES['large']) -> Dict[str, str]:
+    """
+    Size of each function of the query log records ('small' or 'large'), from its uncached runs on the large warehouse.
+    """
+    df = pd.DataFrame(records)
+    if df.empty:
+        return {}
+    df = df[(df['warehouse'] == large_warehouse) & ~df['cached'].astype(bool)]
+    stats = df.groupby('function').agg(samples=('execute_s', 'size'), execute_s=('execute_s', 'median'), rows=('rows', 'max'))
+    stats = stats[stats['samples'] >= MIN_SAMPLES]
+    small = (stats['execute_s'] <= SMALL_MAX_EXECUTE_S) & (stats['rows'] <= SMALL_MAX_ROWS)
+    return {function: 'small' if is_small else 'large' for function, is_small in small.items()}
+
+
+def _is_warehouse_error(error: Exception) -> bool:
+    # snowflake.connector error of a missing, suspended or unauthorized warehouse
+    return type(error).__module__.startswith('snowflake') and 'warehouse' in str(error).lower()
+
+
+class WarehouseRouter:
+    """
+    Connection that runs each query on the warehouse sized for the function asking for it.
+
+    The router is passed as _conn like a plain connection (init_connection returns one when
+    MAG_WAREHOUSE_ROUTING=1). executeQueryNatif runs its query with run_routed() and iterQueryNatif
+    with routed_connection(): the calling function is looked up in DECLARED_SIZES, then in the sizes
+    learned from the query log, unknown functions stay on the large warehouse. Everything else
+    (cursor, execute_async, warehouse...) is the connection of the large warehouse.
+
+    A warehouse that cannot be reached, has no active warehouse in its session (SELECT CURRENT_WAREHOUSE()
+    checked once) or fails a query with a warehouse error is not tried again, its queries fall back to the large one.
+    """
+
+    def __init__(self, conn: Any, warehouses: Optional[Dict[str, str]] = None, declared: Optional[Dict[str, str]] = None):
+        self.conn = conn
+        self.warehouses = warehouses or WAREHOUSES
+        self.declared = DECLARED_SIZES if declared is None else declared
+        self._log_records: Optional[List[Dict[str, Any]]] = None
+        self._log_offset = 0
+        self._unavailable: Set[str] = set()
+        self._verified: Set[str] = set()
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.conn, name)
+
+    def learned(self) -> Dict[str, str]:
+        # the JSONL log of the previous renders is read once, the queries logged since then are added on every call
+        with self._lock:
+            if self._log_records is None:
+                self._log_records = _read_log_tail(query_log.QUERY_LOG.path, LOG_TAIL)
+                self._log_offset = len(query_log.QUERY_LOG.records)
+            records = self._log_records + query_log.QUERY_LOG.records[self._log_offset:]
+        return learned_sizes(records, self.warehouses['large'])
+
+    def size_of(self, function: str) -> str:
+        if function in self.declared:
+            return self.declared[function]
+        return self.learned().get(function, 'large')
+
+    def warehouse_for(self, function: str) -> str:
+        warehouse = self.warehouses[self.size_of(function)]
+        return self.warehouses['large'] if warehouse in self._unavailable else warehouse
+
+    def _acquire(self, warehouse: str) -> Optional[Any]:
+        # pooled connection of a small warehouse, None (and the warehouse marked unavailable) if it cannot be used
+        pool = get_pool(warehouse)
+        try:
+            conn = pool.acquire()
+        except Exception:
+            self._unavailable.add(warehouse)
+            return None
+        try:
+            usable = self._check_warehouse(conn, warehouse)
+        except Exception:
+            usable = False
+        if not usable:
+            pool.release(conn, discard=True)
+            self._unavailable.add(warehouse)
+            return None
+        return conn
+
+    def _check_warehouse(self, conn: Any, warehouse: str) -> bool:
+        # a session on a missing or unauthorized warehouse opens fine and its queries fail with
+        # "No active warehouse": the first connection of each warehouse is checked
+        if warehouse in self._verified:
+            return True
+        cursor = conn.cursor()
+        try:
+            cursor.execute("SELECT CURRENT_WAREHOUSE()")
+            usable = cursor.fetchall()[0][0] is not None
+        finally:
+            cursor.close()
+        if usable:
+            self._verified.add(warehouse)
+        return usable
+
+    @contextmanager
+    def _connection(self, warehouse: str) -> Iterator[Any]:
+        conn = None if warehouse == self.warehouses['large'] else self._acquire(warehouse)
+        if conn is None:
+            yield self.conn
+            return
+        pool = get_pool(warehouse)
+        try:
+            yield conn
+        except Exception as e:
+            pool.release(conn, discard=type(e).__module__.startswith('snowflake'))
+            raise
+        else:
+            pool.release(conn)
+
+    @contextmanager
+    def routed_connection(self) -> Iterator[Any]:
+        """
+        Connection of the warehouse of the calling function: self.conn for the large warehouse, a pooled one otherwise.
+        """
+        with self._connection(self.warehouse_for(query_log.calling_function())) as conn:
+            yield conn
+
+    def run_routed(self, func: Callable[[Any], Any]) -> Any:
+        """
+        func(connection of the warehouse of the calling function). A query failing on a small
+        warehouse with a warehouse error runs again on self.conn, the warehouse is not used anymore.
+        """
+        warehouse = self.warehouse_for(query_log.calling_function())
+        routed = False
+        try:
+            with self._connection(warehouse) as conn:
+                routed = conn is not self.conn
+                return func(conn)
+        except Exception as e:
+            if not (routed and _is_warehouse_error(e)):
+                raise
+            self._unavailable.add(warehouse)
+            return func(self.conn)
+
+    def __repr__(self) -> str:
+        return f"WarehouseRouter({self.conn!r}, {self.warehouses})"
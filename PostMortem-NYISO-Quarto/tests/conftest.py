@@ -0,0 +1,38 @@
+import pytest
+
+# The query functions run on the DuckDB stand-in (see Snowflake_Natif_Connector.duckdb_backend), loaded
+# with the synthetic fixtures of duckdb_fixtures. Run from the project directory:
+#
+#     python -m pytest tests
+duckdb = pytest.importorskip('duckdb')
+
+import duckdb_fixtures
+from Snowflake_Natif_Connector import duckdb_backend, query_cache, query_log
+from services import history_store, market_prices, reference_data, snowflake_queries
+
+FIXTURES_START = '2024-12-01'
+FIXTURES_END = '2025-10-31'
+
+
+@pytest.fixture(scope='session')
+def fixtures_dir(tmp_path_factory):
+    path = str(tmp_path_factory.mktemp('fixtures'))
+    duckdb_fixtures.build_fixtures(path, FIXTURES_START, FIXTURES_END)
+    return path
+
+
+@pytest.fixture
+def stand_in(fixtures_dir, tmp_path, monkeypatch):
+    """
+    Connection to the stand-in, every cache of the process and local store starts empty.
+    """
+    monkeypatch.setattr(query_cache, 'ENABLED', False)
+    monkeypatch.setattr(query_log, 'ENABLED', False)
+    monkeypatch.setattr(history_store, 'HISTORY_DIR', str(tmp_path / 'history'))
+    monkeypatch.setattr(reference_data, 'REFERENCE_DIR', str(tmp_path / 'reference'))
+    reference_data.clear_reference_cache()
+    market_prices.clear_market_prices()
+    snowflake_queries.clear_historical_SP()
+    conn = duckdb_backend.connect(fixtures_dir)
+    yield conn
+    conn.close()
@@ -0,0 +1,170 @@
+import argparse
+import time
+from typing import Any, Callable, Dict, List, Tuple
+import numpy as np
+import pandas as pd
+from Snowflake_Natif_Connector import duckdb_backend
+from services import snowflake_queries as sq
+
+# Synthetic extracts of the tables read by services.snowflake_queries, for the DuckDB stand-in
+# (MAG_QUERY_BACKEND=duckdb, see Snowflake_Natif_Connector.duckdb_backend): one pool with three
+# constraints on two monitored lines, two cubed scenarios and hourly data from start to end.
+# The values are random (fixed seed), only the shapes and the keys are those of the real tables.
+#
+# The tests build them in a temporary directory (see conftest.py). From the project directory,
+#
+#     python -m tests.duckdb_fixtures fixtures --start 2025-01-01 --end 2025-10-31 --benchmark
+#
+# writes them to ./fixtures (MAG_QUERY_BACKEND=duckdb MAG_DUCKDB_FIXTURES=fixtures to render on them)
+# and prints the time of each query function.
+POOL_ID = 1
+PACKAGE_ID = 7
+SCENARIOS = {'NYPP_1MA_Default': 101, 'NYPP_1DA_Default': 102, 'NYPP_1MA_LoadMin': 103, 'NYPP_1MA_WindMin': 104}
+# MAG_CID -> CES_CID of the constraints, the first CES of a MAG_CID is its reference ces
+CONSTRAINTS = {1: [10, 11], 2: [20], 3: [30]}
+
+
+def build_fixtures(fixtures_dir: str, start: str = '2024-01-01', end: str = '2025-10-31', seed: int = 0) -> List[str]:
+    """
+    Write the fixtures of every table of the repository queries in fixtures_dir (see duckdb_backend.write_fixture),
+    hours ending from HE 1 of start to HE 24 of end. Returns the written files.
+    """
+    rng = np.random.default_rng(seed)
+    cubed = dict(list(SCENARIOS.items())[:2])
+    ces_names = {10: 'BR A:ctg1', 11: 'BR A:ctg1b', 20: 'BR A:ctg2', 30: 'BR B:ctg3'}
+    he = pd.date_range(pd.Timestamp(start) + pd.Timedelta(hours=1), pd.Timestamp(end) + pd.Timedelta(hours=24), freq='h')
+    day = (he - pd.Timedelta(hours=1)).normalize()
+    hours = pd.DataFrame({'HEDATE': he, 'DATE': day.date, 'PEAKID': np.where(he.hour.isin(range(8, 24)), 1, 0)})
+    months = pd.date_range(pd.Timestamp(start).replace(day=1), end, freq='MS')
+    days = pd.date_range(start, end, freq='D')
+    tables: Dict[str, pd.DataFrame] = {}
+
+    # reference tables
+    tables['MAGSQLSERVER.DAYZERSTUDY.MAG_CES_CONSTRAINTS_MAP_HISTORIC'] = pd.DataFrame(
+        [{'MAG_CID': cid, 'CES_CID': ces, 'CES_NAME': ces_names[ces], 'MAG_REF_PACKAGEVERSION__ID': PACKAGE_ID, 'MAG_REF_POOL__ID': POOL_ID}
+         for cid, ces_cids in CONSTRAINTS.items() for ces in ces_cids])
+    tables['MAGSQLSERVER.DAYZERSTUDY.MAG_REF_MARKET'] = pd.DataFrame({'MAG_REF_MARKET__ID': [POOL_ID], 'MARKET': ['NYPP']})
+    tables['MAGSQLSERVER.DAYZERSTUDY.REF_DAYZER_CONSTRAINTS_DETAILS'] = pd.DataFrame({
+        'MAG_REF_POOL__ID': POOL_ID, 'CES_CID': [10, 11, 20, 30], 'MAG_REF_PACKAGEVERSION__ID': PACKAGE_ID,
+        'MONITOREDDAYZERELEMENTIDS': ['100', '101', '200', '1,2'], 'MONITOREDDAYZERELEMENTIDS_DIR': ['1_x', '1_y', '-1_z', '1_w']})
+    tables['MAGSQLSERVER.DAYZERSTUDY.REF_DAYZER_TRANSMISSION_ELEMENTS_DETAILS'] = pd.DataFrame({
+        'MAG_REF_POOL__ID': POOL_ID, 'MAG_REF_PACKAGEVERSION__ID': PACKAGE_ID, 'DAYZERELEMENTID': ['100', '101', '200'],
+        'FROMBUSNAME': ['BUS1', 'BUS3', 'BUS5'], 'TOBUSNAME': ['BUS2', 'BUS4', 'BUS6']})
+    tables['MAGSNOWFLAKE.DAYZER.LINK_HYBRID_MKT'] = pd.DataFrame({'MAG_REF_POOL__ID': [POOL_ID], 'MAG_REF_POOLHYBRID__ID': [POOL_ID]})
+    tables['MAGSNOWFLAKE.DAYZER.CONSTRAINT_SCENARIO_TO_BE_CUBED'] = pd.DataFrame(
+        {'SCENARIONAME': list(SCENARIOS), 'MAG_REF_SCENARIO_INFO__ID': list(SCENARIOS.values())})
+
+    # hourly cubes
+    n = len(he)
+    flows = pd.concat([pd.DataFrame({
+        'SCENARIONAME': scenario, 'MAG_REF_SCENARIO_INFO__ID': scenario_id, 'HEDATE': he, 'CONSTRAINTMAPPING_DAYZER_REF__ID': ces,
+        'FLOWS': rng.normal(100, 30, n), 'SHADOWPRICE': np.where(rng.random(n) < .1, -rng.exponential(20, n), 0.),
+        'MINFLOWLIMIT': -500., 'MAXFLOWLIMIT': np.where(rng.random(n) < .01, 99999., 500.), 'SIMULATIONDATE': day.date,
+        'MAG_REF_PACKAGEVERSION__ID': PACKAGE_ID, 'MAG_REF_POOL__ID': POOL_ID})
+        for scenario, scenario_id in cubed.items() for ces in ces_names], ignore_index=True)
+    tables['MAGSNOWFLAKE.DAYZER_CUBES.CONSTRAINTS_RESULTS_HOURLY'] = flows
+    category = flows.rename(columns={'CONSTRAINTMAPPING_DAYZER_REF__ID': 'CONSTRAINTID'})[
+        ['SCENARIONAME', 'MAG_REF_SCENARIO_INFO__ID', 'HEDATE', 'CONSTRAINTID', 'MAG_REF_PACKAGEVERSION__ID', 'MAG_REF_POOL__ID']]
+    for impact in ['WIND', 'SOLAR', 'HYDRO', 'GEO', 'IE', 'NRGEN', 'LOAD', 'INDUSTRIALLOAD']:
+        category = category.assign(**{f'{impact}_IMPACT': rng.normal(0, 5, len(category))})
+    tables['MAGSNOWFLAKE.DAYZER_CUBES.CATEGORY_RESULTS_HOURLY'] = category
+    tables['MAGSNOWFLAKE.DAYZER_CUBES.ZONES_RESULTS_HOURLY'] = pd.concat([pd.DataFrame({
+        'SCENARIONAME': scenario, 'ZONENAME': zone, 'ZONETYPE': 'Load', 'HEDATE': he, 'DATE': day.date, 'DEMANDMW': rng.normal(2000, 200, n)})
+        for scenario in SCENARIOS for zone in ['WEST', 'CAPITL', 'NYC']], ignore_index=True)
+    tables['MAGSNOWFLAKE.DAYZER_CUBES.UNITS_RESULTS_HOURLY'] = pd.concat([pd.DataFrame({
+        'SCENARIONAME': scenario, 'UNITNAME': unit, 'FUELNAME': 'Wind', 'HEDATE': he, 'DATE': day.date, 'GENERATIONMW': rng.random(n) * 300})
+        for scenario in SCENARIOS for unit in ['W1', 'W2']], ignore_index=True)
+    tables['MAGSNOWFLAKE.DAYZER_CUBES_STAGING.YESENERGY_PEAKS'] = pd.DataFrame(
+        {'DATETIME': he, 'FTR_PEAKID': hours['PEAKID'].to_numpy(), 'MAG_REF_POOL__ID': POOL_ID})
+
+    # market shadow prices, about 5% of the hours binding
+    market = []
+    for cid, ces_cids in CONSTRAINTS.items():
+        binding = hours.sample(frac=.05, random_state=cid)
+        market.append(pd.DataFrame({
+            'MAG_REF_POOL__ID': POOL_ID, 'POOLNAME': 'NYPP', 'DATE': binding['DATE'].to_numpy(), 'HE': binding['HEDATE'].dt.hour.to_numpy(),
+            'PEAKID': binding['PEAKID'].to_numpy(), 'CID_MAG': cid, 'CID_CES': ces_cids[0], 'CONSTRAINTNAME': f'C{cid}', 'FACILITYNAME': 'F',
+            'CONTINGENCYNAME': 'K', 'SHADOWPRICE': rng.exponential(30, len(binding)), 'SP_RT': rng.exponential(30, len(binding)),
+            'MAG_REF_PACKAGEVERSION__ID': PACKAGE_ID}))
+    market = pd.concat(market, ignore_index=True)
+    tables['MAGSNOWFLAKE.DAYZER.PROD_DA_CONSTRAINTS_MAPPED'] = market.drop(columns='SP_RT')
+    tables['MAGSNOWFLAKE.DAYZER.PROD_RT_CONSTRAINTS_MAPPED'] = market.drop(columns='SHADOWPRICE')
+
+    # monthly results and auctions
+    tables['MAGSNOWFLAKE.DAYZER_CUBES.NODES_RESULTS_MONTHLY'] = pd.DataFrame(
+        {'DATE': months.date, 'MAG_REF_POOL__ID': POOL_ID, 'MAG_REF_PACKAGEVERSION__ID': PACKAGE_ID})
+    tables['MAGSNOWFLAKE.DAYZER.VWMAG_CONSTRAINTS_RESULTS_MONTHLY'] = pd.concat([pd.DataFrame({
+        'MONTH': months.date, 'CONSTRAINTMAPPING_MAG_REF__ID': cid, 'CONSTRAINTMAPPING_DAYZER_REF__ID': ces_cids[0],
+        'CONSTRAINTMAPPING_DAYZER_REF__NAME': f'C{cid}', 'SCENARIONAME': scenario, 'MAG_REF_SCENARIO_INFO__ID': scenario_id,
+        'PEAKID': peak_id, 'SHADOWPRICE': rng.exponential(1000, len(months)), 'MAG_REF_POOL__ID': POOL_ID,
+        'BINDINGHOURSPCT': rng.random(len(months)) / 4, 'MINLOWERLIMIT': -500., 'MAXUPPERLIMIT': 500., 'MAG_REF_PRODUCT__ID': 1})
+        for scenario, scenario_id in SCENARIOS.items() for cid, ces_cids in CONSTRAINTS.items() for peak_id in [0, 1]], ignore_index=True)
+    tables['MAGSNOWFLAKE.DAYZER.VWMAG_SHADOWCOST'] = pd.DataFrame([{
+        'CID_CES': ces_cids[0], 'NAME_CES': 'n', 'MAG_REF_PACKAGEVERSION__ID': PACKAGE_ID, 'SHADOWCOST': -rng.exponential(500),
+        'MAG_REF_MARKET__ID': POOL_ID, 'POOLNAME': 'NYPP', 'ISANNUAL': 0, 'STARTDATE': month.date(),
+        'ENDDATE': (month + pd.offsets.MonthEnd(0)).date(), 'AUCTIONDATE': month.date(), 'PEAKID': 1, 'ROUND': 1}
+        for ces_cids in CONSTRAINTS.values() for month in months])
+
+    # daily outages
+    tables['MAGSNOWFLAKE.DAYZER_CUBES.LOR_RESULTS_DAILY'] = pd.concat([pd.DataFrame({
+        'MDB_SCENARIONAME': scenario, 'CONSTRAINTMAPPING_DAYZER_REF__ID': ces, 'MAG_REF_PACKAGEVERSION__ID': PACKAGE_ID, 'DATE': days.date,
+        'OUTAGEMAPPING_DAYZER_REF__ID': outage_id, 'EQKEY': equipment, 'ILODF': rng.random(len(days)),
+        'AVGREDIRECTEDFLOW': rng.normal(0, 20, len(days)), 'STARTDATE': days[0] + (days[-1] - days[0]) / 4,
+        'ENDDATE': days[-1] - (days[-1] - days[0]) / 4, 'STATUS': 'OUT'})
+        for scenario in SCENARIOS for ces in ces_names for outage_id, equipment in [(1, 'E1'), (2, 'E2')]], ignore_index=True)
+
+    return [duckdb_backend.write_fixture(df, table, fixtures_dir) for table, df in tables.items()]
+
+
+def benchmark_calls(start: str, end: str) -> List[Tuple[str, Callable[[Any], Any]]]:
+    """
+    (name, call(conn)) of the query functions of a report on the fixtures of build_fixtures, over start..end.
+    """
+    scenarios = list(SCENARIOS)[:2]
+    scenario_ids = [SCENARIOS[scenario] for scenario in scenarios]
+    cid_mags = list(CONSTRAINTS)
+    return [
+        ('get_scenario_id', lambda conn: sq.get_scenario_id(scenarios, conn)),
+        ('get_Load', lambda conn: sq.get_Load(scenarios, start, end, conn)),
+        ('get_Wind', lambda conn: sq.get_Wind(scenarios, start, end, conn)),
+        ('get_PostMortem', lambda conn: sq.get_PostMortem(POOL_ID, start, end, scenarios, conn)),
+        ('get_flows', lambda conn: sq.get_flows(cid_mags, POOL_ID, '10,20,30', str(PACKAGE_ID), scenario_ids, start, end, conn)),
+        ('get_catego', lambda conn: sq.get_catego(cid_mags, '10,20,30', str(PACKAGE_ID), POOL_ID, scenario_ids, start, end, conn)),
+        ('get_outages', lambda conn: sq.get_outages(cid_mags, POOL_ID, scenarios, start, end, conn)),
+        ('get_nb_hour_bind', lambda conn: sq.get_nb_hour_bind(POOL_ID, cid_mags[0], start, end, conn)),
+        ('get_historical_SP', lambda conn: sq.get_historical_SP(POOL_ID, cid_mags[0], scenario_ids, conn)),
+    ]
+
+
+def benchmark(fixtures_dir: str, start: str, end: str, repeat: int = 3) -> pd.DataFrame:
+    """
+    Best wall time (s) and rows of each query function on the stand-in loaded with fixtures_dir.
+    The result cache is not bypassed: run with MAG_QUERY_CACHE=0 to time the queries themselves
+    (the local stores of history_store and reference_data are filled by the first run).
+    """
+    conn = duckdb_backend.connect(fixtures_dir)
+    rows = []
+    try:
+        for name, call in benchmark_calls(start, end):
+            timings = []
+            for _ in range(repeat):
+                started = time.perf_counter()
+                result = call(conn)
+                timings.append(time.perf_counter() - started)
+            rows.append({'function': name, 'seconds': min(timings), 'rows': len(result)})
+    finally:
+        conn.close()
+    return pd.DataFrame(rows)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build the fixtures of the DuckDB stand-in, and time the query functions on them')
+    parser.add_argument('fixtures_dir')
+    parser.add_argument('--start', default='2024-01-01')
+    parser.add_argument('--end', default='2025-10-31')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--benchmark', action='store_true', help='time the query functions on the new fixtures')
+    args = parser.parse_args()
+    print(f"{len(build_fixtures(args.fixtures_dir, args.start, args.end, args.seed))} fixture(s) written to {args.fixtures_dir}")
+    if args.benchmark:
+        print(benchmark(args.fixtures_dir, args.start, args.end).to_string(index=False))
@@ -0,0 +1,26 @@
+from contextlib import nullcontext
+import pandas as pd
+from Snowflake_Natif_Connector import query_cache, query_log
+from services import snowflake_queries as sq
+from services.async_queries import AsyncQueryClient
+
+
+def get_markets(_conn):
+    return sq.query_to_df("select MAG_REF_MARKET__ID, MARKET from MAGSQLSERVER.DAYZERSTUDY.MAG_REF_MARKET", _conn)
+
+
+def test_submitted_queries_are_cached_and_logged(stand_in, tmp_path, monkeypatch):
+    monkeypatch.setattr(query_cache, 'ENABLED', True)
+    monkeypatch.setattr(query_cache, 'RESULT_CACHE', query_cache.QueryCache(str(tmp_path / 'queries')))
+    monkeypatch.setattr(query_log, 'ENABLED', True)
+    monkeypatch.setattr(query_log, 'QUERY_LOG', query_log.QueryLog(''))
+
+    with AsyncQueryClient(stand_in, connection_factory=lambda: nullcontext(stand_in)) as client:
+        first = get_markets(client).result()
+        cached = get_markets(client)
+        assert cached.done()
+        pd.testing.assert_frame_equal(cached.result(), first)
+        pd.testing.assert_frame_equal(get_markets(stand_in), first)
+
+    records = [(record['function'], record['cached']) for record in query_log.QUERY_LOG.records]
+    assert records == [('get_markets', False), ('get_markets', True), ('get_markets', True)]
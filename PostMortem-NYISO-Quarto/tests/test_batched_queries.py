@@ -0,0 +1,50 @@
+import pandas as pd
+import pytest
+import duckdb_fixtures
+from components import constraint_utils as cu
+from Snowflake_Natif_Connector import duckdb_backend
+from services import snowflake_queries as sq
+
+CONSTRAINT_MAP = 'MAGSQLSERVER.DAYZERSTUDY.MAG_CES_CONSTRAINTS_MAP_HISTORIC'
+SCENARIOS = list(duckdb_fixtures.SCENARIOS)[:2]
+MINDATE, MAXDATE = '2025-09-01', '2025-09-30'
+
+
+@pytest.fixture(scope='module')
+def fixtures_dir(tmp_path_factory):
+    # the fixtures of duckdb_fixtures, with the ces 20 of constraint 2 also mapped to constraint 3:
+    # constraint 1 has two ces and two constraints share one, AVOID_DOUBLONS keeps one ces per constraint
+    path = str(tmp_path_factory.mktemp('shared_ces_fixtures'))
+    duckdb_fixtures.build_fixtures(path, '2025-08-01', '2025-10-31')
+    database, schema, name = CONSTRAINT_MAP.split('.')
+    df = pd.read_parquet(f"{path}/{database}/{schema}/{name}.parquet")
+    shared = df[df['CES_CID'] == 20].assign(MAG_CID=3)
+    duckdb_backend.write_fixture(pd.concat([df, shared], ignore_index=True), CONSTRAINT_MAP, path)
+    return path
+
+
+def _call(function, cid_mag, conn):
+    ces, packids = cu.df_to_cid_ces_and_package_str(sq.get_cid_ces_packageid_from_cid_mag(duckdb_fixtures.POOL_ID, cid_mag, conn))
+    scenario_ids = cu.df_to_scenario_id(sq.get_scenario_id(SCENARIOS, conn))
+    pool_id = duckdb_fixtures.POOL_ID
+    return {
+        'get_flows': lambda: sq.get_flows(cid_mag, pool_id, ces, packids, scenario_ids, MINDATE, MAXDATE, conn),
+        'get_catego': lambda: sq.get_catego(cid_mag, ces, packids, pool_id, scenario_ids, MINDATE, MAXDATE, conn),
+        'get_outages': lambda: sq.get_outages(cid_mag, pool_id, SCENARIOS, MINDATE, MAXDATE, conn),
+    }[function]()
+
+
+def _values(df):
+    # the categories of a batch are those of all its constraints
+    df = df.apply(lambda column: column.astype(object) if isinstance(column.dtype, pd.CategoricalDtype) else column)
+    return df.sort_values(list(df.columns), ignore_index=True)
+
+
+@pytest.mark.parametrize('cid_mags', [[1, 2, 3], [3, 2], [1]])
+@pytest.mark.parametrize('function', ['get_flows', 'get_catego', 'get_outages'])
+def test_batch_equals_the_single_constraint_queries(stand_in, function, cid_mags):
+    batch = cu.split_by_constraint(_call(function, cid_mags, stand_in), cid_mags)
+    for cid in cid_mags:
+        single = _call(function, cid, stand_in)
+        assert len(single) > 0
+        pd.testing.assert_frame_equal(_values(batch[cid]), _values(single))
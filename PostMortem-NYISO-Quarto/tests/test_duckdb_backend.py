@@ -0,0 +1,31 @@
+import pandas as pd
+import pytest
+import duckdb_fixtures
+from Snowflake_Natif_Connector import duckdb_backend
+
+CALLS = duckdb_fixtures.benchmark_calls('2025-09-01', '2025-09-30')
+
+
+def test_translate_sql_keeps_string_literals():
+    sql = "select SPLIT_PART(CES_NAME,':',0), DATEADD(HOUR,-1,HEDATE), 'DATEADD(HOUR,1,x)' from T"
+    assert duckdb_backend.translate_sql(sql) == "select SPLIT_PART(CES_NAME,':',1), DATEADD('HOUR',-1,HEDATE), 'DATEADD(HOUR,1,x)' from T"
+
+
+def test_translate_sql_skips_session_settings():
+    assert duckdb_backend.translate_sql("ALTER SESSION SET QUERY_TAG = 'NERD_MONKEY'") is None
+
+
+def test_every_fixture_is_a_view(fixtures_dir, stand_in):
+    for database, schema, table, _ in duckdb_backend.list_fixtures(fixtures_dir):
+        cursor = stand_in.cursor()
+        try:
+            assert cursor.execute(f'select count(*) from {database}.{schema}.{table}').fetchall()[0][0] > 0
+        finally:
+            cursor.close()
+
+
+@pytest.mark.parametrize('name,call', CALLS, ids=[name for name, _ in CALLS])
+def test_query_functions_run_on_the_stand_in(stand_in, name, call):
+    result = call(stand_in)
+    assert isinstance(result, pd.DataFrame)
+    assert len(result) > 0
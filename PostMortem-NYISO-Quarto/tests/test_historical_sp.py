@@ -0,0 +1,46 @@
+import pandas as pd
+import pytest
+import duckdb_fixtures
+from Snowflake_Natif_Connector import duckdb_backend
+from services import history_store, reference_data
+from services import snowflake_queries as sq
+
+CONSTRAINT_MAP = 'MAGSQLSERVER.DAYZERSTUDY.MAG_CES_CONSTRAINTS_MAP_HISTORIC'
+
+
+@pytest.fixture(scope='module')
+def fixtures_dir(tmp_path_factory):
+    # the fixtures of duckdb_fixtures, with constraint 2 also mapped to a ces of the line of constraint 3
+    path = str(tmp_path_factory.mktemp('two_lines_fixtures'))
+    duckdb_fixtures.build_fixtures(path, '2024-12-01', '2025-10-31')
+    database, schema, name = CONSTRAINT_MAP.split('.')
+    df = pd.read_parquet(f"{path}/{database}/{schema}/{name}.parquet")
+    second_line = df[df['MAG_CID'] == 2].assign(CES_CID=21, CES_NAME='BR B:ctg2b')
+    duckdb_backend.write_fixture(pd.concat([df, second_line], ignore_index=True), CONSTRAINT_MAP, path)
+    return path
+
+
+def _historical_SP(conn, tmp_path, monkeypatch, pool_wide):
+    monkeypatch.setattr(sq, 'HISTORICAL_SP_POOL_WIDE', pool_wide)
+    monkeypatch.setattr(history_store, 'HISTORY_DIR', str(tmp_path / f'history_pool_wide={pool_wide}'))
+    sq.clear_historical_SP()
+    scenario_ids = list(duckdb_fixtures.SCENARIOS.values())
+    return {cid: sq.get_historical_SP(duckdb_fixtures.POOL_ID, cid, scenario_ids, conn) for cid in duckdb_fixtures.CONSTRAINTS}
+
+
+def test_pool_wide_and_per_line_histories_are_the_same(stand_in, tmp_path, monkeypatch):
+    lines = {name.split(':')[0] for name in reference_data.constraint_map(duckdb_fixtures.POOL_ID, stand_in)
+             .query('MAG_CID == 2')['CES_NAME']}
+    assert lines == {'BR A', 'BR B'}
+    per_line = _historical_SP(stand_in, tmp_path, monkeypatch, False)
+    pool_wide = _historical_SP(stand_in, tmp_path, monkeypatch, True)
+    for cid in duckdb_fixtures.CONSTRAINTS:
+        assert len(pool_wide[cid]) > 0
+        pd.testing.assert_frame_equal(pool_wide[cid], per_line[cid])
+
+
+def test_pool_without_monitored_line(stand_in, monkeypatch):
+    monkeypatch.setattr(sq.rd, 'monitored_lines', lambda pool_id, conn: [])
+    df = sq.get_historical_SP(duckdb_fixtures.POOL_ID, 1, list(duckdb_fixtures.SCENARIOS.values()), stand_in)
+    assert df.empty
+    assert list(df.columns) == ['STARTDATE', 'MAG_CID', 'NAME', 'CTG', 'PEAKID']
@@ -0,0 +1,67 @@
+from datetime import date
+import pandas as pd
+from services import history_store as hs
+
+
+def _month(offset):
+    return (pd.Timestamp(date.today().replace(day=1)) + pd.DateOffset(months=offset)).date().isoformat()
+
+
+def test_monthly_history_fetches_the_last_month_again(tmp_path):
+    path = str(tmp_path / 'history')
+    calls = []
+
+    def fetch(since):
+        calls.append(since)
+        return pd.DataFrame({'STARTDATE': pd.to_datetime([_month(-3), _month(-1), _month(0)]), 'VALUE': [1, 2, len(calls)]})
+
+    hs.monthly_history(path, fetch, 'STARTDATE')
+    df = hs.monthly_history(path, fetch, 'STARTDATE')
+    assert calls == [hs.HISTORY_START, _month(-1)]
+    assert df['VALUE'].tolist() == [1, 2, 2]
+
+
+def test_monthly_histories_fetch_only_the_new_keys_from_the_start(tmp_path):
+    paths = {key: str(tmp_path / key) for key in ('A', 'B')}
+    calls = []
+
+    def fetch(since, keys):
+        calls.append((since, keys))
+        return pd.DataFrame({'BRANCH': keys, 'STARTDATE': pd.to_datetime([_month(-2)] * len(keys))})
+
+    hs.monthly_histories({'A': paths['A']}, fetch, 'BRANCH', 'STARTDATE')
+    result = hs.monthly_histories(paths, fetch, 'BRANCH', 'STARTDATE')
+    assert calls == [(hs.HISTORY_START, ['A']), (hs.HISTORY_START, ['B']), (_month(-1), ['A'])]
+    assert [len(result[key]) for key in ('A', 'B')] == [1, 1]
+
+
+def test_hourly_history_applies_chunk_func_per_batch(tmp_path):
+    dates = pd.date_range('2025-01-01', '2025-01-10', freq='D')
+
+    def fetch(marks):
+        for day in dates:
+            yield pd.DataFrame({'SCENARIONAME': [scenario for scenario, _ in marks], 'DATE': day.date(), 'VALUE': 1.0})
+
+    seen = []
+    df = hs.hourly_history(str(tmp_path), ['S1', 'S2'], '2025-01-02', '2025-01-09', fetch,
+                           chunk_func=lambda batch: seen.append(len(batch)) or batch.groupby('SCENARIONAME', as_index=False)['VALUE'].sum())
+    assert df.groupby('SCENARIONAME')['VALUE'].sum().tolist() == [8.0, 8.0]
+    assert sum(seen) == 16
+
+
+def test_hourly_history_fetches_a_partial_last_day_again(tmp_path):
+    hours = {'2025-01-01': [1, 2, 3], '2025-01-02': [1, 2]}
+
+    def fetch(marks):
+        calls.append(marks)
+        for day, he in hours.items():
+            if day >= marks[0][1]:
+                yield pd.DataFrame({'SCENARIONAME': 'S1', 'DATE': pd.Timestamp(day).date(), 'HE': he})
+
+    calls = []
+    assert len(hs.hourly_history(str(tmp_path), ['S1'], '2025-01-01', '2025-01-02', fetch)) == 5
+    # the last day is complete at the next render with the same end_date
+    hours['2025-01-02'] = [1, 2, 3]
+    df = hs.hourly_history(str(tmp_path), ['S1'], '2025-01-01', '2025-01-02', fetch)
+    assert calls == [[['S1', '2025-01-01']], [['S1', '2025-01-02']]]
+    assert df.groupby('DATE')['HE'].count().tolist() == [3, 3]
@@ -0,0 +1,60 @@
+import os
+from datetime import date
+import pandas as pd
+import pytest
+from services import mirror_sync as ms
+
+TABLE = 'MAGSNOWFLAKE.DAYZER_CUBES.CONSTRAINTS_RESULTS_HOURLY'
+POOL_ID = 1
+
+
+@pytest.fixture
+def mirror_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(ms, 'MIRROR_DIR', str(tmp_path / 'mirror'))
+    return tmp_path / 'mirror'
+
+
+def _rows(stand_in, start, end):
+    cursor = stand_in.cursor()
+    try:
+        return cursor.execute(f"select count(*) from {TABLE} where HEDATE > ?::TIMESTAMP and HEDATE <= ?::TIMESTAMP",
+                              [start, end]).fetchall()[0][0]
+    finally:
+        cursor.close()
+
+
+def test_final_partitions_are_downloaded_once(stand_in, mirror_dir):
+    assert ms.sync_table(TABLE, POOL_ID, '2025-08-01', '2025-10-31', stand_in) == [
+        'pool=1/month=2025-08.parquet', 'pool=1/month=2025-09.parquet', 'pool=1/month=2025-10.parquet']
+    manifest = ms.read_manifest(TABLE)
+    assert all(entry['complete'] for entry in manifest.values())
+    mirrored = pd.read_parquet(os.path.join(ms.table_dir(TABLE), 'pool=1', 'month=2025-09.parquet'))
+    assert len(mirrored) == manifest['pool=1/month=2025-09.parquet']['rows'] == _rows(stand_in, '2025-09-01', '2025-10-01')
+    assert ms.sync_table(TABLE, POOL_ID, '2025-08-01', '2025-10-31', stand_in) == []
+    assert ms.sync_table(TABLE, POOL_ID, '2025-10-01', '2025-10-31', stand_in, force=True) == ['pool=1/month=2025-10.parquet']
+
+
+def test_corrupted_partition_is_downloaded_again(stand_in, mirror_dir):
+    ms.sync_table(TABLE, POOL_ID, '2025-09-01', '2025-10-31', stand_in)
+    path = os.path.join(ms.table_dir(TABLE), 'pool=1', 'month=2025-09.parquet')
+    expected = pd.read_parquet(path)
+    with open(path, 'ab') as f:
+        f.write(b'corrupted')
+    assert ms.verify_mirror([TABLE]) == {TABLE: ['pool=1/month=2025-09.parquet']}
+    assert ms.sync_table(TABLE, POOL_ID, '2025-09-01', '2025-10-31', stand_in) == ['pool=1/month=2025-09.parquet']
+    assert ms.verify_mirror([TABLE]) == {}
+    pd.testing.assert_frame_equal(pd.read_parquet(path), expected)
+
+
+def test_months_without_rows(stand_in, mirror_dir):
+    # a final month before the fixtures is kept without a file, the current month is synced every time
+    current_month = f"pool=1/month={date.today():%Y-%m}.parquet"
+    assert ms.sync_table(TABLE, POOL_ID, '2020-01-01', '2020-01-31', stand_in) == ['pool=1/month=2020-01.parquet']
+    assert ms.sync_table(TABLE, POOL_ID, date.today().isoformat(), date.today().isoformat(), stand_in) == [current_month]
+    manifest = ms.read_manifest(TABLE)
+    assert manifest['pool=1/month=2020-01.parquet']['rows'] == manifest[current_month]['rows'] == 0
+    assert [manifest[name]['complete'] for name in ('pool=1/month=2020-01.parquet', current_month)] == [True, False]
+    assert not os.path.exists(os.path.join(ms.table_dir(TABLE), 'pool=1', 'month=2020-01.parquet'))
+    assert ms.verify_mirror([TABLE]) == {}
+    assert ms.sync_table(TABLE, POOL_ID, '2020-01-01', date.today().isoformat(), stand_in)[-1:] == [current_month]
+    assert 'pool=1/month=2020-01.parquet' not in ms.sync_table(TABLE, POOL_ID, '2020-01-01', '2020-01-31', stand_in)
@@ -0,0 +1,87 @@
+import pandas as pd
+import pytest
+from components import constraint_utils as cu
+from components import report_planner as rp
+from Snowflake_Natif_Connector import conn_python_snowflake as ntf
+from services import snowflake_queries as sq
+
+QMD = '''---
+title: "Post-mortem"
+---
+
+```{python}
+%matplotlib inline
+from components import constraint_utils as cu
+pool_id = 1
+scenarios = ['NYPP_1MA_Default', 'NYPP_1DA_Default']
+start, end = '2025-09-01', '2025-09-30'
+histo_start = '2025-09-01'
+histo_end = f"2025-{9:02d}-30"
+```
+
+Some text.
+
+```{python}
+cu.get_all_cstr_data(pool_id, 1, histo_start, histo_end, histo_start, histo_end,
+                     scenarios, scenarios[0], scenarios, scenarios, conn)
+cid = top_constraint(conn)
+cu.get_all_cstr_data(pool_id, cid, histo_start, histo_end, histo_start, histo_end,
+                     scenarios, scenarios[0], scenarios, scenarios, conn)
+```
+
+```{python}
+for cid in [2, 3]:
+    cu.get_all_cstr_data(pool_id, cid, histo_start, histo_end, histo_start, histo_end,
+                         scenarios, scenarios[0], scenarios, scenarios, _conn=conn, max_workers=2)
+cu.get_all_cstr_data(pool_id, cid, histo_start, histo_end, histo_start, histo_end,
+                     scenarios, scenarios[0], scenarios, scenarios, conn)
+```
+'''
+SCENARIOS = ['NYPP_1MA_Default', 'NYPP_1DA_Default']
+
+
+def _values(df):
+    # the categories of a batch are those of all its constraints
+    df = df.apply(lambda column: column.astype(object) if isinstance(column.dtype, pd.CategoricalDtype) else column)
+    return df.sort_values(list(df.columns), ignore_index=True)
+
+
+@pytest.fixture
+def qmd_path(tmp_path):
+    path = tmp_path / 'report.qmd'
+    path.write_text(QMD, encoding='utf-8')
+    return str(path)
+
+
+def test_plan_report_keeps_the_calls_with_known_arguments(qmd_path):
+    planned = {'pool_id': 1, 'ftrstartdate': '2025-09-01', 'ftrenddate': '2025-09-30', 'histostartdate': '2025-09-01',
+               'histoenddate': '2025-09-30', 'scenario_flows': SCENARIOS, 'scenario_first_priority': SCENARIOS[0],
+               'scenario_sf': SCENARIOS, 'scenario_histo_sp': SCENARIOS, 'result_format': 'pandas'}
+    # the call on the computed cid and the one after the loop are not planned
+    assert rp.plan_report(qmd_path) == [dict(planned, cid_mag=cid) for cid in (1, 2, 3)]
+
+
+def test_prefetched_report_runs_no_constraint_query(stand_in, qmd_path, monkeypatch):
+    monkeypatch.setattr(cu, '_PREFETCHED', {})
+    monkeypatch.setattr(cu, 'show', lambda *args, **kwargs: None)
+    monkeypatch.setattr(cu.gu, 'shadowprice_monthly_fig', lambda *args, **kwargs: None)
+    drawn = []
+    monkeypatch.setattr(cu.gu, 'hourly_figure', lambda df_flows, *args: drawn.append(df_flows))
+    expected = {cid: cu.get_cdd_data(cid, 1, SCENARIOS, SCENARIOS, SCENARIOS, '2025-09-01', '2025-09-30', stand_in,
+                                     max_workers=1, prefetched={})[0] for cid in (1, 2, 3)}
+
+    assert list(rp.prefetch_report(qmd_path, stand_in, max_workers=1).values()) == [[1, 2, 3]]
+
+    executed = []
+    for name in ('executeQueryNatif', 'iterQueryNatif'):
+        def record(query_data, conn, *args, _run=getattr(ntf, name), **kwargs):
+            executed.extend(sql for sql, _ in query_data)
+            return _run(query_data, conn, *args, **kwargs)
+        monkeypatch.setattr(ntf, name, record)
+    for cid in (1, 2, 3):
+        cu.get_all_cstr_data(1, cid, '2025-09-01', '2025-09-30', '2025-09-01', '2025-09-30',
+                             SCENARIOS, SCENARIOS[0], SCENARIOS, SCENARIOS, stand_in)
+    # only the binding hours of the ftr window are queried for each constraint
+    assert executed and set(executed) <= {sql for sql, _ in sq.NB_HOUR_BIND_QUERY.statements}
+    for cid, df_flows in zip((1, 2, 3), drawn):
+        pd.testing.assert_frame_equal(_values(df_flows), _values(expected[cid]))
@@ -0,0 +1,18 @@
+import duckdb_fixtures
+from components import constraint_utils as cu
+
+
+def test_stand_in_is_not_pooled(stand_in):
+    assert cu.connection_factory_of(stand_in) is None
+
+
+def test_concurrent_queries_run_on_the_given_connection(stand_in):
+    queries = {name: (lambda name, conn, result_format: conn, (name,)) for name in ('flows', 'catego', 'outages')}
+    assert all(conn is stand_in for conn in cu.run_queries(queries, stand_in, max_workers=4).values())
+
+
+def test_cdd_data_on_the_stand_in(stand_in):
+    scenarios = list(duckdb_fixtures.SCENARIOS)[:2]
+    flows, catego, outages, histo_sp = cu.get_cdd_data(1, duckdb_fixtures.POOL_ID, scenarios, scenarios, scenarios,
+                                                       '2025-09-01', '2025-09-30', stand_in)
+    assert len(flows) and len(catego) and len(outages) and len(histo_sp)
@@ -0,0 +1,103 @@
+import pandas as pd
+import pytest
+import duckdb_fixtures
+from Snowflake_Natif_Connector import duckdb_backend
+from services import snowflake_queries as sq
+
+# get_flows / get_catego / get_nb_hour_bind select the hours ending of mindate..maxdate with a range
+# on the raw column (partition pruning). The predicates they replaced are put back in the templates
+# and both versions must return the same rows.
+FLOWS_PREDICATE = ("HEDATE >= DATEADD(HOUR,1,date(?)) AND HEDATE < DATEADD(HOUR,25,date(?))",
+                   "CAST(DATEADD(HOUR,-1,HEDATE) AS DATE) between date(?) AND date(?)")
+NB_HOUR_BIND_PREDICATE = ("DATETIME >= DATEADD(HOUR,1,DATE(?)) AND DATETIME < DATEADD(HOUR,25,DATE(?))",
+                          "DATE_TRUNC(DAY,DATEADD(HOUR,-1,DATETIME)) between DATE(?) AND DATE(?)")
+OLD_PREDICATES = [(sq.FLOWS_QUERY, FLOWS_PREDICATE), (sq.CATEGO_QUERY, FLOWS_PREDICATE), (sq.NB_HOUR_BIND_QUERY, NB_HOUR_BIND_PREDICATE)]
+
+WINDOWS = {
+    'month': ('2025-09-01', '2025-09-30'),
+    'single_day': ('2025-10-15', '2025-10-15'),
+    'year_boundary': ('2024-12-31', '2025-01-01'),
+}
+# rows added around the midnights of the windows, off the hour
+SUB_HOUR = [pd.Timedelta(-1, 'us'), pd.Timedelta(0), pd.Timedelta(1, 'us'), pd.Timedelta(minutes=30),
+            pd.Timedelta(minutes=59, seconds=59, microseconds=999999), pd.Timedelta(hours=1, microseconds=1)]
+HOURLY_TABLES = {'MAGSNOWFLAKE.DAYZER_CUBES.CONSTRAINTS_RESULTS_HOURLY': 'HEDATE',
+                 'MAGSNOWFLAKE.DAYZER_CUBES.CATEGORY_RESULTS_HOURLY': 'HEDATE',
+                 'MAGSNOWFLAKE.DAYZER_CUBES_STAGING.YESENERGY_PEAKS': 'DATETIME'}
+
+
+def _midnights():
+    days = set()
+    for mindate, maxdate in WINDOWS.values():
+        for day in (pd.Timestamp(mindate), pd.Timestamp(maxdate) + pd.Timedelta(days=1)):
+            days.update(day + pd.Timedelta(days=shift) for shift in (-1, 0, 1))
+    return sorted(days)
+
+
+@pytest.fixture(scope='module')
+def fixtures_dir(tmp_path_factory):
+    # the fixtures of duckdb_fixtures, with copies of the first hour of the days around
+    # the windows moved to sub-hour timestamps around midnight
+    path = str(tmp_path_factory.mktemp('sub_hour_fixtures'))
+    duckdb_fixtures.build_fixtures(path, '2024-12-01', '2025-10-31')
+    for table, column in HOURLY_TABLES.items():
+        database, schema, name = table.split('.')
+        df = pd.read_parquet(f"{path}/{database}/{schema}/{name}.parquet")
+        copies = []
+        for midnight in _midnights():
+            first_hour = df[df[column] == midnight + pd.Timedelta(hours=1)]
+            copies += [first_hour.assign(**{column: midnight + offset}) for offset in SUB_HOUR]
+        duckdb_backend.write_fixture(pd.concat([df] + copies, ignore_index=True), table, path)
+    return path
+
+
+@pytest.fixture
+def old_predicates(monkeypatch):
+    # the templates with the predicates used before
+    for template, (new, old) in OLD_PREDICATES:
+        assert sum(new in sql for sql, _ in template.statements) == 1, template.name
+        monkeypatch.setattr(template, 'statements', [(sql.replace(new, old), names) for sql, names in template.statements])
+
+
+def _sorted(df):
+    return df.sort_values(list(df.columns), ignore_index=True)
+
+
+def _calls(mindate, maxdate):
+    scenario_ids = [duckdb_fixtures.SCENARIOS[name] for name in list(duckdb_fixtures.SCENARIOS)[:2]]
+    cid_mags = list(duckdb_fixtures.CONSTRAINTS)
+    pool_id, packid = duckdb_fixtures.POOL_ID, str(duckdb_fixtures.PACKAGE_ID)
+    return {
+        'get_flows': lambda conn: sq.get_flows(cid_mags, pool_id, '10,20,30', packid, scenario_ids, mindate, maxdate, conn),
+        'get_catego': lambda conn: sq.get_catego(cid_mags, '10,20,30', packid, pool_id, scenario_ids, mindate, maxdate, conn),
+        'get_nb_hour_bind': lambda conn: sq.get_nb_hour_bind(pool_id, cid_mags[0], mindate, maxdate, conn),
+    }
+
+
+@pytest.mark.parametrize('window', list(WINDOWS))
+@pytest.mark.parametrize('function', ['get_flows', 'get_catego', 'get_nb_hour_bind'])
+def test_old_and_new_predicates_return_the_same_rows(stand_in, request, window, function):
+    call = _calls(*WINDOWS[window])[function]
+    new = call(stand_in)
+    assert len(new) > 0
+    request.getfixturevalue('old_predicates')
+    old = call(stand_in)
+    pd.testing.assert_frame_equal(_sorted(old), _sorted(new))
+
+
+@pytest.mark.parametrize('window', list(WINDOWS))
+@pytest.mark.parametrize('table', list(HOURLY_TABLES))
+def test_old_and_new_predicates_select_the_same_timestamps(stand_in, window, table):
+    column = HOURLY_TABLES[table]
+    new, old = FLOWS_PREDICATE if column == 'HEDATE' else NB_HOUR_BIND_PREDICATE
+    selected = []
+    for predicate in (new, old):
+        cursor = stand_in.cursor()
+        try:
+            rows = cursor.execute(f"select distinct {column} from {table} where {predicate}", list(WINDOWS[window])).fetchall()
+        finally:
+            cursor.close()
+        selected.append({row[0] for row in rows})
+    assert selected[0] == selected[1]
+    # the sub-hour rows are part of the comparison
+    assert any(pd.Timestamp(value).minute or pd.Timestamp(value).microsecond for value in selected[0])
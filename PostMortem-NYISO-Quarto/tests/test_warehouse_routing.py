@@ -0,0 +1,134 @@
+import pytest
+from components import constraint_utils as cu
+from services import warehouse_routing as wr
+
+WAREHOUSES = {'small': 'SMALL_WH', 'large': 'LARGE_WH'}
+
+
+class ProgrammingError(Exception):
+    pass
+
+
+# raised like the errors of snowflake.connector
+ProgrammingError.__module__ = 'snowflake.connector.errors'
+
+
+class FakeCursor:
+    def __init__(self, conn):
+        self.conn = conn
+
+    def execute(self, sql, params=None):
+        self.conn.executed.append(sql)
+        return self
+
+    def fetchall(self):
+        return [(self.conn.current_warehouse,)]
+
+    def close(self):
+        pass
+
+
+class FakeConnection:
+    def __init__(self, warehouse, current_warehouse=None):
+        self.warehouse = warehouse
+        self.current_warehouse = current_warehouse
+        self.executed = []
+
+    def cursor(self):
+        return FakeCursor(self)
+
+
+# the connections of snowflake.connector can be pooled (see constraint_utils.connection_factory_of)
+FakeConnection.__module__ = 'snowflake.connector.connection'
+
+
+class FakePool:
+    def __init__(self, conn):
+        self.conn = conn
+        self.acquired = 0
+        self.released = []
+
+    def acquire(self, timeout=None):
+        self.acquired += 1
+        return self.conn
+
+    def release(self, conn, discard=False):
+        self.released.append(discard)
+
+
+@pytest.fixture
+def pools(monkeypatch):
+    pools = {'SMALL_WH': FakePool(FakeConnection('SMALL_WH', 'SMALL_WH'))}
+    monkeypatch.setattr(wr, 'get_pool', lambda warehouse: pools[warehouse])
+    return pools
+
+
+@pytest.fixture
+def router(pools):
+    return wr.WarehouseRouter(FakeConnection('LARGE_WH', 'LARGE_WH'), WAREHOUSES, {'get_lookup': 'small', 'get_scan': 'large'})
+
+
+def get_lookup(router, func):
+    return router.run_routed(func)
+
+
+def get_scan(router, func):
+    return router.run_routed(func)
+
+
+def _record(function, execute_s, rows, warehouse='LARGE_WH', cached=False):
+    return {'function': function, 'warehouse': warehouse, 'execute_s': execute_s, 'rows': rows, 'cached': cached}
+
+
+def test_learned_sizes_use_the_uncached_runs_on_the_large_warehouse():
+    records = ([_record('fast', 0.5, 10)] * 3 + [_record('slow', 30.0, 10)] * 3 + [_record('wide', 0.5, 10**6)] * 3
+               + [_record('rare', 0.5, 10)] * 2
+               + [_record('cached', 0.0, 10, cached=True)] * 3 + [_record('elsewhere', 0.5, 10, warehouse='SMALL_WH')] * 3)
+    assert wr.learned_sizes(records, 'LARGE_WH') == {'fast': 'small', 'slow': 'large', 'wide': 'large'}
+    assert wr.learned_sizes([], 'LARGE_WH') == {}
+
+
+def test_functions_run_on_the_warehouse_of_their_size(router, pools):
+    assert get_lookup(router, lambda conn: conn.warehouse) == 'SMALL_WH'
+    assert get_scan(router, lambda conn: conn.warehouse) == 'LARGE_WH'
+    assert pools['SMALL_WH'].released == [False]
+
+
+def test_warehouse_is_checked_once(router, pools):
+    for _ in range(2):
+        get_lookup(router, lambda conn: conn.warehouse)
+    assert pools['SMALL_WH'].conn.executed == ['SELECT CURRENT_WAREHOUSE()']
+
+
+def test_warehouse_without_active_session_is_not_used(router, pools):
+    pools['SMALL_WH'].conn.current_warehouse = None
+    assert get_lookup(router, lambda conn: conn.warehouse) == 'LARGE_WH'
+    assert pools['SMALL_WH'].released == [True]
+    assert router.warehouse_for('get_lookup') == 'LARGE_WH'
+    get_lookup(router, lambda conn: conn.warehouse)
+    assert pools['SMALL_WH'].acquired == 1
+
+
+def test_query_failing_on_a_small_warehouse_runs_again_on_the_large_one(router, pools):
+    def query(conn):
+        if conn.warehouse == 'SMALL_WH':
+            raise ProgrammingError("No active warehouse selected in the current session")
+        return conn
+
+    assert get_lookup(router, query) is router.conn
+    assert pools['SMALL_WH'].released == [True]
+    assert router.warehouse_for('get_lookup') == 'LARGE_WH'
+
+
+def test_other_errors_are_raised(router, pools):
+    def query(conn):
+        raise ProgrammingError("SQL compilation error")
+
+    with pytest.raises(ProgrammingError):
+        get_lookup(router, query)
+    assert router.warehouse_for('get_lookup') == 'SMALL_WH'
+
+
+def test_concurrent_queries_of_a_router_use_the_pool_of_its_warehouse(router):
+    factory = cu.connection_factory_of(router)
+    assert factory.args == ('LARGE_WH',)